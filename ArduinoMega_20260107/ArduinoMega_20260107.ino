@@ -14,6 +14,7 @@ const int PIN_RST = 3; // デジタル出力 (リセット)
 
 // 変数
 float volFx, volFy, volFz, volMx, volMy, volMz;
+uint16_t adcForce[6]; // analogRead の生値 (バイナリ送信用)
 
 // --- MPU-6050 (IMU) 設定 ---
 const int MPU_addr = 0x68;
@@ -114,15 +115,54 @@ void readIMU() {
 // --- DAIF-1500読み取り ---
 void readForceSensor() {
     // アナログ読み取り & 電圧変換 (0-5V)
-    volFx = analogRead(PIN_FX) * (5.0 / 1023.0);
-    volFy = analogRead(PIN_FY) * (5.0 / 1023.0);
-    volFz = analogRead(PIN_FZ) * (5.0 / 1023.0);
-    volMx = analogRead(PIN_MX) * (5.0 / 1023.0);
-    volMy = analogRead(PIN_MY) * (5.0 / 1023.0);
-    volMz = analogRead(PIN_MZ) * (5.0 / 1023.0);
+    adcForce[0] = analogRead(PIN_FX);
+    adcForce[1] = analogRead(PIN_FY);
+    adcForce[2] = analogRead(PIN_FZ);
+    adcForce[3] = analogRead(PIN_MX);
+    adcForce[4] = analogRead(PIN_MY);
+    adcForce[5] = analogRead(PIN_MZ);
+    volFx = adcForce[0] * (5.0 / 1023.0);
+    volFy = adcForce[1] * (5.0 / 1023.0);
+    volFz = adcForce[2] * (5.0 / 1023.0);
+    volMx = adcForce[3] * (5.0 / 1023.0);
+    volMy = adcForce[4] * (5.0 / 1023.0);
+    volMz = adcForce[5] * (5.0 / 1023.0);
+}
+
+// --- バイナリ送信 ('b' で開始) ---
+// 1 フレーム 38 バイト (リトルエンディアン). 受信側は moveRobot/telemetry.py
+// CSV 1 行 (約 90 バイト) の半分以下で, Serial.print の数値→文字列変換もなくなる
+const uint16_t FRAME_SYNC = 0xA55A; // 送信順は 0x5A, 0xA5
+
+struct __attribute__((packed)) TelemetryFrame {
+    uint16_t sync;
+    uint16_t seq;       // フレームごとに +1 (抜けの検出用)
+    uint32_t micros;    // 計測時刻 [us]
+    int32_t  current;   // 電流 x100 [A] (VESC の値そのまま)
+    int16_t  imu[6];    // AcX, AcY, AcZ, GyX, GyY, GyZ
+    uint16_t force[6];  // Fx, Fy, Fz, Mx, My, Mz (analogRead の生値. x 5/1023 で電圧)
+    uint16_t crc;       // sync から force までの crc16
+};
+
+TelemetryFrame frame;
+uint16_t frameSeq = 0;
+
+void send_frame(uint32_t t, int32_t current) {
+    frame.sync    = FRAME_SYNC;
+    frame.seq     = frameSeq++;
+    frame.micros  = t;
+    frame.current = current;
+    frame.imu[0] = AcX; frame.imu[1] = AcY; frame.imu[2] = AcZ;
+    frame.imu[3] = GyX; frame.imu[4] = GyY; frame.imu[5] = GyZ;
+    for (int i = 0; i < 6; i++) {
+        frame.force[i] = adcForce[i];
+    }
+    frame.crc = crc16((unsigned char *)&frame, sizeof(frame) - sizeof(frame.crc));
+    Serial.write((uint8_t *)&frame, sizeof(frame));
 }
 
 bool isRunning = false;
+bool isBinary = false; // true: send_frame で送信, false: CSV 文字列で送信
 unsigned long lastTime = 0; 
 
 void setup() {
@@ -158,6 +198,12 @@ void loop() {
         char command = Serial.read();
         if (command == 's') {
             isRunning = true;
+            isBinary = false;
+            lastTime = millis();
+        } else if (command == 'b') {
+            isRunning = true;
+            isBinary = true;
+            frameSeq = 0;
             lastTime = millis();
         } else if (command == 'e') {
             isRunning = false; 
@@ -211,37 +257,46 @@ void loop() {
                         buffer_get_int16(rx_buffer, &ind); 
                         
                         // 1. 電流値
-                        float currentMotor = buffer_get_int32(rx_buffer, &ind) / 100.0;
+                        int32_t currentRaw = buffer_get_int32(rx_buffer, &ind);
+                        float currentMotor = currentRaw / 100.0;
                         
                         // 2. IMU取得
                         readIMU();
 
                         // 3. 力覚センサ取得
                         readForceSensor();
-
-                        // 4. 周波数計算
-                        unsigned long currentTime = millis();
-                        float actualFreq = 1000.0 / (currentTime - lastTime + 0.001); 
-                        lastTime = currentTime;
-
-                        // 5. 一括送信 (電流, IMU6軸, 力覚6軸, 周波数)
-                        Serial.print(currentMotor); Serial.print(",");
-                        // IMU
-                        Serial.print(AcX); Serial.print(",");
-                        Serial.print(AcY); Serial.print(",");
-                        Serial.print(AcZ); Serial.print(",");
-                        Serial.print(GyX); Serial.print(",");
-                        Serial.print(GyY); Serial.print(",");
-                        Serial.print(GyZ); Serial.print(",");
-                        // Force (Voltage)
-                        Serial.print(volFx, 3); Serial.print(",");
-                        Serial.print(volFy, 3); Serial.print(",");
-                        Serial.print(volFz, 3); Serial.print(",");
-                        Serial.print(volMx, 3); Serial.print(",");
-                        Serial.print(volMy, 3); Serial.print(",");
-                        Serial.print(volMz, 3); Serial.print(",");
-                        // Freq
-                        Serial.println(actualFreq);
+                        unsigned long sampleMicros = micros(); // 取得時刻 (受信側で PC の時計に合わせる)
+
+                        if (isBinary) {
+                            // 周波数は受信側で micros の差から求める
+                            send_frame(sampleMicros, currentRaw);
+                        } else {
+                            // 4. 周波数計算
+                            unsigned long currentTime = millis();
+                            float actualFreq = 1000.0 / (currentTime - lastTime + 0.001); 
+                            lastTime = currentTime;
+
+                            // 5. 一括送信 (電流, IMU6軸, 力覚6軸, 周波数, 取得時刻)
+                            Serial.print(currentMotor); Serial.print(",");
+                            // IMU
+                            Serial.print(AcX); Serial.print(",");
+                            Serial.print(AcY); Serial.print(",");
+                            Serial.print(AcZ); Serial.print(",");
+                            Serial.print(GyX); Serial.print(",");
+                            Serial.print(GyY); Serial.print(",");
+                            Serial.print(GyZ); Serial.print(",");
+                            // Force (Voltage)
+                            Serial.print(volFx, 3); Serial.print(",");
+                            Serial.print(volFy, 3); Serial.print(",");
+                            Serial.print(volFz, 3); Serial.print(",");
+                            Serial.print(volMx, 3); Serial.print(",");
+                            Serial.print(volMy, 3); Serial.print(",");
+                            Serial.print(volMz, 3); Serial.print(",");
+                            // Freq
+                            Serial.print(actualFreq); Serial.print(",");
+                            // micros
+                            Serial.println(sampleMicros);
+                        }
                     }
                 }
             }
@@ -0,0 +1,524 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import struct
+from ctypes import *
+from bcapclient import BCAPClient
+from orinexception import *
+
+class AsyncBCAPClient:
+  def __init__(self, host, port, timeout):
+    self._host    = host
+    self._port    = port
+    self._serial  = 1
+    self._version = 0
+    self._timeout = timeout
+    self._reader  = None
+    self._writer  = None
+    self._head    = None
+    self._lock    = asyncio.Lock()
+    self._codec   = BCAPClient.codec()
+
+  async def __aenter__(self):
+    await self.connect()
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+  async def connect(self):
+    self._head = None
+    try:
+      (self._reader, self._writer) = await asyncio.wait_for(
+        asyncio.open_connection(self._host, self._port), self._timeout)
+    except asyncio.TimeoutError:
+      raise ORiNException(HResult.E_TIMEOUT)
+
+  async def close(self):
+    if not (self._writer is None):
+      try:
+        self._writer.close()
+        await self._writer.wait_closed()
+      except OSError:
+        pass
+      finally:
+        self._reader = None
+        self._writer = None
+        self._head   = None
+
+  def settimeout(self, timeout):
+    self._timeout = timeout
+
+  def gettimeout(self):
+    return self._timeout
+
+  def setndarray(self, enable):
+    self._codec.setndarray(enable)
+
+  def getndarray(self):
+    return self._codec.getndarray()
+
+  async def service_start(self, option = ""):
+    await self._send_and_recv(1, [option])
+
+  async def service_stop(self):
+    await self._send_and_recv(2, [])
+
+  async def controller_connect(self, name, provider, machine, option):
+    return (await self._send_and_recv(3, [name, provider, machine, option]))[0]
+
+  async def controller_disconnect(self, handle):
+    await self._send_and_recv(4, [handle])
+
+  async def controller_getextension(self, handle, name, option = ""):
+    return (await self._send_and_recv(5, [handle, name, option]))[0]
+
+  async def controller_getfile(self, handle, name, option = ""):
+    return (await self._send_and_recv(6, [handle, name, option]))[0]
+
+  async def controller_getrobot(self, handle, name, option = ""):
+    return (await self._send_and_recv(7, [handle, name, option]))[0]
+
+  async def controller_gettask(self, handle, name, option = ""):
+    return (await self._send_and_recv(8, [handle, name, option]))[0]
+
+  async def controller_getvariable(self, handle, name, option = ""):
+    return (await self._send_and_recv(9, [handle, name, option]))[0]
+
+  async def controller_getcommand(self, handle, name, option = ""):
+    return (await self._send_and_recv(10, [handle, name, option]))[0]
+
+  async def controller_getextensionnames(self, handle, option = ""):
+    return (await self._send_and_recv(11, [handle, option]))[0]
+
+  async def controller_getfilenames(self, handle, option = ""):
+    return (await self._send_and_recv(12, [handle, option]))[0]
+
+  async def controller_getrobotnames(self, handle, option = ""):
+    return (await self._send_and_recv(13, [handle, option]))[0]
+
+  async def controller_gettasknames(self, handle, option = ""):
+    return (await self._send_and_recv(14, [handle, option]))[0]
+
+  async def controller_getvariablenames(self, handle, option = ""):
+    return (await self._send_and_recv(15, [handle, option]))[0]
+
+  async def controller_getcommandnames(self, handle, option = ""):
+    return (await self._send_and_recv(16, [handle, option]))[0]
+
+  async def controller_execute(self, handle, command, param = None):
+    return (await self._send_and_recv(17, [handle, command, param]))[0]
+
+  async def controller_getmessage(self, handle):
+    return (await self._send_and_recv(18, [handle]))[0]
+
+  async def controller_getattribute(self, handle):
+    return (await self._send_and_recv(19, [handle]))[0]
+
+  async def controller_gethelp(self, handle):
+    return (await self._send_and_recv(20, [handle]))[0]
+
+  async def controller_getname(self, handle):
+    return (await self._send_and_recv(21, [handle]))[0]
+
+  async def controller_gettag(self, handle):
+    return (await self._send_and_recv(22, [handle]))[0]
+
+  async def controller_puttag(self, handle, newval):
+    await self._send_and_recv(23, [handle, newval])
+
+  async def controller_getid(self, handle):
+    return (await self._send_and_recv(24, [handle]))[0]
+
+  async def controller_putid(self, handle, newval):
+    await self._send_and_recv(25, [handle, newval])
+
+  async def extension_getvariable(self, handle, name, option = ""):
+    return (await self._send_and_recv(26, [handle, name, option]))[0]
+
+  async def extension_getvariablenames(self, handle, option = ""):
+    return (await self._send_and_recv(27, [handle, option]))[0]
+
+  async def extension_execute(self, handle, command, param = None):
+    return (await self._send_and_recv(28, [handle, command, param]))[0]
+
+  async def extension_getattribute(self, handle):
+    return (await self._send_and_recv(29, [handle]))[0]
+
+  async def extension_gethelp(self, handle):
+    return (await self._send_and_recv(30, [handle]))[0]
+
+  async def extension_getname(self, handle):
+    return (await self._send_and_recv(31, [handle]))[0]
+
+  async def extension_gettag(self, handle):
+    return (await self._send_and_recv(32, [handle]))[0]
+
+  async def extension_puttag(self, handle, newval):
+    await self._send_and_recv(33, [handle, newval])
+
+  async def extension_getid(self, handle):
+    return (await self._send_and_recv(34, [handle]))[0]
+
+  async def extension_putid(self, handle, newval):
+    await self._send_and_recv(35, [handle, newval])
+
+  async def extension_release(self, handle):
+    await self._send_and_recv(36, [handle])
+
+  async def file_getfile(self, handle, name, option = ""):
+    return (await self._send_and_recv(37, [handle, name, option]))[0]
+
+  async def file_getvariable(self, handle, name, option = ""):
+    return (await self._send_and_recv(38, [handle, name, option]))[0]
+
+  async def file_getfilenames(self, handle, option = ""):
+    return (await self._send_and_recv(39, [handle, option]))[0]
+
+  async def file_getvariablenames(self, handle, option = ""):
+    return (await self._send_and_recv(40, [handle, option]))[0]
+
+  async def file_execute(self, handle, command, param = None):
+    return (await self._send_and_recv(41, [handle, command, param]))[0]
+
+  async def file_copy(self, handle, name, option = ""):
+    await self._send_and_recv(42, [handle, name, option])
+
+  async def file_delete(self, handle, option = ""):
+    await self._send_and_recv(43, [handle, option])
+
+  async def file_move(self, handle, name, option = ""):
+    await self._send_and_recv(44, [handle, name, option])
+
+  async def file_run(self, handle, option = ""):
+    return (await self._send_and_recv(45, [handle, option]))[0]
+
+  async def file_getdatecreated(self, handle):
+    return (await self._send_and_recv(46, [handle]))[0]
+
+  async def file_getdatelastaccessed(self, handle):
+    return (await self._send_and_recv(47, [handle]))[0]
+
+  async def file_getdatelastmodified(self, handle):
+    return (await self._send_and_recv(48, [handle]))[0]
+
+  async def file_getpath(self, handle):
+    return (await self._send_and_recv(49, [handle]))[0]
+
+  async def file_getsize(self, handle):
+    return (await self._send_and_recv(50, [handle]))[0]
+
+  async def file_gettype(self, handle):
+    return (await self._send_and_recv(51, [handle]))[0]
+
+  async def file_getvalue(self, handle):
+    return (await self._send_and_recv(52, [handle]))[0]
+
+  async def file_putvalue(self, handle, newval):
+    await self._send_and_recv(53, [handle, newval])
+
+  async def file_getattribute(self, handle):
+    return (await self._send_and_recv(54, [handle]))[0]
+
+  async def file_gethelp(self, handle):
+    return (await self._send_and_recv(55, [handle]))[0]
+
+  async def file_getname(self, handle):
+    return (await self._send_and_recv(56, [handle]))[0]
+
+  async def file_gettag(self, handle):
+    return (await self._send_and_recv(57, [handle]))[0]
+
+  async def file_puttag(self, handle, newval):
+    await self._send_and_recv(58, [handle, newval])
+
+  async def file_getid(self, handle):
+    return (await self._send_and_recv(59, [handle]))[0]
+
+  async def file_putid(self, handle, newval):
+    await self._send_and_recv(60, [handle, newval])
+
+  async def file_release(self, handle):
+    await self._send_and_recv(61, [handle])
+
+  async def robot_getvariable(self, handle, name, option = ""):
+    return (await self._send_and_recv(62, [handle, name, option]))[0]
+
+  async def robot_getvariablenames(self, handle, option = ""):
+    return (await self._send_and_recv(63, [handle, option]))[0]
+
+  async def robot_execute(self, handle, command, param = None):
+    return (await self._send_and_recv(64, [handle, command, param]))[0]
+
+  async def robot_accelerate(self, handle, axis, accel, decel):
+    await self._send_and_recv(65, [handle, axis, c_float(accel), c_float(decel)])
+
+  async def robot_change(self, handle, name):
+    await self._send_and_recv(66, [handle, name])
+
+  async def robot_chuck(self, handle, option = ""):
+    await self._send_and_recv(67, [handle, option])
+
+  async def robot_drive(self, handle, axis, mov, option = ""):
+    await self._send_and_recv(68, [handle, axis, c_float(mov), option])
+
+  async def robot_gohome(self, handle):
+    await self._send_and_recv(69, [handle])
+
+  async def robot_halt(self, handle, option = ""):
+    await self._send_and_recv(70, [handle, option])
+
+  async def robot_hold(self, handle, option = ""):
+    await self._send_and_recv(71, [handle, option])
+
+  async def robot_move(self, handle, comp, pose, option = ""):
+    await self._send_and_recv(72, [handle, comp, pose, option])
+
+  async def robot_rotate(self, handle, rotsuf, deg, pivot, option = ""):
+    await self._send_and_recv(73, [handle, rotsuf, c_float(deg), pivot, option])
+
+  async def robot_speed(self, handle, axis, speed):
+    await self._send_and_recv(74, [handle, axis, c_float(speed)])
+
+  async def robot_unchuck(self, handle, option = ""):
+    await self._send_and_recv(75, [handle, option])
+
+  async def robot_unhold(self, handle, option = ""):
+    await self._send_and_recv(76, [handle, option])
+
+  async def robot_getattribute(self, handle):
+    return (await self._send_and_recv(77, [handle]))[0]
+
+  async def robot_gethelp(self, handle):
+    return (await self._send_and_recv(78, [handle]))[0]
+
+  async def robot_getname(self, handle):
+    return (await self._send_and_recv(79, [handle]))[0]
+
+  async def robot_gettag(self, handle):
+    return (await self._send_and_recv(80, [handle]))[0]
+
+  async def robot_puttag(self, handle, newval):
+    await self._send_and_recv(81, [handle, newval])
+
+  async def robot_getid(self, handle):
+    return (await self._send_and_recv(82, [handle]))[0]
+
+  async def robot_putid(self, handle, newval):
+    await self._send_and_recv(83, [handle, newval])
+
+  async def robot_release(self, handle):
+    await self._send_and_recv(84, [handle])
+
+  async def task_getvariable(self, handle, name, option = ""):
+    return (await self._send_and_recv(85, [handle, name, option]))[0]
+
+  async def task_getvariablenames(self, handle, option = ""):
+    return (await self._send_and_recv(86, [handle, option]))[0]
+
+  async def task_execute(self, handle, command, param = None):
+    return (await self._send_and_recv(87, [handle, command, param]))[0]
+
+  async def task_start(self, handle, mode, option = ""):
+    await self._send_and_recv(88, [handle, mode, option])
+
+  async def task_stop(self, handle, mode, option = ""):
+    await self._send_and_recv(89, [handle, mode, option])
+
+  async def task_delete(self, handle, option = ""):
+    await self._send_and_recv(90, [handle, option])
+
+  async def task_getfilename(self, handle):
+    return (await self._send_and_recv(91, [handle]))[0]
+
+  async def task_getattribute(self, handle):
+    return (await self._send_and_recv(92, [handle]))[0]
+
+  async def task_gethelp(self, handle):
+    return (await self._send_and_recv(93, [handle]))[0]
+
+  async def task_getname(self, handle):
+    return (await self._send_and_recv(94, [handle]))[0]
+
+  async def task_gettag(self, handle):
+    return (await self._send_and_recv(95, [handle]))[0]
+
+  async def task_puttag(self, handle, newval):
+    await self._send_and_recv(96, [handle, newval])
+
+  async def task_getid(self, handle):
+    return (await self._send_and_recv(97, [handle]))[0]
+
+  async def task_putid(self, handle, newval):
+    await self._send_and_recv(98, [handle, newval])
+
+  async def task_release(self, handle):
+    await self._send_and_recv(99, [handle])
+
+  async def variable_getdatetime(self, handle):
+    return (await self._send_and_recv(100, [handle]))[0]
+
+  async def variable_getvalue(self, handle):
+    return (await self._send_and_recv(101, [handle]))[0]
+
+  async def variable_putvalue(self, handle, newval):
+    await self._send_and_recv(102, [handle, newval])
+
+  async def variable_getattribute(self, handle):
+    return (await self._send_and_recv(103, [handle]))[0]
+
+  async def variable_gethelp(self, handle):
+    return (await self._send_and_recv(104, [handle]))[0]
+
+  async def variable_getname(self, handle):
+    return (await self._send_and_recv(105, [handle]))[0]
+
+  async def variable_gettag(self, handle):
+    return (await self._send_and_recv(106, [handle]))[0]
+
+  async def variable_puttag(self, handle, newval):
+    await self._send_and_recv(107, [handle, newval])
+
+  async def variable_getid(self, handle):
+    return (await self._send_and_recv(108, [handle]))[0]
+
+  async def variable_putid(self, handle, newval):
+    await self._send_and_recv(109, [handle, newval])
+
+  async def variable_getmicrosecond(self, handle):
+    return (await self._send_and_recv(110, [handle]))[0]
+
+  async def variable_release(self, handle):
+    await self._send_and_recv(111, [handle])
+
+  async def command_execute(self, handle, mode):
+    await self._send_and_recv(112, [handle, mode])
+
+  async def command_cancel(self, handle):
+    await self._send_and_recv(113, [handle])
+
+  async def command_gettimeout(self, handle):
+    return (await self._send_and_recv(114, [handle]))[0]
+
+  async def command_puttimeout(self, handle, newval):
+    await self._send_and_recv(115, [handle, newval])
+
+  async def command_getstate(self, handle):
+    return (await self._send_and_recv(116, [handle]))[0]
+
+  async def command_getparameters(self, handle):
+    return (await self._send_and_recv(117, [handle]))[0]
+
+  async def command_putparameters(self, handle, newval):
+    await self._send_and_recv(118, [handle, newval])
+
+  async def command_getresult(self, handle):
+    return (await self._send_and_recv(119, [handle]))[0]
+
+  async def command_getattribute(self, handle):
+    return (await self._send_and_recv(120, [handle]))[0]
+
+  async def command_gethelp(self, handle):
+    return (await self._send_and_recv(121, [handle]))[0]
+
+  async def command_getname(self, handle):
+    return (await self._send_and_recv(122, [handle]))[0]
+
+  async def command_gettag(self, handle):
+    return (await self._send_and_recv(123, [handle]))[0]
+
+  async def command_puttag(self, handle, newval):
+    await self._send_and_recv(124, [handle, newval])
+
+  async def command_getid(self, handle):
+    return (await self._send_and_recv(125, [handle]))[0]
+
+  async def command_putid(self, handle, newval):
+    await self._send_and_recv(126, [handle, newval])
+
+  async def command_release(self, handle):
+    await self._send_and_recv(127, [handle])
+
+  async def message_reply(self, handle, data):
+    await self._send_and_recv(128, [handle, data])
+
+  async def message_clear(self, handle):
+    await self._send_and_recv(129, [handle])
+
+  async def message_getdatetime(self, handle):
+    return (await self._send_and_recv(130, [handle]))[0]
+
+  async def message_getdescription(self, handle):
+    return (await self._send_and_recv(131, [handle]))[0]
+
+  async def message_getdestination(self, handle):
+    return (await self._send_and_recv(132, [handle]))[0]
+
+  async def message_getnumber(self, handle):
+    return (await self._send_and_recv(133, [handle]))[0]
+
+  async def message_getserialnumber(self, handle):
+    return (await self._send_and_recv(134, [handle]))[0]
+
+  async def message_getsource(self, handle):
+    return (await self._send_and_recv(135, [handle]))[0]
+
+  async def message_getvalue(self, handle):
+    return (await self._send_and_recv(136, [handle]))[0]
+
+  async def message_release(self, handle):
+    await self._send_and_recv(137, [handle])
+
+  async def _send_and_recv(self, funcid, args):
+    async with self._lock:
+      if self._writer is None:
+        raise ORiNException(HResult.E_NOT_CONNECTED)
+
+      serial = self._serial
+      try:
+        buf = bytes(self._codec._serialize(
+          serial, self._version, funcid, args))
+        self._writer.write(buf)
+        await self._writer.drain()
+
+        while True:
+          buf = await self._recv_frame()
+          (serial_recv, version, hresult, retvals) = self._codec._deserialize(buf)
+
+          if (serial_recv == serial) and (hresult != HResult.S_EXECUTING):
+            break
+      finally:
+        # タイムアウトやキャンセル (wait_for 等) で抜けても次の要求は別の番号にする.
+        # 遅れて届いた応答は番号が違うので次の要求の受信で読み捨てる
+        if self._serial >= 0xFFFF:
+          self._serial  = 1
+        else:
+          self._serial += 1
+
+      if HResult.failed(hresult):
+        raise ORiNException(hresult)
+
+    if len(retvals) == 0:
+      retvals.append(None)
+
+    return retvals
+
+  async def _recv_frame(self):
+    # ヘッダを読んだ後に止められても (キャンセル・タイムアウト), ヘッダを覚えておいて
+    # 次回はフレームの残りから読む (readexactly は揃うまで読み進めないので残りはそのまま)
+    try:
+      if self._head is None:
+        self._head = await asyncio.wait_for(self._reader.readexactly(5), self._timeout)
+      (len_frame, ) = struct.unpack_from("<I", self._head, 1)
+      if len_frame < 16:
+        # どこがフレームの先頭か分からなくなったので, この接続は使わない
+        await self.close()
+        raise ORiNException(HResult.E_INVALIDPACKET)
+      body = await asyncio.wait_for(
+        self._reader.readexactly(len_frame - 5), self._timeout)
+    except asyncio.TimeoutError:
+      raise ORiNException(HResult.E_TIMEOUT)
+    except asyncio.IncompleteReadError:
+      raise ORiNException(HResult.E_NOT_CONNECTED)
+
+    (head, self._head) = (self._head, None)
+    return head + body
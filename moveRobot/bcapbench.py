@@ -0,0 +1,513 @@
+# -*- coding:utf-8 -*-
+# b-CAP クライアントのベンチマーク (ローカルのスタンドインサーバを使用)
+#   python bcapbench.py [decode] [encode] [codec] [latency] [throughput] [transport]
+#   引数なしなら全部実行する.
+import multiprocessing
+import select
+import struct
+import sys
+import time
+from threading import Thread
+from bcapclient import BCAPClient
+from bcapserver import BCAPServer, SimulatedRobot
+from orinexception import *
+from variant import VarType
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+def _reply(codec, retval):
+  # 応答パケットは funcid の位置に HRESULT が入る以外は要求と同じ形式
+  return bytes(codec._serialize(1, 0, HResult.S_OK, [retval]))
+
+def _best_of(func, repeat, number):
+  best = None
+  for r in range(repeat):
+    t0 = time.perf_counter()
+    for n in range(number):
+      func()
+    elapsed = (time.perf_counter() - t0) / number
+    if (best is None) or (elapsed < best):
+      best = elapsed
+  return best
+
+# --- 比較用: 旧実装 (引数ごとに残りバッファを struct.unpack でコピー) ---
+def _legacy_deserialize(buf):
+  format = "<bIHhiH%dsb" % (len(buf) - 16)
+  (soh, len_buf, serial, version, hresult, len_args, buf_args, eot) \
+    = struct.unpack(format, buf)
+  (retvals, buf_args) = _legacy_deserialize_args(buf_args, len_args, True)
+  return (serial, version, hresult, retvals)
+
+def _legacy_deserialize_args(buf, len_args, first = False):
+  retvals = []
+  for i in range(len_args):
+    if first:
+      buf = buf[4:]
+    (retval, buf) = _legacy_deserialize_arg(buf)
+    retvals.append(retval)
+  return (retvals, buf)
+
+def _legacy_deserialize_arg(buf):
+  retval = None
+  format = "<HI%ds" % (len(buf) - 6)
+  (vt, len_arg, buf) = struct.unpack(format, buf)
+
+  if (vt & VarType.VT_ARRAY) != 0:
+    vt = vt ^ VarType.VT_ARRAY
+    if vt == VarType.VT_VARIANT:
+      (retval, buf) = _legacy_deserialize_args(buf, len_arg)
+    elif vt == VarType.VT_UI1:
+      format = "<%ds%ds" % (len_arg, len(buf) - len_arg)
+      (retval, buf) = struct.unpack(format, buf)
+    elif vt == VarType.VT_BSTR:
+      retval = []
+      for i in range(len_arg):
+        format = "<I%ds" % (len(buf) - 4)
+        (len_str, buf) = struct.unpack(format, buf)
+        format = "<%ds%ds" % (len_str, len(buf) - len_str)
+        (ret_tmp, buf) = struct.unpack(format, buf)
+        retval.append(ret_tmp.decode("utf-16le"))
+    else:
+      (fmt, len_val) = BCAPClient._DICT_VT2TYPE[vt]
+      format = "<%s%ds" % (fmt * len_arg, len(buf) - (len_val * len_arg))
+      unpacked_arg = struct.unpack(format, buf)
+      retval = list(unpacked_arg[:-1])
+      buf    = unpacked_arg[-1]
+      if vt == VarType.VT_DATE:
+        retval = [BCAPClient.vntdate2datetime(o) for o in retval]
+      elif vt == VarType.VT_BOOL:
+        retval = [(o != 0) for o in retval]
+  else:
+    if vt in [ VarType.VT_EMPTY, VarType.VT_NULL ]:
+      pass
+    elif vt == VarType.VT_BSTR:
+      format = "<I%ds" % (len(buf) - 4)
+      (len_str, buf) = struct.unpack(format, buf)
+      format = "<%ds%ds" % (len_str, len(buf) - len_str)
+      (retval , buf) = struct.unpack(format, buf)
+      retval = retval.decode("utf-16le")
+    else:
+      (fmt, len_val) = BCAPClient._DICT_VT2TYPE[vt]
+      format = "<%s%ds" % (fmt, (len(buf) - len_val))
+      (retval, buf) = struct.unpack(format, buf)
+      if vt == VarType.VT_DATE:
+        retval = BCAPClient.vntdate2datetime(retval)
+      elif vt == VarType.VT_BOOL:
+        retval = (retval != 0)
+  return (retval, buf)
+
+# --- 比較用: 旧実装のエンコード (引数ごとに書式文字列を組み立てて struct.pack, 長さは後から置換) ---
+def _legacy_serialize(serial, version, funcid, args):
+  format = "<bIHhiH"
+  packet_data = [BCAPClient._BCAP_SOH, 0, serial, version, funcid, len(args)]
+  packed_args = _legacy_serialize_args(args, True)
+  format += "%ds" % len(packed_args)
+  packet_data.append(packed_args)
+  format += "b"
+  packet_data.append(BCAPClient._BCAP_EOT)
+  buf = struct.pack(format, *packet_data)
+  buf = buf.replace(b'\0\0\0\0', struct.pack("<I", len(buf)), 1)
+  return buf
+
+def _legacy_serialize_args(args, first = False):
+  format = "<"
+  packet_data = []
+  offset = 0
+  for arg in args:
+    if first:
+      format += "I"
+      packet_data.append(0)
+    packed_arg = _legacy_serialize_arg(arg)
+    len_arg = len(packed_arg)
+    format += "%ds" % len_arg
+    packet_data.append(packed_arg)
+    if first:
+      packet_data[2*offset] = len_arg
+    offset += 1
+  if len(packet_data) > 0:
+    return struct.pack(format, *packet_data)
+  else:
+    return b''
+
+def _legacy_serialize_arg(arg):
+  format = "<HI"
+  packet_data = []
+
+  if arg is None:
+    packet_data = [VarType.VT_EMPTY, 1]
+
+  elif isinstance(arg, (list, tuple)):
+    len_arg = len(arg)
+    if len_arg <= 0:
+      packet_data = [VarType.VT_EMPTY, 1]
+    else:
+      is_vntary = False
+      type_o0 = type(arg[0])
+      for o in arg:
+        if type_o0 != type(o):
+          is_vntary = True
+          break
+
+      if is_vntary:
+        packed_args = _legacy_serialize_args(arg)
+        format += "%ds" % len(packed_args)
+        packet_data += [VarType.VT_VARIANT | VarType.VT_ARRAY, len_arg, packed_args]
+      elif type_o0 in BCAPClient._DICT_TYPE2VT:
+        (vt, fmt, is_ctype) = BCAPClient._DICT_TYPE2VT[type_o0]
+        if vt == VarType.VT_DATE:
+          format += fmt * len_arg
+          packet_data += [vt | VarType.VT_ARRAY, len_arg]
+          for o in arg:
+            packet_data.append(BCAPClient.datetime2vntdate(o))
+        elif vt == VarType.VT_BSTR:
+          packet_data += [vt | VarType.VT_ARRAY, len_arg]
+          for o in arg:
+            str_tmp = (o.value if is_ctype else o).encode("utf-16le")
+            format += fmt % len(str_tmp)
+            packet_data += [len(str_tmp), str_tmp]
+        elif vt == VarType.VT_BOOL:
+          format += fmt * len_arg
+          packet_data += [vt | VarType.VT_ARRAY, len_arg]
+          packet_data += [-1 if o else 0 for o in arg]
+        else:
+          format += fmt * len_arg
+          packet_data += [vt | VarType.VT_ARRAY, len_arg]
+          packet_data += [o.value for o in arg] if is_ctype else list(arg)
+      else:
+        raise ORiNException(HResult.E_CAO_VARIANT_TYPE_NOSUPPORT)
+
+  elif isinstance(arg, (bytes, bytearray)):
+    format += "%ds" % len(arg)
+    packet_data += [VarType.VT_ARRAY | VarType.VT_UI1, len(arg), arg]
+
+  elif type(arg) in BCAPClient._DICT_TYPE2VT:
+    (vt, fmt, is_ctype) = BCAPClient._DICT_TYPE2VT[type(arg)]
+    if vt == VarType.VT_DATE:
+      format += fmt
+      packet_data += [vt, 1, BCAPClient.datetime2vntdate(arg)]
+    elif vt == VarType.VT_BSTR:
+      str_tmp = (arg.value if is_ctype else arg).encode("utf-16le")
+      format += fmt % len(str_tmp)
+      packet_data += [vt, 1, len(str_tmp), str_tmp]
+    elif vt == VarType.VT_BOOL:
+      format += fmt
+      packet_data += [vt, 1, -1 if arg else 0]
+    else:
+      format += fmt
+      packet_data += [vt, 1, arg.value if is_ctype else arg]
+
+  else:
+    raise ORiNException(HResult.E_CAO_VARIANT_TYPE_NOSUPPORT)
+
+  return struct.pack(format, *packet_data)
+
+# --- ペイロード ---
+def _payload_bstr(n):
+  # controller_getvariablenames 相当
+  return ["I%d" % i for i in range(n)]
+
+def _payload_variant(n):
+  # [ポーズ, 型, ...] が並ぶ VT_VARIANT 配列
+  retval = []
+  for i in range(n):
+    retval += [[0.1 * i, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0], "P", i]
+  return retval
+
+def _payload_r8(n):
+  return [0.5 * i for i in range(n)]
+
+PAYLOADS = [
+  ("VT_BSTR array"   , _payload_bstr),
+  ("VT_VARIANT array", _payload_variant),
+  ("VT_R8 array"     , _payload_r8),
+]
+
+def bench_decode(sizes = (10, 100, 1000, 5000), repeat = 5):
+  codec = BCAPClient.codec()
+  results = []
+  for (name, make) in PAYLOADS:
+    for n in sizes:
+      buf = _reply(codec, make(n))
+      if codec._deserialize(buf) != _legacy_deserialize(buf):
+        raise AssertionError("decoder mismatch: %s (%d)" % (name, n))
+
+      number = max(1, 2000 // n)
+      t_old = _best_of(lambda: _legacy_deserialize(buf), repeat, number)
+      t_new = _best_of(lambda: codec._deserialize(buf), repeat, number)
+      results.append((name, n, len(buf), t_old, t_new))
+  return results
+
+def print_decode(results):
+  print("%-18s %6s %9s %12s %12s %8s" \
+    % ("payload", "N", "bytes", "legacy[us]", "offset[us]", "speedup"))
+  for (name, n, size, t_old, t_new) in results:
+    print("%-18s %6d %9d %12.1f %12.1f %7.1fx" \
+      % (name, n, size, t_old * 1e6, t_new * 1e6, t_old / t_new))
+
+# --- エンコード: run_measurement_mode で毎ステップ送るコマンド ---
+_POSE = [350.0, 0.0, 400.0, 180.0, 0.0, 180.0]
+
+COMMANDS = [
+  ("robot_execute CurPos", 64, [1, "CurPos", None]),
+  ("robot_execute DevH"  , 64, [1, "DevH", [_POSE, "P(0, 5, 0, 0, 0, 0)"]]),
+  ("robot_move"          , 72, [1, 2, [_POSE, "P", "@P"],
+                                "SPEED=10, ACCEL=100, DECEL=100, NEXT"]),
+]
+
+def bench_encode(repeat = 5, number = 20000):
+  codec = BCAPClient.codec()
+  results = []
+  for (name, funcid, args) in COMMANDS:
+    buf = bytes(codec._serialize(1, 0, funcid, args))
+    if buf != _legacy_serialize(1, 0, funcid, args):
+      raise AssertionError("encoder mismatch: %s" % name)
+
+    t_old = _best_of(lambda: _legacy_serialize(1, 0, funcid, args), repeat, number)
+    t_new = _best_of(lambda: codec._serialize(1, 0, funcid, args), repeat, number)
+    results.append((name, len(buf), t_old, t_new))
+  return results
+
+def print_encode(results):
+  print("%-22s %7s %12s %12s %8s" % ("command", "bytes", "legacy[us]", "struct[us]", "speedup"))
+  for (name, size, t_old, t_new) in results:
+    print("%-22s %7d %12.2f %12.2f %7.1fx" % (name, size, t_old * 1e6, t_new * 1e6, t_old / t_new))
+
+# --- 往復レイテンシ: ローカルのスタンドインサーバに対して計測 ---
+class _LegacyRecvClient(BCAPClient):
+  # 比較用: 旧実装の受信処理 (recv ごとに select, b''.join で連結)
+  def _recv_wait(self, call):
+    pass
+
+  def _recv_stream(self, deadline):
+    buf_all = b''
+    buf_tmp = self._recv_with_select(1)
+    buf_all = b''.join([buf_all, buf_tmp])
+    buf_tmp  = self._recv_with_select(4)
+    len_recv = struct.unpack("<I", buf_tmp)
+    buf_all  = b''.join([buf_all, buf_tmp])
+    buf_tmp = self._recv_with_select(len_recv[0] - 5)
+    buf_all = b''.join([buf_all, buf_tmp])
+    return buf_all
+
+  def _recv_with_select(self, len_recv):
+    buf_recv = b''
+    while True:
+      (reads, writes, errors) = select.select(
+        [self._sock], [], [], self._timeout)
+      if len(reads) == 0:
+        raise ORiNException(HResult.E_TIMEOUT)
+      buf_recv = b''.join([buf_recv, self._sock.recv(len_recv)])
+      if len(buf_recv) >= len_recv:
+        break
+    return buf_recv
+
+def percentile(samples, p):
+  s = sorted(samples)
+  return s[min(len(s) - 1, int(len(s) * p / 100.0))]
+
+# --- エンコード/デコードのスループット ---
+CODEC_PAYLOADS = [
+  ("scalar int"         , 12345),
+  ("scalar float"       , 1.25),
+  ("scalar str"         , "SPEED=10, ACCEL=100, DECEL=100, NEXT"),
+  ("array float x1000"  , _payload_r8(1000)),
+  ("array str x1000"    , _payload_bstr(1000)),
+  ("array bytes 64KiB"  , bytes(65536)),
+  ("variant pose"       , [_POSE, "P", "@P"]),
+  ("variant x1000"      , _payload_variant(333)),
+]
+
+if np is not None:
+  CODEC_PAYLOADS += [
+    ("ndarray f8 x1000"   , np.arange(1000, dtype=np.float64)),
+    ("ndarray i4 x1000"   , np.arange(1000, dtype=np.int32)),
+  ]
+
+def bench_codec(repeat = 5, seconds = 0.05):
+  codec = BCAPClient.codec()
+  results = []
+  for (name, payload) in CODEC_PAYLOADS:
+    codec._ndarray = name.startswith("ndarray")
+    buf = _reply(codec, payload)
+    t_enc = _best_of(lambda: codec._serialize(1, 0, HResult.S_OK, [payload]),
+                     repeat, max(1, int(seconds / max(_once(codec, payload), 1e-7))))
+    number = max(1, int(seconds / max(_once_decode(codec, buf), 1e-7)))
+    t_dec = _best_of(lambda: codec._deserialize(buf), repeat, number)
+    results.append((name, len(buf), t_enc, t_dec))
+  return results
+
+def _once(codec, payload):
+  t0 = time.perf_counter()
+  codec._serialize(1, 0, HResult.S_OK, [payload])
+  return time.perf_counter() - t0
+
+def _once_decode(codec, buf):
+  t0 = time.perf_counter()
+  codec._deserialize(buf)
+  return time.perf_counter() - t0
+
+def print_codec(results):
+  print("%-20s %8s %11s %10s %11s %10s" % ("payload", "bytes",
+    "enc[op/s]", "enc[MB/s]", "dec[op/s]", "dec[MB/s]"))
+  for (name, size, t_enc, t_dec) in results:
+    print("%-20s %8d %11.0f %10.1f %11.0f %10.1f" % (name, size,
+      1 / t_enc, size / t_enc / 1e6, 1 / t_dec, size / t_dec / 1e6))
+
+# --- 往復レイテンシ ---
+def _measure(client, call, handles, number):
+  samples = []
+  for n in range(number):
+    t0 = time.perf_counter()
+    call(client, handles)
+    samples.append(time.perf_counter() - t0)
+  return samples
+
+def _connect(client):
+  client.service_start("")
+  hctrl  = client.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+  hrobot = client.controller_getrobot(hctrl, "Arm", "")
+  return (hctrl, hrobot)
+
+LATENCY_CALLS = [
+  ("robot_execute CurPos"  , lambda c, h: c.robot_execute(h[1], "CurPos")),
+  ("robot_execute DevH"    , lambda c, h: c.robot_execute(h[1], "DevH",
+                               [_POSE, "P(0, 5, 0, 0, 0, 0)"])),
+  ("getvariablenames x1000", lambda c, h: c.controller_getvariablenames(h[0])),
+]
+
+def _bench_server(queue, stop, keepalive):
+  # GIL の影響を避けるため別プロセスで動かす
+  with BCAPServer(keepalive=keepalive, udp=True) as server:
+    SimulatedRobot(server, variables={"I%d" % i: i for i in range(1000)})
+    queue.put((server.host, server.port))
+    stop.wait()
+
+class _ServerProcess:
+  def __init__(self, keepalive = None):
+    self._queue = multiprocessing.Queue()
+    self._stop  = multiprocessing.Event()
+    self._proc  = multiprocessing.Process(target=_bench_server,
+      args=(self._queue, self._stop, keepalive))
+
+  def __enter__(self):
+    self._proc.start()
+    return self._queue.get(timeout=10)
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._stop.set()
+    self._proc.join()
+
+def bench_latency(number = 2000, chunk = 100, timeout = 2):
+  with _ServerProcess() as (host, port):
+    clients = []
+    for (label, cls) in [("legacy", _LegacyRecvClient), ("recv_into", BCAPClient)]:
+      client = cls(host, port, timeout)
+      clients.append((label, client, _connect(client)))
+
+    results = _compare(clients, LATENCY_CALLS, number, chunk)
+    del clients
+  return results
+
+def _compare(clients, calls, number, chunk):
+  results = []
+  for (name, call) in calls:
+    samples = {}
+    for (label, client, handles) in clients:
+      _measure(client, call, handles, chunk)
+      samples[label] = []
+    # 交互に計測して条件を揃える
+    for n in range(number // chunk):
+      for (label, client, handles) in clients:
+        samples[label] += _measure(client, call, handles, chunk)
+    for (label, client, handles) in clients:
+      results.append((name, label, samples[label]))
+  return results
+
+def print_latency(results):
+  print("%-24s %-10s %9s %9s %9s %9s" % ("call", "recv",
+    "p50[us]", "p90[us]", "p99[us]", "cmd/s"))
+  for (name, label, samples) in results:
+    print("%-24s %-10s %9.1f %9.1f %9.1f %9.0f" % (name, label,
+      percentile(samples, 50) * 1e6, percentile(samples, 90) * 1e6,
+      percentile(samples, 99) * 1e6, len(samples) / sum(samples)))
+
+# --- 並列接続時のスループット ---
+def bench_throughput(connections = (1, 2, 4), seconds = 1.0, timeout = 2):
+  results = []
+  with _ServerProcess() as (host, port):
+    for n in connections:
+      counts = [0] * n
+      samples = [[] for i in range(n)]
+      t_end = time.perf_counter() + seconds
+
+      def worker(i):
+        client = BCAPClient(host, port, timeout)
+        handles = _connect(client)
+        while time.perf_counter() < t_end:
+          t0 = time.perf_counter()
+          client.robot_execute(handles[1], "CurPos")
+          samples[i].append(time.perf_counter() - t0)
+          counts[i] += 1
+
+      threads = [Thread(target=worker, args=(i, )) for i in range(n)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      merged = sum(samples, [])
+      results.append((n, sum(counts) / seconds, percentile(merged, 50),
+                      percentile(merged, 99)))
+  return results
+
+def print_throughput(results):
+  print("%-12s %10s %9s %9s" % ("connections", "cmd/s", "p50[us]", "p99[us]"))
+  for (n, rate, p50, p99) in results:
+    print("%-12d %10.0f %9.1f %9.1f" % (n, rate, p50 * 1e6, p99 * 1e6))
+
+# --- TCP と UDP の往復時間 ---
+TRANSPORT_CALLS = [
+  ("robot_execute CurPos"  , lambda c, h: c.robot_execute(h[1], "CurPos")),
+  ("robot_getname"         , lambda c, h: c.robot_getname(h[1])),
+  ("variable_getvalue"     , lambda c, h: c.variable_getvalue(h[2])),
+  ("getvariablenames x1000", lambda c, h: c.controller_getvariablenames(h[0])),
+]
+
+def bench_transport(number = 2000, chunk = 100, timeout = 2):
+  with _ServerProcess() as (host, port):
+    clients = []
+    for transport in ("tcp", "udp"):
+      client = BCAPClient(host, port, timeout, transport=transport)
+      handles = _connect(client)
+      handles += (client.controller_getvariable(handles[0], "I1"), )
+      clients.append((transport, client, handles))
+
+    results = _compare(clients, TRANSPORT_CALLS, number, chunk)
+    retransmits = clients[1][1].transport_stats()["retransmits"]
+    del clients
+  return (results, retransmits)
+
+def print_transport(results):
+  (results, retransmits) = results
+  print_latency(results)
+  print("udp retransmits: %d" % retransmits)
+
+SUITES = [
+  ("decode"    , bench_decode    , print_decode),
+  ("encode"    , bench_encode    , print_encode),
+  ("codec"     , bench_codec     , print_codec),
+  ("latency"   , bench_latency   , print_latency),
+  ("throughput", bench_throughput, print_throughput),
+  ("transport" , bench_transport , print_transport),
+]
+
+if __name__ == '__main__':
+  selected = sys.argv[1:]
+  for (name, bench, report) in SUITES:
+    if selected and name not in selected:
+      continue
+    print("== %s ==" % name)
+    report(bench())
+    print()
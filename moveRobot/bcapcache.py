@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+# 変化しない (しにくい) メタデータの呼び出し結果を TTL 付きで覚えておく
+#   client.setcache(MetadataCache()) で有効にする. キャッシュしてよい関数は SAFE に
+#   列挙したものだけで, それ以外 (変数の読み書き, 動作指令等) は常にコントローラに問い合わせる.
+#   robot_execute / controller_execute はコマンド名ごとに SAFE_COMMANDS で指定する.
+#   *_put* や *_release を呼んだハンドルの分, controller_disconnect / service_stop では全て捨てる.
+import copy
+import fnmatch
+import time
+from threading import Lock
+import numpy as np
+from bcapclient import FUNC_IDS, FUNC_NAMES
+
+def _funcids(*patterns):
+  return [funcid for (funcid, name) in FUNC_NAMES.items()
+          if any(fnmatch.fnmatch(name, p) for p in patterns)]
+
+def _freeze(value):
+  # 引数をキーにできる形にする (setndarray(True) なら ndarray も来る)
+  if isinstance(value, (list, tuple)):
+    return tuple(_freeze(v) for v in value)
+  if isinstance(value, np.ndarray):
+    return ("nd", value.dtype.str, value.shape, value.tobytes())
+  return value
+
+class MetadataCache:
+  FOREVER = None
+
+  # funcid -> 既定の TTL [s] (None は無期限)
+  SAFE = dict(
+    [(funcid, None) for funcid in _funcids("*_getname", "*_gethelp", "*_getattribute",
+                                           "task_getfilename")] +
+    [(funcid, 60.0) for funcid in _funcids("*_getid", "*_gettag")] +
+    [(funcid, 10.0) for funcid in _funcids("*_get*names")])
+
+  # (funcid, コマンド名) -> 既定の TTL [s]
+  SAFE_COMMANDS = {
+    (FUNC_IDS["robot_execute"], "MPS"): None,
+  }
+
+  _CLEAR_ALL  = set(_funcids("controller_disconnect", "service_stop"))
+  _INVALIDATE = set(_funcids("*_put*", "*_release"))
+
+  def __init__(self, policies = None, clock = time.monotonic):
+    # policies: {関数名 / funcid / (関数名, コマンド名): TTL [s]} で既定の TTL を上書きする.
+    #   TTL 0 ならキャッシュしない. SAFE / SAFE_COMMANDS にないものは指定できない.
+    self._ttl = dict(self.SAFE)
+    self._ttl.update(self.SAFE_COMMANDS)
+    for (key, ttl) in (policies or {}).items():
+      key = self._key(key)
+      if key not in self._ttl:
+        raise ValueError("not safe to cache: %r" % (key, ))
+      self._ttl[key] = ttl
+    self._clock   = clock
+    self._lock    = Lock()
+    self._entries = {}
+    self._hits    = {}
+    self.misses        = 0
+    self.expired       = 0
+    self.invalidations = 0
+
+  def _key(self, key):
+    if isinstance(key, str):
+      return FUNC_IDS[key]
+    if isinstance(key, tuple) and isinstance(key[0], str):
+      return (FUNC_IDS[key[0]], key[1])
+    return key
+
+  def _policy(self, funcid, args):
+    if funcid in self._ttl:
+      return (True, self._ttl[funcid])
+    if (len(args) > 1) and isinstance(args[1], str) and ((funcid, args[1]) in self._ttl):
+      return (True, self._ttl[(funcid, args[1])])
+    return (False, 0)
+
+  def observe(self, funcid, args):
+    # キャッシュを通さない呼び出し (応答を待たない *_nowait 等) でも, 無効化だけは行う
+    if funcid in self._CLEAR_ALL:
+      self.invalidate()
+    elif (funcid in self._INVALIDATE) and args:
+      self.invalidate(handle=args[0])
+
+  def call(self, send_and_recv, funcid, args):
+    (safe, ttl) = self._policy(funcid, args)
+    if (not safe) or (ttl == 0):
+      self.observe(funcid, args)
+      return send_and_recv(funcid, args)
+
+    key = (funcid, _freeze(args))
+    try:
+      hash(key)
+    except TypeError:
+      # キーにできない引数 (dict 等) の呼び出しはキャッシュしない
+      return send_and_recv(funcid, args)
+    now = self._clock()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        if (entry[0] is None) or (now < entry[0]):
+          self._hits[funcid] = self._hits.get(funcid, 0) + 1
+          return copy.deepcopy(entry[1])
+        del self._entries[key]
+        self.expired += 1
+      self.misses += 1
+
+    retvals = send_and_recv(funcid, args)
+    with self._lock:
+      self._entries[key] = (None if ttl is None else now + ttl, copy.deepcopy(retvals))
+    return retvals
+
+  def invalidate(self, func = None, handle = None):
+    # func: 関数名 / funcid (None なら全関数), handle: このハンドルへの呼び出しだけ捨てる
+    funcid = self._key(func) if func is not None else None
+    with self._lock:
+      keys = [key for key in self._entries
+              if ((funcid is None) or (key[0] == funcid))
+              and ((handle is None) or (key[1] and key[1][0] == handle))]
+      for key in keys:
+        del self._entries[key]
+      self.invalidations += len(keys)
+
+  def stats(self):
+    with self._lock:
+      hits = sum(self._hits.values())
+      return {
+        "size"         : len(self._entries),
+        "hits"         : hits,
+        "misses"       : self.misses,
+        "hit_ratio"    : hits / (hits + self.misses) if hits + self.misses else 0.0,
+        "expired"      : self.expired,
+        "invalidations": self.invalidations,
+        "by_function"  : {FUNC_NAMES.get(funcid, str(funcid)): n
+                          for (funcid, n) in sorted(self._hits.items())},
+      }
@@ -0,0 +1,226 @@
+# -*- coding:utf-8 -*-
+# 複数コントローラ (複数アーム) を 1 プロセスで動かす
+#   Arm  : 1 コントローラへの接続 (service_start 〜 controller_getrobot まで済ませたもの)
+#   Cell : 複数の Arm の手順 (script) をスレッドプールで並行に動かし,
+#          barrier() で足並みを揃える. move_together() は各アームの robot_move を同時に出す.
+#   アームごとの呼び出し時間は bcapstats.CallStats に記録する.
+#   python bcapcell.py でローカルのスタンドインサーバ 2 台を相手に動作確認する.
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, BrokenBarrierError
+from bcapclient import BCAPClient
+from bcapstats import CallStats
+from orinexception import *
+
+class Arm:
+  def __init__(self, name, host, port, timeout, provider, machine = "localhost",
+               robot = "Arm", transport = "tcp"):
+    self.name      = name
+    self.host      = host
+    self.port      = port
+    self.timeout   = timeout
+    self.provider  = provider
+    self.machine   = machine
+    self.robot     = robot
+    self.transport = transport
+    self.stats     = CallStats()
+    self.client    = None
+    self.hctrl     = None
+    self.hrobot    = None
+
+  def connect(self):
+    self.client = BCAPClient(self.host, self.port, self.timeout, transport=self.transport)
+    self.client.settrace(self.stats)
+    self.client.service_start("")
+    self.hctrl  = self.client.controller_connect("", self.provider, self.machine, "")
+    self.hrobot = self.client.controller_getrobot(self.hctrl, self.robot, "")
+
+  def close(self):
+    if self.client is None:
+      return
+    try:
+      # connect() が途中で失敗していれば取れた分だけ解放する
+      if self.hrobot is not None:
+        self.client.robot_release(self.hrobot)
+      if self.hctrl is not None:
+        self.client.controller_disconnect(self.hctrl)
+      self.client.service_stop()
+    finally:
+      self.client.close()
+      self.client = None
+      self.hctrl  = None
+      self.hrobot = None
+
+  def execute(self, command, param = None):
+    return self.client.robot_execute(self.hrobot, command, param)
+
+  def move(self, comp, pose, option = ""):
+    self.client.robot_move(self.hrobot, comp, pose, option)
+
+  def move_nowait(self, comp, pose, option = ""):
+    return self.client.robot_move_nowait(self.hrobot, comp, pose, option)
+
+class Cell:
+  def __init__(self, arms, barrier_timeout = None):
+    self.arms = {arm.name: arm for arm in arms}
+    self._barrier  = Barrier(len(arms), timeout=barrier_timeout)
+    self._executor = ThreadPoolExecutor(max_workers=len(arms))
+    self.skews = []
+
+  def __enter__(self):
+    self.connect()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __getitem__(self, name):
+    return self.arms[name]
+
+  def connect(self):
+    # どれかが接続できなければ, 接続できた分とスレッドプールを片付けて送出する
+    try:
+      self._all(lambda arm: arm.connect())
+    except BaseException as e:
+      try:
+        self.close()
+      except Exception:
+        pass  # 接続の失敗の方を送出する
+      raise e
+
+  def close(self):
+    try:
+      self._all(lambda arm: arm.close())
+    finally:
+      self._executor.shutdown()
+
+  def barrier(self):
+    # 全アームの script がここに来るまで待つ. どれかが失敗していれば BrokenBarrierError
+    return self._barrier.wait()
+
+  def run(self, scripts):
+    # scripts: {アーム名: script(arm, cell)}. 全アーム分そろえること (barrier の人数になる).
+    # 戻り値: {アーム名: script の戻り値}. どれかが例外を出したら他の barrier 待ちを解いて再送出する
+    if set(scripts) != set(self.arms):
+      raise ValueError("scripts must be given for every arm: %s" % sorted(self.arms))
+    self._barrier.reset()
+    futures = {name: self._executor.submit(self._script_task, script, self.arms[name])
+               for (name, script) in scripts.items()}
+    results = {}
+    error = None
+    for (name, future) in futures.items():
+      try:
+        results[name] = future.result()
+      except BrokenBarrierError as e:
+        error = error or e
+      except Exception as e:
+        error = e
+    if error is not None:
+      raise error
+    return results
+
+  def move_together(self, moves, wait = True):
+    # moves: {アーム名: (comp, pose, option)}. 全アームの robot_move をなるべく同時に出す.
+    # 戻り値: 各アームの送信時刻の差 [s] (wait=False なら Future の辞書も返す)
+    # run() の script の中からは呼ばないこと (スレッドプールを使い切っている)
+    names = list(moves)
+    barrier = Barrier(len(names))
+
+    def issue(name):
+      (comp, pose, option) = moves[name]
+      barrier.wait()
+      t = time.perf_counter()
+      return (t, self.arms[name].move_nowait(comp, pose, option))
+
+    issued = dict(zip(names, self._executor.map(issue, names)))
+    times = [t for (t, future) in issued.values()]
+    skew = max(times) - min(times)
+    self.skews.append(skew)
+
+    futures = {name: future for (name, (t, future)) in issued.items()}
+    if not wait:
+      return (skew, futures)
+    for future in futures.values():
+      future.result()
+    return skew
+
+  def stats(self):
+    # {アーム名: {関数名: {"count", "mean", "p99", "max"} [s]}} と送信時刻の差
+    result = {}
+    for (name, arm) in self.arms.items():
+      result[name] = {}
+      for summary in arm.stats.summary().values():
+        total = summary["phases_ns"]["total"]
+        result[name][summary["name"]] = {
+          "count": summary["count"],
+          "mean" : total["mean"] / 1e9,
+          "p99"  : total["p99"] / 1e9,
+          "max"  : total["max"] / 1e9,
+        }
+    skews = self.skews
+    return {
+      "arms": result,
+      "skew": {"count": len(skews),
+               "mean" : sum(skews) / len(skews) if skews else 0.0,
+               "max"  : max(skews) if skews else 0.0},
+    }
+
+  def _all(self, func):
+    # 全アームで func を実行する. 失敗があっても全部終わるのを待ってから最初の例外を送出する
+    futures = [self._executor.submit(func, arm) for arm in self.arms.values()]
+    error = None
+    for future in futures:
+      try:
+        future.result()
+      except Exception as e:
+        error = error or e
+    if error is not None:
+      raise error
+
+  def _script_task(self, script, arm):
+    try:
+      return script(arm, self)
+    except BaseException as e:
+      self._barrier.abort()
+      raise e
+
+if __name__ == '__main__':
+  from bcapserver import BCAPServer, SimulatedRobot
+
+  servers = [BCAPServer(keepalive=0.05) for i in range(2)]
+  robots  = [SimulatedRobot(server, delays={"robot_move": 0.2 + 0.1 * i, "CurPos": 0.002})
+             for (i, server) in enumerate(servers)]
+  for server in servers:
+    server.start()
+
+  arms = [Arm("arm%d" % (i + 1), server.host, server.port, 2, "CaoProv.DENSO.VRC9")
+          for (i, server) in enumerate(servers)]
+
+  def script(arm, cell):
+    arm.execute("TakeArm", [0, 0])
+    arm.execute("Motor", [1, 0])
+    base = arm.execute("CurPos")
+    for i in range(3):
+      cell.barrier()
+      arm.move(2, [[base[0], base[1] + 5 * (i + 1)] + base[2:], "P", "@P"], "SPEED=10")
+    cell.barrier()
+    arm.execute("Motor", [0, 0])
+    return arm.execute("CurPos")
+
+  with Cell(arms, barrier_timeout=10) as cell:
+    t0 = time.perf_counter()
+    print(cell.run({arm.name: script for arm in arms}))
+    print("run: %.3f s" % (time.perf_counter() - t0))
+
+    for arm in arms:
+      arm.execute("Motor", [1, 0])
+    skew = cell.move_together({arm.name: (2, [[300.0, 0.0, 350.0, 180.0, 0.0, 180.0, -1.0], "P", "@P"], "")
+                               for arm in arms})
+    print("move_together skew: %.1f us" % (skew * 1e6))
+
+    for (name, calls) in cell.stats()["arms"].items():
+      for (func, s) in calls.items():
+        print("%-6s %-24s %5d %10.1f us" % (name, func, s["count"], s["mean"] * 1e6))
+
+  for server in servers:
+    server.stop()
@@ -10,12 +10,205 @@ sys.path.append('./pybcapclient')
 import select
 import socket
 import struct
+import time
+from concurrent.futures import Future
 from ctypes import *
 from datetime import datetime
 from orinexception import *
-from threading import Lock
+from threading import Condition, Lock, Thread
 from variant import VarType
 
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# b-CAP の関数 ID <-> BCAPClient のメソッド名 (統計・記録・キャッシュの表示と指定に使う)
+FUNC_NAMES = {
+  1  : "service_start",
+  2  : "service_stop",
+
+  3  : "controller_connect",
+  4  : "controller_disconnect",
+  5  : "controller_getextension",
+  6  : "controller_getfile",
+  7  : "controller_getrobot",
+  8  : "controller_gettask",
+  9  : "controller_getvariable",
+  10 : "controller_getcommand",
+  11 : "controller_getextensionnames",
+  12 : "controller_getfilenames",
+  13 : "controller_getrobotnames",
+  14 : "controller_gettasknames",
+  15 : "controller_getvariablenames",
+  16 : "controller_getcommandnames",
+  17 : "controller_execute",
+  18 : "controller_getmessage",
+  19 : "controller_getattribute",
+  20 : "controller_gethelp",
+  21 : "controller_getname",
+  22 : "controller_gettag",
+  23 : "controller_puttag",
+  24 : "controller_getid",
+  25 : "controller_putid",
+
+  26 : "extension_getvariable",
+  27 : "extension_getvariablenames",
+  28 : "extension_execute",
+  29 : "extension_getattribute",
+  30 : "extension_gethelp",
+  31 : "extension_getname",
+  32 : "extension_gettag",
+  33 : "extension_puttag",
+  34 : "extension_getid",
+  35 : "extension_putid",
+  36 : "extension_release",
+
+  37 : "file_getfile",
+  38 : "file_getvariable",
+  39 : "file_getfilenames",
+  40 : "file_getvariablenames",
+  41 : "file_execute",
+  42 : "file_copy",
+  43 : "file_delete",
+  44 : "file_move",
+  45 : "file_run",
+  46 : "file_getdatecreated",
+  47 : "file_getdatelastaccessed",
+  48 : "file_getdatelastmodified",
+  49 : "file_getpath",
+  50 : "file_getsize",
+  51 : "file_gettype",
+  52 : "file_getvalue",
+  53 : "file_putvalue",
+  54 : "file_getattribute",
+  55 : "file_gethelp",
+  56 : "file_getname",
+  57 : "file_gettag",
+  58 : "file_puttag",
+  59 : "file_getid",
+  60 : "file_putid",
+  61 : "file_release",
+
+  62 : "robot_getvariable",
+  63 : "robot_getvariablenames",
+  64 : "robot_execute",
+  65 : "robot_accelerate",
+  66 : "robot_change",
+  67 : "robot_chuck",
+  68 : "robot_drive",
+  69 : "robot_gohome",
+  70 : "robot_halt",
+  71 : "robot_hold",
+  72 : "robot_move",
+  73 : "robot_rotate",
+  74 : "robot_speed",
+  75 : "robot_unchuck",
+  76 : "robot_unhold",
+  77 : "robot_getattribute",
+  78 : "robot_gethelp",
+  79 : "robot_getname",
+  80 : "robot_gettag",
+  81 : "robot_puttag",
+  82 : "robot_getid",
+  83 : "robot_putid",
+  84 : "robot_release",
+
+  85 : "task_getvariable",
+  86 : "task_getvariablenames",
+  87 : "task_execute",
+  88 : "task_start",
+  89 : "task_stop",
+  90 : "task_delete",
+  91 : "task_getfilename",
+  92 : "task_getattribute",
+  93 : "task_gethelp",
+  94 : "task_getname",
+  95 : "task_gettag",
+  96 : "task_puttag",
+  97 : "task_getid",
+  98 : "task_putid",
+  99 : "task_release",
+
+  100: "variable_getdatetime",
+  101: "variable_getvalue",
+  102: "variable_putvalue",
+  103: "variable_getattribute",
+  104: "variable_gethelp",
+  105: "variable_getname",
+  106: "variable_gettag",
+  107: "variable_puttag",
+  108: "variable_getid",
+  109: "variable_putid",
+  110: "variable_getmicrosecond",
+  111: "variable_release",
+
+  112: "command_execute",
+  113: "command_cancel",
+  114: "command_gettimeout",
+  115: "command_puttimeout",
+  116: "command_getstate",
+  117: "command_getparameters",
+  118: "command_putparameters",
+  119: "command_getresult",
+  120: "command_getattribute",
+  121: "command_gethelp",
+  122: "command_getname",
+  123: "command_gettag",
+  124: "command_puttag",
+  125: "command_getid",
+  126: "command_putid",
+  127: "command_release",
+
+  128: "message_reply",
+  129: "message_clear",
+  130: "message_getdatetime",
+  131: "message_getdescription",
+  132: "message_getdestination",
+  133: "message_getnumber",
+  134: "message_getserialnumber",
+  135: "message_getsource",
+  136: "message_getvalue",
+  137: "message_release",
+}
+FUNC_IDS = {name: funcid for (funcid, name) in FUNC_NAMES.items()}
+
+# ハンドルを返す関数 -> そのハンドルの解放に使う関数
+RELEASE_OF = {
+  "controller_connect"     : "controller_disconnect",
+  "controller_getextension": "extension_release",
+  "controller_getfile"     : "file_release",
+  "controller_getrobot"    : "robot_release",
+  "controller_gettask"     : "task_release",
+  "controller_getvariable" : "variable_release",
+  "controller_getcommand"  : "command_release",
+  "controller_getmessage"  : "message_release",
+  "extension_getvariable"  : "variable_release",
+  "file_getfile"           : "file_release",
+  "file_getvariable"       : "variable_release",
+  "robot_getvariable"      : "variable_release",
+  "task_getvariable"       : "variable_release",
+}
+
+class _Call:
+  # 送信して応答を待っている要求
+  def __init__(self, funcid):
+    self.funcid     = funcid
+    self.serial     = None
+    self.deadline   = 0.0
+    self.packet     = None    # UDP の再送用
+    self.sends      = 0
+    self.resend_at  = 0.0
+    self.frame      = None    # 届いた応答
+    self.error      = None    # 切断等で失敗したときの hresult
+    self.keepalives = 0
+    self.len_send   = None
+    self.len_recv   = None
+    self.start_ns   = None
+    self.t0         = 0
+    self.t_sent     = 0
+    self.phases     = [None] * 6
+
 class BCAPClient:
   _BCAP_SOH = 0x1
   _BCAP_EOT = 0x4
@@ -69,15 +262,87 @@ class BCAPClient:
     VarType.VT_UI8  :("Q"  , 8),
   }
 
-  def __init__(self, host, port, timeout):
+  _DICT_DTYPE2VT = {
+    "f8": VarType.VT_R8 , "f4": VarType.VT_R4 ,
+    "i2": VarType.VT_I2 , "i4": VarType.VT_I4 , "i8": VarType.VT_I8 ,
+    "u1": VarType.VT_UI1, "u2": VarType.VT_UI2, "u4": VarType.VT_UI4,
+    "u8": VarType.VT_UI8, "b1": VarType.VT_BOOL,
+  }
+
+  # ndarray で返す配列の型. VT_UI1 の配列 (バイト列) は setndarray に関わらず bytes で返す
+  _DICT_VT2DTYPE = {
+    VarType.VT_I2   :"<i2",
+    VarType.VT_I4   :"<i4",
+    VarType.VT_R4   :"<f4",
+    VarType.VT_R8   :"<f8",
+    VarType.VT_CY   :"<i8",
+    VarType.VT_ERROR:"<i4",
+    VarType.VT_BOOL :"<i2",
+    VarType.VT_UI2  :"<u2",
+    VarType.VT_UI4  :"<u4",
+    VarType.VT_I8   :"<i8",
+    VarType.VT_UI8  :"<u8",
+  }
+
+  _DICT_VT2STRUCT = {
+    vt: struct.Struct("<" + fmt)
+    for (vt, (fmt, len_val)) in _DICT_VT2TYPE.items() if len_val > 0
+  }
+
+  _ST_HEADER = struct.Struct("<bIHhiH")
+  _ST_VT_LEN = struct.Struct("<HI")
+  _ST_UINT   = struct.Struct("<I")
+
+  _DICT_FMT2LEN = {
+    fmt: struct.calcsize("<" + fmt) for fmt in "hHiIlLqQfdB"
+  }
+
+  _STRUCT_CACHE     = {}
+  _STRUCT_CACHE_MAX = 512
+
+  _PLAN_CACHE     = {}
+  _PLAN_CACHE_MAX = 256
+  _plan_hits      = 0
+  _plan_misses    = 0
+  _SEND_FLAGS = getattr(socket, "MSG_NOSIGNAL", 0)
+
+  _SEND_BUF_SIZE    = 4096
+  _RECV_BUF_SIZE    = 65536
+  _RESYNC_MAX_FRAME = 1 << 24
+
+  def __init__(self, host, port, timeout, transport = "tcp", retry = 3,
+               retry_interval = None):
+    # transport: "tcp" または "udp"
+    #   UDP では応答が retry_interval [s] (既定 timeout / (retry + 1)) 以内に
+    #   届かなければ同じパケット (同じシリアル番号) を最大 retry 回まで再送する
+    if transport not in ("tcp", "udp"):
+      raise ValueError("transport must be 'tcp' or 'udp': %r" % (transport, ))
     self._serial  = 1
     self._version = 0
     self._timeout = timeout
     self._sock    = None
     self._lock    = Lock()
+    self._stats   = None
+    self._span    = None
+    self._traced  = False
+    self._capture = None
+    self._cache   = None
+    self._udp     = (transport == "udp")
+    self._retry   = retry
+    self._retry_interval = retry_interval
+    self._pending = {}      # シリアル番号 -> 応答待ちの _Call
+    self._reading = False   # どれかのスレッドが受信中
+    self._ready   = Condition(self._lock)
+    self._retransmits = 0
+    self._duplicates  = 0
+    self._invalid     = 0
+    self._init_codec()
 
     try:
-      self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      if self._udp:
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      else:
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       self._sock.setblocking(False)
       self._sock.settimeout(timeout)
       self._sock.connect((host, port))
@@ -90,12 +355,38 @@ class BCAPClient:
     self._sock.setblocking(True)
 
   def __del__(self):
-    if not (self._sock is None):
+    self.close()
+
+  def close(self):
+    # ソケットを閉じる. 以降の呼び出しは E_NOT_CONNECTED になる
+    sock = getattr(self, "_sock", None)
+    if not (sock is None):
+      self._sock = None
       try:
-        self._sock.shutdown(socket.SHUT_RDWR)
+        if not self._udp:
+          sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass  # 相手側から既に切断されている
       finally:
-        self._sock.close()
-        self._sock = None
+        sock.close()
+
+  def codec():
+    c = BCAPClient.__new__(BCAPClient)
+    c._sock = None
+    c._capture = None
+    c._udp = False
+    c._init_codec()
+    return c
+
+  def _init_codec(self):
+    self._ndarray   = False
+    self._send_buf  = bytearray(BCAPClient._SEND_BUF_SIZE)
+    self._recv_buf  = bytearray(BCAPClient._RECV_BUF_SIZE)
+    self._recv_view = memoryview(self._recv_buf)
+    self._recv_head = 0
+    self._recv_tail = 0
+    self._resync    = False
+    self._recv_discard = 0
 
   def settimeout(self, timeout):
     self._timeout = timeout
@@ -103,6 +394,53 @@ class BCAPClient:
   def gettimeout(self):
     return self._timeout
 
+  def setndarray(self, enable):
+    # True にすると数値配列の戻り値を numpy.ndarray (読み取り専用) で返す.
+    # VT_UI1 の配列 (ファイル・変数のバイト列) はどちらでも bytes のまま
+    if enable and (np is None):
+      raise ImportError("numpy is required for ndarray replies")
+    self._ndarray = enable
+
+  def getndarray(self):
+    return self._ndarray
+
+  def transport_stats(self):
+    return {
+      "transport"  : "udp" if self._udp else "tcp",
+      "retransmits": self._retransmits,
+      "duplicates" : self._duplicates,
+      "invalid"    : self._invalid,
+    }
+
+  def settrace(self, stats = None, span = None):
+    # stats: bcapstats.CallStats (funcid ごとの区間ヒストグラムに記録する)
+    # span : span(dict) を呼び出しごとに呼ぶ (トレーサへの受け渡し用)
+    # どちらも None なら計測しない
+    with self._lock:
+      self._stats  = stats
+      self._span   = span
+      self._traced = (stats is not None) or (span is not None)
+
+  def gettrace(self):
+    return (self._stats, self._span)
+
+  def setcapture(self, writer):
+    # writer: bcaprecord.CaptureWriter (送受信した全フレームを記録する). None で停止.
+    # writer の close は呼び出し側で行う
+    with self._lock:
+      self._capture = writer
+
+  def getcapture(self):
+    return self._capture
+
+  def setcache(self, cache):
+    # cache: bcapcache.MetadataCache (名前・属性等の結果を TTL 付きで覚える). None で無効
+    with self._lock:
+      self._cache = cache
+
+  def getcache(self):
+    return self._cache
+
   def service_start(self, option = ""):
     self._send_and_recv(1, [option])
 
@@ -514,85 +852,212 @@ class BCAPClient:
   def message_release(self, handle):
     self._send_and_recv(137, [handle])
 
+  def robot_execute_nowait(self, handle, command, param = None):
+    return self._send_nowait(64, [handle, command, param])
+
+  def robot_move_nowait(self, handle, comp, pose, option = ""):
+    return self._send_nowait(72, [handle, comp, pose, option])
+
+  def task_start_nowait(self, handle, mode, option = ""):
+    return self._send_nowait(88, [handle, mode, option])
+
+  def _send_nowait(self, funcid, args):
+    # 送信したら戻り, 戻り値は Future で返す. 応答はシリアル番号で振り分けるので,
+    # 応答を待つ間も同じクライアントで他の呼び出しができる (TCP のみ. UDP は 1 つずつ).
+    # コントローラが同じ接続の要求を並行に処理するとは限らないので, 動作中に待たずに
+    # 呼び出したい場合は BCAPClientPool で接続を分ける. キャッシュは無効化だけ行う
+    if self._cache is not None:
+      self._cache.observe(funcid, args)
+    return self._request(funcid, args, True)
+
   def _send_and_recv(self, funcid, args):
-    with self._lock:
-      self._bcap_send(self._serial, self._version, funcid, args)
-      (serial, version, hresult, retvals) = self._bcap_recv()
+    if self._cache is not None:
+      return self._cache.call(self._request, funcid, args)
+    return self._request(funcid, args)
 
-      if self._serial >= 0xFFFF:
-        self._serial  = 1
-      else:
-        self._serial += 1
+  def _request(self, funcid, args, nowait = False):
+    call = self._begin(funcid, args)
+    if not nowait:
+      return self._finish(call)
 
-      if HResult.failed(hresult):
-        raise ORiNException(hresult)
+    future = Future()
+    future.set_running_or_notify_cancel()
+    Thread(target=self._finish_future, args=(call, future), daemon=True).start()
+    return future
+
+  def _finish_future(self, call, future):
+    try:
+      retvals = self._finish(call)
+    except BaseException as e:
+      future.set_exception(e)
+      return
+    future.set_result(retvals[0])
+
+  def _begin(self, funcid, args):
+    # 要求を送って応答待ちに登録する. ロックを持つのは送信の間だけ
+    clock = time.perf_counter_ns
+    call = _Call(funcid)
+    with self._lock:
+      if self._udp:
+        # UDP ではコントローラは送信元ごとに最後のシリアル番号しか覚えないので,
+        # 前の要求の応答を受け取るまで次を送らない (再送が別の要求と混ざらないように)
+        while self._pending:
+          self._ready.wait()
+      call.serial = self._alloc_serial()
+      if self._traced:
+        call.start_ns = time.time_ns()
+      call.t0 = clock()
+      try:
+        buf = self._serialize(call.serial, self._version, funcid, args)
+        call.len_send = len(buf)
+        t1 = clock()
+        call.phases[0] = t1 - call.t0
+
+        self._sock_send(call, buf)
+        call.t_sent = clock()
+        call.phases[1] = call.t_sent - t1
+        if self._capture is not None:
+          self._capture.write(self._capture.SENT, buf)
+      except BaseException as e:
+        if self._traced:
+          self._record(call, e)
+        raise e
+      self._pending[call.serial] = call
+    return call
+
+  def _finish(self, call):
+    # 応答を待って戻り値を返す
+    clock = time.perf_counter_ns
+    (hresult, error) = (None, None)
+    try:
+      self._wait(call)
+      t5 = clock()
+      (serial, version, hresult, retvals) = self._deserialize(call.frame)
+      call.phases[4] = clock() - t5
+    except BaseException as e:
+      error = e
+      raise e
+    finally:
+      if self._traced:
+        self._record(call, error if error is not None else hresult)
+
+    if HResult.failed(hresult):
+      raise ORiNException(hresult)
 
     if len(retvals) == 0:
       retvals.append(None)
-      
+
     return retvals
 
-  def _bcap_send(self, serial, version, funcid, args):
-    buf = self._serialize(serial, version, funcid, args)
-    flags = 0
-    if hasattr(socket, 'MSG_NOSIGNAL'):
-      flags |= socket.MSG_NOSIGNAL
-    self._sock.sendall(buf, flags)
+  def _record(self, call, result):
+    # result: 応答の hresult または例外
+    (stats, span) = (self._stats, self._span)
+    phases = call.phases
+    phases[5] = time.perf_counter_ns() - call.t0
+    if isinstance(result, ORiNException):
+      hresult = result.hresult
+    elif isinstance(result, OSError):
+      hresult = HResult.E_NOT_CONNECTED
+    elif isinstance(result, BaseException):
+      hresult = None
+    else:
+      hresult = result
+    failed = (hresult is not None) and HResult.failed(hresult)
+    if stats is not None:
+      stats.record(call.funcid, phases, call.len_send, call.len_recv, call.keepalives,
+                   hresult if failed else None)
+    if span is not None:
+      span({
+        "funcid"    : call.funcid,
+        "serial"    : call.serial,
+        "start_ns"  : call.start_ns,
+        "phases_ns" : dict(zip(("serialize", "send", "wait", "receive",
+                                "decode", "total"), phases)),
+        "sent"      : call.len_send,
+        "received"  : call.len_recv,
+        "keepalives": call.keepalives,
+        "hresult"   : hresult,
+      })
+
+  def _alloc_serial(self):
+    # 応答待ちのシリアル番号は使わない (一周しても重ならないように)
+    while self._serial in self._pending:
+      self._next_serial()
+    serial = self._serial
+    self._next_serial()
+    return serial
+
+  def _next_serial(self):
+    if self._serial >= 0xFFFF:
+      self._serial  = 1
+    else:
+      self._serial += 1
+
+  def _sock_send(self, call, buf):
+    if self._sock is None:
+      raise ORiNException(HResult.E_NOT_CONNECTED)
+    now = time.monotonic()
+    call.deadline = now + self._timeout
+    if self._udp:
+      # 再送用に保持 (送信バッファは次の要求で上書きされる)
+      call.packet    = bytes(buf)
+      call.sends     = 1
+      call.resend_at = now + self._udp_interval()
+      self._sock.send(call.packet)
+    else:
+      self._sock.sendall(buf, BCAPClient._SEND_FLAGS)
 
   def _serialize(self, serial, version, funcid, args):
-    format = "<bIHhiH"
+    fmts = ["<bIHhiH"]
     packet_data = [BCAPClient._BCAP_SOH, 0, serial, version, funcid, len(args)]
 
-    packed_args = self._serialize_args(args, True)
-
-    format += "%ds" % len(packed_args)
-    packet_data.append(packed_args)
+    for (encode, arg) in zip(BCAPClient._get_plan(args), args):
+      fmts.append("I")
+      packet_data.append(0)
+      index = len(packet_data) - 1
+      packet_data[index] = encode(self, arg, fmts, packet_data)
 
-    format += "b"
+    fmts.append("b")
     packet_data.append(BCAPClient._BCAP_EOT)
 
-    buf = struct.pack(format, *packet_data)
-    buf = buf.replace(b'\0\0\0\0', struct.pack("<I", len(buf)), 1)
-
-    return buf
+    st = BCAPClient._get_struct("".join(fmts))
+    len_buf = st.size
+    if len(self._send_buf) < len_buf:
+      self._send_buf = bytearray(max(len_buf, 2 * len(self._send_buf)))
 
-  def _serialize_args(self, args, first = False):
-    format = "<"
-    packet_data = []
-    offset = 0
+    st.pack_into(self._send_buf, 0, *packet_data)
+    BCAPClient._ST_UINT.pack_into(self._send_buf, 1, len_buf)
 
-    for arg in args:
-      if first:
-        format += "I"
-        packet_data.append(0)
+    return memoryview(self._send_buf)[:len_buf]
 
-      packed_arg = self._serialize_arg(arg)
-      len_arg = len(packed_arg)
-      format += "%ds" % len_arg
-      packet_data.append(packed_arg)
+  def _serialize_args(self, args, fmts, packet_data):
+    len_args = 0
 
-      if first:
-        packet_data[2*offset] = len_arg
+    for arg in args:
+      len_args += self._serialize_arg(arg, fmts, packet_data)
 
-      offset += 1
+    return len_args
 
-    if len(packet_data) > 0:
-      return struct.pack(format, *packet_data)
-    else:
-      return b''
+  def _serialize_arg(self, arg, fmts, packet_data):
+    if (np is not None) and isinstance(arg, (np.ndarray, np.generic)):
+      if (arg.ndim == 0) or (BCAPClient._dtype_key(arg) not in BCAPClient._DICT_DTYPE2VT):
+        arg = arg.tolist()
+      elif arg.size > 0:
+        return self._serialize_ndarray(arg, fmts, packet_data)
+      else:
+        arg = None
 
-  def _serialize_arg(self, arg):
-    format = "<HI"
-    packet_data = []
+    fmts.append("HI")
+    len_arg = 6
 
     if arg is None:
-      packet_data = [VarType.VT_EMPTY, 1]
+      packet_data += [VarType.VT_EMPTY, 1]
 
     elif isinstance(arg, (list, tuple)):
-      len_arg = len(arg)
+      len_ary = len(arg)
 
-      if len_arg <= 0:
-        packet_data = [VarType.VT_EMPTY, 1]
+      if len_ary <= 0:
+        packet_data += [VarType.VT_EMPTY, 1]
       else:
         is_vntary = False
         type_o0 = type(arg[0])
@@ -602,46 +1067,44 @@ class BCAPClient:
             break
 
         if is_vntary:
-          packed_args = self._serialize_args(arg)
-          format += "%ds" % len(packed_args)
-          packet_data += [VarType.VT_VARIANT | VarType.VT_ARRAY, len_arg, packed_args]        
+          packet_data += [VarType.VT_VARIANT | VarType.VT_ARRAY, len_ary]
+          len_arg += self._serialize_args(arg, fmts, packet_data)
 
         else:
           if type_o0 in BCAPClient._DICT_TYPE2VT:
             (vt, fmt, is_ctype) = BCAPClient._DICT_TYPE2VT[type_o0]
+            packet_data += [vt | VarType.VT_ARRAY, len_ary]
 
-            if vt == VarType.VT_DATE:
-              format += fmt * len_arg
-              packet_data += [vt | VarType.VT_ARRAY, len_arg]
-              for o in arg:
-                packet_data.append(BCAPClient.datetime2vntdate(o))
-
-            elif vt == VarType.VT_BSTR:
-              packet_data += [vt | VarType.VT_ARRAY, len_arg]
+            if vt == VarType.VT_BSTR:
               for o in arg:
                 if is_ctype:
                   str_tmp = o.value.encode("utf-16le")
                 else:
                   str_tmp = o.encode("utf-16le")
                 len_str = len(str_tmp)
-                format += fmt % len_str
+                fmts.append(fmt % len_str)
                 packet_data += [len_str, str_tmp]
-
-            elif vt == VarType.VT_BOOL:
-              format += fmt * len_arg
-              packet_data += [vt | VarType.VT_ARRAY, len_arg]
-              for o in arg:
-                if o:
-                  packet_data.append(-1)
-                else:
-                  packet_data.append(0)
+                len_arg += 4 + len_str
 
             else:
-              format += fmt * len_arg
-              packet_data += [vt | VarType.VT_ARRAY, len_arg]
-              if is_ctype:
+              fmts.append("%d%s" % (len_ary, fmt))
+              len_arg += BCAPClient._DICT_FMT2LEN[fmt] * len_ary
+
+              if vt == VarType.VT_DATE:
+                for o in arg:
+                  packet_data.append(BCAPClient.datetime2vntdate(o))
+
+              elif vt == VarType.VT_BOOL:
+                for o in arg:
+                  if o:
+                    packet_data.append(-1)
+                  else:
+                    packet_data.append(0)
+
+              elif is_ctype:
                 for o in arg:
                   packet_data.append(o.value)
+
               else:
                 packet_data += arg
 
@@ -649,123 +1112,545 @@ class BCAPClient:
             raise ORiNException(HResult.E_CAO_VARIANT_TYPE_NOSUPPORT)
 
     elif isinstance(arg, (bytes, bytearray)):
-      len_arg = len(arg)
-      format += "%ds" % len_arg
-      packet_data += [VarType.VT_ARRAY | VarType.VT_UI1, len_arg, arg]
+      len_ary = len(arg)
+      fmts.append("%ds" % len_ary)
+      packet_data += [VarType.VT_ARRAY | VarType.VT_UI1, len_ary, arg]
+      len_arg += len_ary
 
     else:
       type_arg = type(arg)
       if type_arg in BCAPClient._DICT_TYPE2VT:
         (vt, fmt, is_ctype) = BCAPClient._DICT_TYPE2VT[type_arg]
 
-        if vt == VarType.VT_DATE:
-          format += fmt
-          date_tmp = BCAPClient.datetime2vntdate(arg)
-          packet_data += [vt, 1, date_tmp]
-
-        elif vt == VarType.VT_BSTR:
+        if vt == VarType.VT_BSTR:
           if is_ctype:
             str_tmp = arg.value.encode("utf-16le")
           else:
             str_tmp = arg.encode("utf-16le")
           len_str = len(str_tmp)
-          format += fmt % len_str
+          fmts.append(fmt % len_str)
           packet_data += [vt, 1, len_str, str_tmp]
-
-        elif vt == VarType.VT_BOOL:
-          format += fmt
-          if arg:
-            packet_data += [vt, 1, -1]
-          else:
-            packet_data += [vt, 1,  0]
+          len_arg += 4 + len_str
 
         else:
-          format += fmt
-          if is_ctype:
+          fmts.append(fmt)
+          len_arg += BCAPClient._DICT_FMT2LEN[fmt]
+
+          if vt == VarType.VT_DATE:
+            packet_data += [vt, 1, BCAPClient.datetime2vntdate(arg)]
+
+          elif vt == VarType.VT_BOOL:
+            if arg:
+              packet_data += [vt, 1, -1]
+            else:
+              packet_data += [vt, 1,  0]
+
+          elif is_ctype:
             packet_data += [vt, 1, arg.value]
+
           else:
             packet_data += [vt, 1, arg]
 
       else:
         raise ORiNException(HResult.E_CAO_VARIANT_TYPE_NOSUPPORT)
 
-    return struct.pack(format, *packet_data)
+    return len_arg
 
-  def _bcap_recv(self):
+  def _serialize_ndarray(self, arg, fmts, packet_data):
+    key = BCAPClient._dtype_key(arg)
+    vt  = BCAPClient._DICT_DTYPE2VT[key]
+
+    if vt == VarType.VT_BOOL:
+      data = np.where(arg.ravel(), -1, 0).astype("<i2").tobytes()
+    else:
+      data = np.ascontiguousarray(arg.ravel(), dtype="<" + key).tobytes()
+
+    len_data = len(data)
+    fmts.append("HI%ds" % len_data)
+    packet_data += [vt | VarType.VT_ARRAY, arg.size, data]
+    return 6 + len_data
+
+  def _dtype_key(arg):
+    return "%s%d" % (arg.dtype.kind, arg.dtype.itemsize)
+
+  def encoder_cache_info():
+    return {
+      "hits"  : BCAPClient._plan_hits,
+      "misses": BCAPClient._plan_misses,
+      "size"  : len(BCAPClient._PLAN_CACHE),
+    }
+
+  def encoder_cache_clear():
+    BCAPClient._PLAN_CACHE.clear()
+    BCAPClient._plan_hits   = 0
+    BCAPClient._plan_misses = 0
+
+  def _signature(args):
+    signature = []
+    for o in args:
+      type_o = type(o)
+      if (type_o is list) or (type_o is tuple):
+        signature.append(BCAPClient._list_signature(o))
+      else:
+        signature.append(type_o)
+    return tuple(signature)
+
+  def _list_signature(arg):
+    # 同じ型だけの配列は (型, 要素数), それ以外は要素ごとの型 (入れ子は再帰)
+    types = tuple(map(type, arg))
+    len_ary = len(types)
+    if (len_ary > 0) and (types.count(types[0]) == len_ary):
+      return (types[0], len_ary)
+    if (list in types) or (tuple in types):
+      return (BCAPClient._signature(arg), )
+    return types
+
+  def _get_plan(args):
+    signature = BCAPClient._signature(args)
+    plan = BCAPClient._PLAN_CACHE.get(signature)
+    if plan is None:
+      BCAPClient._plan_misses += 1
+      if len(BCAPClient._PLAN_CACHE) >= BCAPClient._PLAN_CACHE_MAX:
+        BCAPClient._PLAN_CACHE.clear()
+      plan = [BCAPClient._compile(o) for o in args]
+      BCAPClient._PLAN_CACHE[signature] = plan
+    else:
+      BCAPClient._plan_hits += 1
+    return plan
+
+  def _compile(sample):
+    # sample と同じ型構造の引数をエンコードする関数を返す.
+    # 型だけで決まる処理 (VT の決定, VARIANT 配列の判定, 固定長部分の書式) を
+    # ここで済ませておき, 文字列長などの値に依存する部分だけを毎回処理する.
+    type_arg = type(sample)
+
+    if sample is None:
+      return BCAPClient._encode_empty
+
+    elif (type_arg is list) or (type_arg is tuple):
+      len_ary = len(sample)
+      if len_ary <= 0:
+        return BCAPClient._encode_empty
+
+      type_o0 = type(sample[0])
+      for o in sample:
+        if type_o0 != type(o):
+          return BCAPClient._compile_variant(sample)
+
+      if not (type_o0 in BCAPClient._DICT_TYPE2VT):
+        return BCAPClient._encode_generic
+
+      (vt, fmt, is_ctype) = BCAPClient._DICT_TYPE2VT[type_o0]
+      vt_ary = vt | VarType.VT_ARRAY
+
+      if vt == VarType.VT_BSTR:
+        def encode(codec, arg, fmts, packet_data):
+          packet_data += [vt_ary, len_ary]
+          len_arg = 6
+          fmts.append("HI")
+          for o in arg:
+            str_tmp = (o.value if is_ctype else o).encode("utf-16le")
+            len_str = len(str_tmp)
+            fmts.append(fmt % len_str)
+            packet_data += [len_str, str_tmp]
+            len_arg += 4 + len_str
+          return len_arg
+        return encode
+
+      fmt_ary = "HI%d%s" % (len_ary, fmt)
+      len_arg = 6 + BCAPClient._DICT_FMT2LEN[fmt] * len_ary
+
+      if vt == VarType.VT_DATE:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_ary)
+          packet_data += [vt_ary, len_ary]
+          packet_data += [BCAPClient.datetime2vntdate(o) for o in arg]
+          return len_arg
+      elif vt == VarType.VT_BOOL:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_ary)
+          packet_data += [vt_ary, len_ary]
+          packet_data += [-1 if o else 0 for o in arg]
+          return len_arg
+      elif is_ctype:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_ary)
+          packet_data += [vt_ary, len_ary]
+          packet_data += [o.value for o in arg]
+          return len_arg
+      else:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_ary)
+          packet_data += [vt_ary, len_ary]
+          packet_data += arg
+          return len_arg
+      return encode
+
+    elif type_arg in BCAPClient._DICT_TYPE2VT:
+      (vt, fmt, is_ctype) = BCAPClient._DICT_TYPE2VT[type_arg]
+
+      if vt == VarType.VT_BSTR:
+        fmt_str = "HI" + fmt
+        def encode(codec, arg, fmts, packet_data):
+          str_tmp = (arg.value if is_ctype else arg).encode("utf-16le")
+          len_str = len(str_tmp)
+          fmts.append(fmt_str % len_str)
+          packet_data += [vt, 1, len_str, str_tmp]
+          return 10 + len_str
+        return encode
+
+      fmt_val = "HI" + fmt
+      len_arg = 6 + BCAPClient._DICT_FMT2LEN[fmt]
+
+      if vt == VarType.VT_DATE:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_val)
+          packet_data += [vt, 1, BCAPClient.datetime2vntdate(arg)]
+          return len_arg
+      elif vt == VarType.VT_BOOL:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_val)
+          packet_data += [vt, 1, -1 if arg else 0]
+          return len_arg
+      elif is_ctype:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_val)
+          packet_data += [vt, 1, arg.value]
+          return len_arg
+      else:
+        def encode(codec, arg, fmts, packet_data):
+          fmts.append(fmt_val)
+          packet_data += [vt, 1, arg]
+          return len_arg
+      return encode
+
+    else:
+      # bytes, ndarray, 派生型など値ごとに形が変わるものは通常の経路で処理する
+      return BCAPClient._encode_generic
+
+  def _compile_variant(sample):
+    len_ary = len(sample)
+    vt_ary  = VarType.VT_VARIANT | VarType.VT_ARRAY
+    encoders = [BCAPClient._compile(o) for o in sample]
+
+    def encode(codec, arg, fmts, packet_data):
+      fmts.append("HI")
+      packet_data += [vt_ary, len_ary]
+      len_arg = 6
+      for (encode_o, o) in zip(encoders, arg):
+        len_arg += encode_o(codec, o, fmts, packet_data)
+      return len_arg
+    return encode
+
+  def _encode_empty(codec, arg, fmts, packet_data):
+    fmts.append("HI")
+    packet_data += [VarType.VT_EMPTY, 1]
+    return 6
+
+  def _encode_generic(codec, arg, fmts, packet_data):
+    return codec._serialize_arg(arg, fmts, packet_data)
+
+  def _get_struct(fmt):
+    st = BCAPClient._STRUCT_CACHE.get(fmt)
+    if st is None:
+      if len(BCAPClient._STRUCT_CACHE) >= BCAPClient._STRUCT_CACHE_MAX:
+        BCAPClient._STRUCT_CACHE.clear()
+      st = struct.Struct(fmt)
+      BCAPClient._STRUCT_CACHE[fmt] = st
+    return st
+
+  def _wait(self, call):
+    # call の応答が届くまで待つ. 受信中のスレッドがなければ自分で 1 フレームずつ受信し,
+    # シリアル番号で応答待ちの要求に振り分ける (他のスレッドの応答なら起こす)
+    with self._lock:
+      try:
+        while (call.frame is None) and (call.error is None):
+          if self._reading:
+            wait = call.deadline - time.monotonic()
+            if wait <= 0:
+              raise ORiNException(HResult.E_TIMEOUT)
+            self._ready.wait(wait)
+            continue
+
+          self._reading = True
+          self._lock.release()
+          (received, error) = (None, None)
+          try:
+            received = self._recv_next(call)
+          except (ORiNException, OSError) as e:
+            error = e
+          finally:
+            self._lock.acquire()
+            self._reading = False
+            self._ready.notify_all()
+
+          if error is not None:
+            self._recv_failed(error)
+            raise error
+          self._route(*received)
+
+        if call.error is not None:
+          raise ORiNException(call.error)
+      finally:
+        if self._pending.get(call.serial) is call:
+          del self._pending[call.serial]
+          self._ready.notify_all()
+
+  def _recv_next(self, call):
+    # 1 フレーム受信する (待つのは call の期限まで). 戻り値: (フレーム, 受信開始, 受信完了)
+    clock = time.perf_counter_ns
+    if self._sock is None:
+      raise ORiNException(HResult.E_NOT_CONNECTED)
+    self._recv_wait(call)
+    t3 = clock()
+    frame = self._recv_frame(call)
+    return (frame, t3, clock())
+
+  def _route(self, frame, t3, t4):
+    # 受信したフレームを同じシリアル番号の要求に渡す
+    (soh, len_frame, serial, version, hresult, len_args) \
+      = BCAPClient._ST_HEADER.unpack_from(frame, 0)
+    call = self._pending.get(serial)
+    if (call is None) or (call.frame is not None):
+      # 待っていない番号: タイムアウトした要求に遅れて届いた応答, UDP の重複応答
+      self._duplicates += 1
+      return
+
+    # 応答 (S_EXECUTING を含む) が届いたので再送をやめる
+    call.sends = self._retry + 1
+    if hresult == HResult.S_EXECUTING:
+      call.keepalives += 1
+      call.deadline = time.monotonic() + self._timeout
+      return
+
+    # 受信バッファは次の受信で上書きされるので複製して渡す
+    call.frame    = bytes(frame)
+    call.len_recv = len(frame)
+    call.phases[2] = t3 - call.t_sent
+    call.phases[3] = t4 - t3
+
+  def _recv_failed(self, error):
+    # 受信エラー: 切断なら応答待ちの要求をすべて失敗させる
+    if not self._udp:
+      self._recv_reset()
+    if isinstance(error, OSError) or (error.hresult == HResult.E_NOT_CONNECTED):
+      for call in self._pending.values():
+        call.error = HResult.E_NOT_CONNECTED
+
+  def _recv_reset(self):
+    # 受信エラーの後: 受信バッファに残った途中までのフレームを捨てる.
+    # 残りは後から届くので, 長さが分かっていればその分を読み捨て,
+    # 分からなければ次に SOH と EOT がそろうフレームまで読み飛ばす
+    len_recv = self._recv_tail - self._recv_head
+    if len_recv >= 5:
+      (len_frame, ) = BCAPClient._ST_UINT.unpack_from(self._recv_buf, self._recv_head + 1)
+      self._recv_discard = max(len_frame - len_recv, 0)
+    elif len_recv > 0:
+      self._resync = True
+    self._recv_head = self._recv_tail = 0
+
+  def _recv_wait(self, call):
+    if self._udp:
+      self._udp_wait(call)
+    elif self._recv_tail == self._recv_head:
+      self._recv_fill(call.deadline)
+
+  def _recv_frame(self, call):
+    if self._udp:
+      frame = self._recv_datagram(call)
+    else:
+      frame = self._recv_stream(call.deadline)
+    if self._capture is not None:
+      self._capture.write(self._capture.RECEIVED, frame)
+    return frame
+
+  def _recv_stream(self, deadline):
     while True:
-      buf_all = b''
+      if self._recv_discard or self._resync:
+        self._recv_skip()
+      len_recv = self._recv_tail - self._recv_head
+
+      if self._recv_discard:
+        len_frame = 1
+      elif len_recv >= 5:
+        (len_frame, ) = BCAPClient._ST_UINT.unpack_from(
+          self._recv_buf, self._recv_head + 1)
+        if self._resync and not self._resync_header(len_frame, len_recv):
+          self._recv_head += 1
+          continue
+        if len_frame < BCAPClient._ST_HEADER.size + 1:
+          raise ORiNException(HResult.E_INVALIDPACKET)
+
+        if len_recv >= len_frame:
+          if self._resync:
+            if self._recv_buf[self._recv_head + len_frame - 1] != BCAPClient._BCAP_EOT:
+              self._recv_head += 1
+              continue
+            self._resync = False
+          head = self._recv_head
+          self._recv_head += len_frame
+          if self._recv_head == self._recv_tail:
+            self._recv_head = self._recv_tail = 0
+          return self._recv_view[head:head + len_frame]
+      else:
+        len_frame = 5
 
-      buf_tmp = self._recv_with_select(1)
-      buf_all = b''.join([buf_all, buf_tmp])
+      self._reserve_recv(len_frame)
+      self._recv_fill(deadline)
 
-      buf_tmp  = self._recv_with_select(4)
-      len_recv = struct.unpack("<I", buf_tmp)
-      buf_all  = b''.join([buf_all, buf_tmp])
+  def _recv_skip(self):
+    if self._recv_discard:
+      # 前に途中で諦めたフレームの残り
+      len_skip = min(self._recv_discard, self._recv_tail - self._recv_head)
+      self._recv_head    += len_skip
+      self._recv_discard -= len_skip
+    else:
+      # 同期し直す間は SOH が来るまで捨てる
+      head = self._recv_buf.find(BCAPClient._BCAP_SOH, self._recv_head, self._recv_tail)
+      self._recv_head = self._recv_tail if head < 0 else head
+    if self._recv_head == self._recv_tail:
+      self._recv_head = self._recv_tail = 0
+
+  def _resync_header(self, len_frame, len_recv):
+    # 同期し直すときのフレーム先頭の候補: 長さがありえる値で, 待っている応答のシリアル番号
+    if not (BCAPClient._ST_HEADER.size < len_frame <= BCAPClient._RESYNC_MAX_FRAME):
+      return False
+    if len_recv < 7:
+      return True
+    (serial, ) = struct.unpack_from("<H", self._recv_buf, self._recv_head + 5)
+    return serial in self._pending
+
+  def _reserve_recv(self, len_frame):
+    if self._recv_head + len_frame <= len(self._recv_buf):
+      return
+
+    len_recv = self._recv_tail - self._recv_head
+    if len_frame <= len(self._recv_buf):
+      self._recv_view[:len_recv] \
+        = self._recv_view[self._recv_head:self._recv_tail]
+    else:
+      buf = bytearray(max(len_frame, 2 * len(self._recv_buf)))
+      buf[:len_recv] = self._recv_view[self._recv_head:self._recv_tail]
+      self._recv_buf  = buf
+      self._recv_view = memoryview(buf)
 
-      buf_tmp = self._recv_with_select(len_recv[0] - 5)
-      buf_all = b''.join([buf_all, buf_tmp])
+    self._recv_head = 0
+    self._recv_tail = len_recv
 
-      (serial, version, hresult, retvals) = self._deserialize(buf_all)
+  def _recv_fill(self, deadline):
+    (reads, writes, errors) = select.select(
+      [self._sock], [], [], max(deadline - time.monotonic(), 0.0))
 
-      if (self._serial == serial) and (hresult != HResult.S_EXECUTING):
-        break
+    if len(reads) == 0:
+      raise ORiNException(HResult.E_TIMEOUT)
 
-    return (serial, version, hresult, retvals)
+    len_recv = self._sock.recv_into(self._recv_view[self._recv_tail:])
+    if len_recv == 0:
+      raise ORiNException(HResult.E_NOT_CONNECTED)
 
-  def _recv_with_select(self, len_recv):
-    buf_recv = b''
+    self._recv_tail += len_recv
+
+  def _udp_interval(self):
+    if self._retry_interval is not None:
+      return self._retry_interval
+    return self._timeout / (self._retry + 1)
+
+  def _udp_wait(self, call):
     while True:
+      now = time.monotonic()
+      if call.sends <= self._retry:
+        wait = min(call.resend_at, call.deadline) - now
+      else:
+        wait = call.deadline - now
+
       (reads, writes, errors) = select.select(
-        [self._sock], [], [], self._timeout)
+        [self._sock], [], [], max(wait, 0.0))
+      if len(reads) > 0:
+        return
 
-      if len(reads) == 0:
+      now = time.monotonic()
+      if now >= call.deadline:
         raise ORiNException(HResult.E_TIMEOUT)
+      if (call.sends <= self._retry) and (now >= call.resend_at):
+        self._sock.send(call.packet)
+        call.sends += 1
+        call.resend_at = now + self._udp_interval()
+        self._retransmits += 1
+
+  def _recv_datagram(self, call):
+    # 1 データグラム = 1 フレーム. 壊れたものは捨てる (シリアル番号の振り分けは _route)
+    while True:
+      self._udp_wait(call)
+      try:
+        len_recv = self._sock.recv_into(self._recv_view)
+      except ConnectionRefusedError:
+        # 相手ポートが閉じている (ICMP port unreachable). 再送に任せる
+        continue
 
-      buf_recv = b''.join([buf_recv,
-        self._sock.recv(len_recv)])
-
-      if len(buf_recv) >= len_recv:
-        break
+      if (len_recv < BCAPClient._ST_HEADER.size + 1) \
+          or (self._recv_buf[0] != BCAPClient._BCAP_SOH) \
+          or (self._recv_buf[len_recv - 1] != BCAPClient._BCAP_EOT) \
+          or (BCAPClient._ST_UINT.unpack_from(self._recv_buf, 1)[0] != len_recv):
+        self._invalid += 1
+        continue
 
-    return buf_recv
+      return self._recv_view[:len_recv]
 
   def _deserialize(self, buf):
-    format = "<bIHhiH%dsb" % (len(buf) - 16)
-    (soh, len_buf, serial, version, hresult, len_args, buf_args, eot) \
-      = struct.unpack(format, buf)
+    if self._ndarray and isinstance(buf, memoryview):
+      # 受信バッファは再利用されるので, ndarray がビューを持てるよう複製する
+      buf = bytes(buf)
+    view = memoryview(buf)
+    len_buf = len(view)
+    if len_buf < BCAPClient._ST_HEADER.size + 1:
+      raise ORiNException(HResult.E_INVALIDPACKET)
+
+    (soh, len_packet, serial, version, hresult, len_args) \
+      = BCAPClient._ST_HEADER.unpack_from(view, 0)
+    eot = view[len_buf - 1]
 
     if (soh != BCAPClient._BCAP_SOH) or (eot != BCAPClient._BCAP_EOT):
       raise ORiNException(HResult.E_INVALIDPACKET)
 
-    (retvals, buf_args) = self._deserialize_args(buf_args, len_args, True)
+    (retvals, offset) = self._deserialize_args(view[:len_buf - 1],
+      BCAPClient._ST_HEADER.size, len_args, True)
 
     return (serial, version, hresult, retvals)
 
-  def _deserialize_args(self, buf, len_args, first = False):
+  def _deserialize_args(self, buf, offset, len_args, first = False):
     retvals = []
 
     for i in range(len_args):
       if first:
-        buf = buf[4:]
-      (retval, buf) = self._deserialize_arg(buf)
+        offset += 4
+      (retval, offset) = self._deserialize_arg(buf, offset)
       retvals.append(retval)
 
-    return (retvals, buf)
+    return (retvals, offset)
 
-  def _deserialize_arg(self, buf):
+  def _deserialize_arg(self, buf, offset):
     retval = None
 
-    format = "<HI%ds" % (len(buf) - 6)
-    (vt, len_arg, buf) = struct.unpack(format, buf)
+    (vt, len_arg) = BCAPClient._ST_VT_LEN.unpack_from(buf, offset)
+    offset += BCAPClient._ST_VT_LEN.size
 
     if (vt & VarType.VT_ARRAY) != 0:
       vt = vt ^ VarType.VT_ARRAY
       if vt == VarType.VT_VARIANT:
-        (retval, buf) = self._deserialize_args(buf, len_arg)
+        (retval, offset) = self._deserialize_args(buf, offset, len_arg)
+
+      elif self._ndarray and (vt in BCAPClient._DICT_VT2DTYPE):
+        dtype = np.dtype(BCAPClient._DICT_VT2DTYPE[vt])
+        end = BCAPClient._check_range(buf, offset, dtype.itemsize * len_arg)
+        retval = np.frombuffer(buf, dtype, len_arg, offset)
+        if vt == VarType.VT_BOOL:
+          retval = (retval != 0)
+        offset = end
 
       elif vt == VarType.VT_UI1:
-        format = "<%ds%ds" % (len_arg, len(buf) - len_arg)
-        (retval, buf) = struct.unpack(format, buf)
+        end = BCAPClient._check_range(buf, offset, len_arg)
+        retval = bytes(buf[offset:end])
+        offset = end
 
       elif vt in BCAPClient._DICT_VT2TYPE:
         (fmt, len_val) = BCAPClient._DICT_VT2TYPE[vt]
@@ -773,17 +1658,13 @@ class BCAPClient:
         if vt == VarType.VT_BSTR:
           retval = []
           for i in range(len_arg):
-            format = "<I%ds" % (len(buf) - 4)
-            (len_str, buf) = struct.unpack(format, buf)
-            format = "<%ds%ds" % (len_str, len(buf) - len_str)
-            (ret_tmp, buf) = struct.unpack(format, buf)
-            retval.append(ret_tmp.decode("utf-16le"))
+            (retstr, offset) = BCAPClient._unpack_bstr(buf, offset)
+            retval.append(retstr)
 
         else:
-          format = "<%s%ds" % (fmt * len_arg, len(buf) - (len_val * len_arg))
-          unpacked_arg = struct.unpack(format, buf)
-          retval   = list(unpacked_arg[:-1])
-          buf      = unpacked_arg[-1]
+          retval = list(struct.unpack_from(
+            "<%d%s" % (len_arg, fmt), buf, offset))
+          offset += len_val * len_arg
 
           if vt == VarType.VT_DATE:
             for i in range(len(retval)):
@@ -800,18 +1681,13 @@ class BCAPClient:
       if vt in [ VarType.VT_EMPTY, VarType.VT_NULL ]:
         pass
       elif vt in BCAPClient._DICT_VT2TYPE:
-        (fmt, len_val) = BCAPClient._DICT_VT2TYPE[vt]
-        
         if vt == VarType.VT_BSTR:
-          format = "<I%ds" % (len(buf) - 4)
-          (len_str, buf) = struct.unpack(format, buf)
-          format = "<%ds%ds" % (len_str, len(buf) - len_str)
-          (retval , buf) = struct.unpack(format, buf)
-          retval = retval.decode("utf-16le")
+          (retval, offset) = BCAPClient._unpack_bstr(buf, offset)
 
         else:
-          format = "<%s%ds" % (fmt, (len(buf) - len_val))
-          (retval, buf) = struct.unpack(format, buf)
+          st = BCAPClient._DICT_VT2STRUCT[vt]
+          (retval, ) = st.unpack_from(buf, offset)
+          offset += st.size
 
           if vt == VarType.VT_DATE:
             retval = BCAPClient.vntdate2datetime(retval)
@@ -822,5 +1698,16 @@ class BCAPClient:
       else:
         raise ORiNException(HResult.E_CAO_VARIANT_TYPE_NOSUPPORT)
 
-    return (retval, buf)
+    return (retval, offset)
+
+  def _unpack_bstr(buf, offset):
+    (len_str, ) = BCAPClient._ST_UINT.unpack_from(buf, offset)
+    offset += BCAPClient._ST_UINT.size
+    end = BCAPClient._check_range(buf, offset, len_str)
+    return (str(buf[offset:end], "utf-16le"), end)
 
+  def _check_range(buf, offset, length):
+    end = offset + length
+    if end > len(buf):
+      raise struct.error("unpack requires a buffer of %d bytes" % end)
+    return end
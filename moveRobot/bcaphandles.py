@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+# ハンドルのキャッシュ
+#   (取得関数, 親ハンドル, 名前, オプション) ごとにハンドルを保持し, 同じ変数の読み書きで
+#   *_getvariable の往復を省く. 上限を超えたら最も長く使われていないものから *_release する.
+#   E_HANDLE (再接続・コントローラ再起動でハンドルが無効になった) を受けたら取得し直して 1 回だけやり直す.
+#   BCAPClient と BCAPClientPool のどちらにも使える.
+from collections import OrderedDict
+from threading import RLock
+from bcapclient import RELEASE_OF
+from orinexception import *
+
+class HandleCache:
+  _KINDS = {
+    "controller": "controller_getvariable",
+    "extension" : "extension_getvariable",
+    "file"      : "file_getvariable",
+    "robot"     : "robot_getvariable",
+    "task"      : "task_getvariable",
+  }
+
+  # (親ハンドル, 名前, オプション) で取得するもの. controller_connect / controller_getmessage は引数が違い,
+  # getmessage は呼ぶたびに別のメッセージになるのでキャッシュしない
+  _GETTERS = {
+    "controller_getextension", "controller_getfile", "controller_getrobot",
+    "controller_gettask", "controller_getvariable", "controller_getcommand",
+    "extension_getvariable", "file_getfile", "file_getvariable",
+    "robot_getvariable", "task_getvariable",
+  }
+
+  def __init__(self, client, capacity = 64):
+    self._client   = client
+    self._capacity = capacity
+    self._entries  = OrderedDict()  # (取得関数, 親, 名前, オプション) -> ハンドル
+    self._lock     = RLock()
+    self.hits      = 0
+    self.misses    = 0
+    self.evictions = 0
+    self.retries   = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __getattr__(self, name):
+    # controller_getvariable(hctrl, "I1") 等をキャッシュ経由にする
+    if name not in self._GETTERS:
+      raise AttributeError(name)
+    return lambda parent, target, option = "": self.acquire(name, parent, target, option)
+
+  def acquire(self, func, parent, name, option = ""):
+    key = (func, parent, name, option)
+    with self._lock:
+      handle = self._entries.get(key)
+      if handle is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return handle
+
+      self.misses += 1
+      while len(self._entries) >= self._capacity:
+        self._evict(next(iter(self._entries)))
+      handle = getattr(self._client, func)(parent, name, option)
+      self._entries[key] = handle
+      return handle
+
+  def getvalue(self, parent, name, option = "", kind = "controller"):
+    return self._with_variable(parent, name, option, kind,
+      lambda hvar: self._client.variable_getvalue(hvar))
+
+  def putvalue(self, parent, name, value, option = "", kind = "controller"):
+    self._with_variable(parent, name, option, kind,
+      lambda hvar: self._client.variable_putvalue(hvar, value))
+
+  def release(self, func, parent, name, option = ""):
+    with self._lock:
+      key = (func, parent, name, option)
+      if key in self._entries:
+        self._evict(key)
+
+  def reset(self):
+    # 接続が切れた後など, 解放せずに全て忘れる (次の取得で取り直す)
+    with self._lock:
+      self._entries.clear()
+
+  def close(self):
+    with self._lock:
+      while self._entries:
+        self._evict(next(reversed(self._entries)))
+
+  def stats(self):
+    with self._lock:
+      return {
+        "size"     : len(self._entries),
+        "capacity" : self._capacity,
+        "hits"     : self.hits,
+        "misses"   : self.misses,
+        "evictions": self.evictions,
+        "retries"  : self.retries,
+      }
+
+  def _with_variable(self, parent, name, option, kind, call):
+    func = self._KINDS[kind]
+    hvar = self.acquire(func, parent, name, option)
+    try:
+      return call(hvar)
+    except ORiNException as e:
+      if e.hresult != HResult.E_HANDLE:
+        raise e
+    # ハンドルが無効になっていたので取得し直す. 古いハンドルも解放しておく
+    # (BCAPClientPool では他のセッションではまだ有効なことがある)
+    with self._lock:
+      self.retries += 1
+      if self._entries.get((func, parent, name, option)) == hvar:
+        del self._entries[(func, parent, name, option)]
+        try:
+          getattr(self._client, RELEASE_OF[func])(hvar)
+        except ORiNException:
+          pass
+    return call(self.acquire(func, parent, name, option))
+
+  def _evict(self, key):
+    # このハンドルを親に持つものを先に解放する
+    handle = self._entries.pop(key)
+    for child in [k for k in self._entries if k[1] == handle]:
+      if child in self._entries:
+        self._evict(child)
+    self.evictions += 1
+    try:
+      getattr(self._client, RELEASE_OF[key[0]])(handle)
+    except ORiNException:
+      pass
@@ -0,0 +1,320 @@
+# -*- coding:utf-8 -*-
+# 同一コントローラへの複数 b-CAP セッション
+#   ハンドル取得系 (controller_connect, *_getrobot 等) は親ハンドルを持つ全セッションで実行し,
+#   論理ハンドルから各セッションの実ハンドルへの対応表を持つ.
+#   それ以外の呼び出しは空いているセッション (ハンドルが一部のセッションにしかなければそのどれか) に振り分ける.
+#   全セッションでの実行はセッションを 1 つずつ順に借りて行うので, connection() で占有中の
+#   セッションがあればその返却を待つ (借りているスレッド自身からの呼び出しはそのセッションをそのまま使う).
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock, get_ident
+from bcapclient import BCAPClient, RELEASE_OF
+from orinexception import *
+
+class BCAPClientPool:
+  _PREFIXES = ("service", "controller", "extension", "file", "robot",
+               "task", "variable", "command", "message")
+
+  _ACQUIRE = {
+    "controller_connect",
+    "controller_getextension", "controller_getfile", "controller_getrobot",
+    "controller_gettask", "controller_getvariable", "controller_getcommand",
+    "controller_getmessage",
+    "extension_getvariable",
+    "file_getfile", "file_getvariable",
+    "robot_getvariable",
+    "task_getvariable",
+  }
+
+  # 1 セッションだけで取得するもの. controller_getmessage は呼ぶたびにコントローラの
+  # メッセージを取り出すので, 全セッションで呼ぶと別々のメッセージになってしまう
+  _SINGLE = {"controller_getmessage"}
+
+  _RELEASE = {
+    "controller_disconnect",
+    "extension_release", "file_release", "robot_release", "task_release",
+    "variable_release", "command_release", "message_release",
+  }
+
+  _BROADCAST = {"service_start", "service_stop"}
+
+  def __init__(self, host, port, timeout, size = 2):
+    self._clients     = []
+    self._handles     = []
+    self._released    = {}  # 論理ハンドル -> 解放に使う関数名 (取得順)
+    self._free        = []
+    self._held        = {}  # スレッド ID -> そのスレッドが借りているセッション
+    self._lock        = Lock()
+    self._available   = Condition(Lock())
+    self._next_handle = 1
+
+    self._calls      = [0] * size
+    self._busy       = [0.0] * size
+    self._wait_count = 0
+    self._wait_total = 0.0
+    self._wait_max   = 0.0
+    self._t_open     = time.perf_counter()
+
+    try:
+      for i in range(size):
+        self._clients.append(BCAPClient(host, port, timeout))
+        self._handles.append({})
+        self._free.append(i)
+    except OSError as e:
+      for client in self._clients:
+        client.close()
+      self._clients = []
+      raise e
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __len__(self):
+    return len(self._clients)
+
+  def __getattr__(self, name):
+    if name.startswith("_") or (name.split("_")[0] not in self._PREFIXES) \
+        or not hasattr(BCAPClient, name):
+      raise AttributeError(name)
+
+    if name in self._BROADCAST:
+      return lambda *args, **kwargs: self._broadcast(name, args, kwargs)
+    elif name in self._ACQUIRE:
+      return lambda *args, **kwargs: self._acquire_handle(name, args, kwargs)
+    elif name in self._RELEASE:
+      return lambda *args, **kwargs: self._release_handle(name, args, kwargs)
+    else:
+      return lambda *args, **kwargs: self._route(name, args, kwargs)
+
+  def close(self):
+    # 取得したハンドルを新しいものから解放し, 各セッションを切断する.
+    # 解放に失敗しても (切断済み等) 切断は行う
+    for handle in reversed(list(self._released)):
+      try:
+        self._release_handle(self._released[handle], (handle, ), {})
+      except (ORiNException, OSError):
+        pass
+    for client in self._clients:
+      client.close()
+    self._clients = []
+    self._handles = []
+    self._released = {}
+
+  def settimeout(self, timeout):
+    for client in self._clients:
+      client.settimeout(timeout)
+
+  def gettimeout(self):
+    return self._clients[0].gettimeout()
+
+  @contextmanager
+  def connection(self):
+    # 1 セッションを占有する (TakeArm 〜 robot_move のように同じセッションで
+    # 続けて呼ぶ必要がある処理用)
+    with self._session(exclusive=True) as index:
+      yield _PinnedConnection(self, index)
+
+  def stats(self):
+    elapsed = time.perf_counter() - self._t_open
+    with self._lock:
+      wait = {
+        "count": self._wait_count,
+        "total": self._wait_total,
+        "mean" : self._wait_total / self._wait_count if self._wait_count else 0.0,
+        "max"  : self._wait_max,
+      }
+      connections = []
+      for i in range(len(self._clients)):
+        connections.append({
+          "calls"      : self._calls[i],
+          "busy"       : self._busy[i],
+          "utilisation": self._busy[i] / elapsed if elapsed > 0 else 0.0,
+        })
+    return {"elapsed": elapsed, "wait": wait, "connections": connections}
+
+  def _checkout(self, candidates = None):
+    # 空いているセッションを借りる. candidates を指定したらその中から
+    t0 = time.perf_counter()
+    with self._available:
+      while True:
+        index = next((i for i in self._free
+                      if (candidates is None) or (i in candidates)), None)
+        if index is not None:
+          break
+        self._available.wait()
+      self._free.remove(index)
+    wait = time.perf_counter() - t0
+    with self._lock:
+      self._wait_count += 1
+      self._wait_total += wait
+      if wait > self._wait_max:
+        self._wait_max = wait
+    return index
+
+  def _checkin(self, index):
+    with self._available:
+      self._free.append(index)
+      self._available.notify_all()
+
+  @contextmanager
+  def _session(self, candidates = None, exclusive = False):
+    # このスレッドが借りているセッションが候補にあればそれを, なければ空いているものを借りる
+    held = self._held.setdefault(get_ident(), [])
+    if not exclusive:
+      for index in held:
+        if (candidates is None) or (index in candidates):
+          yield index
+          return
+    index = self._checkout(candidates)
+    held.append(index)
+    try:
+      yield index
+    finally:
+      held.remove(index)
+      if not held:
+        del self._held[get_ident()]
+      self._checkin(index)
+
+  def _invoke(self, index, name, args, kwargs):
+    t0 = time.perf_counter()
+    try:
+      return getattr(self._clients[index], name)(*args, **kwargs)
+    finally:
+      busy = time.perf_counter() - t0
+      with self._lock:
+        self._calls[index] += 1
+        self._busy[index]  += busy
+
+  def _handle_of(self, name, args, kwargs):
+    # 呼び出しの対象 (第 1 引数) の論理ハンドル. なければ None
+    if name == "controller_connect":
+      return None
+    if len(args) > 0:
+      return args[0]
+    return kwargs.get("handle")
+
+  def _translate(self, index, name, args, kwargs):
+    handle = self._handle_of(name, args, kwargs)
+    if handle is None:
+      return (args, kwargs)
+    handles = self._handles[index]
+    if handle not in handles:
+      raise ORiNException(HResult.E_HANDLE)
+    if len(args) > 0:
+      return ((handles[handle], ) + tuple(args[1:]), kwargs)
+    return (args, dict(kwargs, handle=handles[handle]))
+
+  def _owners(self, name, args, kwargs):
+    # 対象のハンドルを持っているセッション (ハンドルを取らない呼び出しなら全セッション)
+    handle = self._handle_of(name, args, kwargs)
+    if handle is None:
+      return list(range(len(self._clients)))
+    owners = [i for i in range(len(self._clients)) if handle in self._handles[i]]
+    if not owners:
+      raise ORiNException(HResult.E_HANDLE)
+    return owners
+
+  def _new_handle(self):
+    with self._lock:
+      handle = self._next_handle
+      self._next_handle += 1
+    return handle
+
+  def _broadcast(self, name, args, kwargs):
+    for index in range(len(self._clients)):
+      with self._session([index]):
+        self._invoke(index, name, args, kwargs)
+
+  def _route(self, name, args, kwargs):
+    owners = self._owners(name, args, kwargs)
+    candidates = None if len(owners) == len(self._clients) else owners
+    if name.endswith("_nowait"):
+      return self._route_nowait(name, args, kwargs, candidates)
+    with self._session(candidates) as index:
+      return self._invoke(index, name, *self._translate(index, name, args, kwargs))
+
+  def _route_nowait(self, name, args, kwargs, candidates):
+    # *_nowait は送信だけで戻るので, 動作が終わる (Future が完了する) までセッションを返さない.
+    # このスレッドが借りているセッションならそのまま使う (返すのは借りた側)
+    for index in self._held.get(get_ident(), []):
+      if (candidates is None) or (index in candidates):
+        return self._invoke(index, name, *self._translate(index, name, args, kwargs))
+    index = self._checkout(candidates)
+    try:
+      future = self._invoke(index, name, *self._translate(index, name, args, kwargs))
+    except BaseException as e:
+      self._checkin(index)
+      raise e
+    future.add_done_callback(lambda future: self._checkin(index))
+    return future
+
+  def _acquire_handle(self, name, args, kwargs):
+    owners = self._owners(name, args, kwargs)
+    if name in self._SINGLE:
+      with self._session(owners) as index:
+        return self._acquire_on([index], name, args, kwargs)
+    return self._acquire_on(owners, name, args, kwargs)
+
+  def _acquire_on(self, indices, name, args, kwargs):
+    handle = self._new_handle()
+    self._released[handle] = RELEASE_OF[name]
+    try:
+      for index in indices:
+        with self._session([index]):
+          self._handles[index][handle] \
+            = self._invoke(index, name, *self._translate(index, name, args, kwargs))
+    except ORiNException as e:
+      self._release_on(indices, RELEASE_OF[name], (handle, ), {})
+      raise e
+    return handle
+
+  def _release_handle(self, name, args, kwargs):
+    handle = self._handle_of(name, args, kwargs)
+    self._release_on([i for i in range(len(self._clients))
+                      if handle in self._handles[i]], name, args, kwargs)
+
+  def _release_on(self, indices, name, args, kwargs):
+    handle = self._handle_of(name, args, kwargs)
+    error = None
+    for index in indices:
+      if handle in self._handles[index]:
+        try:
+          with self._session([index]):
+            self._invoke(index, name, *self._translate(index, name, args, kwargs))
+        except ORiNException as e:
+          # 一部のセッションで無効になっていても残りのセッションの分は解放する
+          error = error or e
+        del self._handles[index][handle]
+    if not any(handle in handles for handles in self._handles):
+      self._released.pop(handle, None)
+    if error is not None:
+      raise error
+
+class _PinnedConnection:
+  # BCAPClientPool.connection() が返す, 1 セッションに固定した呼び出し口.
+  # ここで取得したハンドルはこのセッションでのみ有効 (プールから呼んでもこのセッションに振り分ける).
+  def __init__(self, pool, index):
+    self._pool  = pool
+    self._index = index
+
+  @property
+  def index(self):
+    # 占有しているセッションの番号 (0 〜 len(pool) - 1)
+    return self._index
+
+  def __getattr__(self, name):
+    pool = self._pool
+    if name.startswith("_") or (name.split("_")[0] not in pool._PREFIXES) \
+        or not hasattr(BCAPClient, name):
+      raise AttributeError(name)
+
+    if name in pool._ACQUIRE:
+      return lambda *args, **kwargs: pool._acquire_on([self._index], name, args, kwargs)
+    elif name in pool._RELEASE:
+      return lambda *args, **kwargs: pool._release_on([self._index], name, args, kwargs)
+    else:
+      return lambda *args, **kwargs: pool._invoke(self._index, name,
+        *pool._translate(self._index, name, args, kwargs))
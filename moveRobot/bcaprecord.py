@@ -0,0 +1,232 @@
+# -*- coding:utf-8 -*-
+# b-CAP セッションの記録と再生
+#   CaptureWriter : BCAPClient.setcapture() に渡すと送受信フレームをそのまま記録する
+#   replay        : 記録したセッションをローカルのスタンドインサーバ相手に再実行する
+#                   (応答内容と処理時間は記録どおり, 要求は現在のコーデックで作り直す)
+#   python bcaprecord.py info <file>
+#   python bcaprecord.py replay <file> [speed]
+#
+# ファイル形式 (リトルエンディアン)
+#   ヘッダ   : "BCAPCAP1", 記録開始時刻 time.time_ns() (q)
+#   レコード : 方向 (B, 0=送信 1=受信), 記録開始からの経過 [ns] (q), 長さ (I), フレーム
+import struct
+import sys
+import time
+from threading import Lock
+from bcapclient import BCAPClient, FUNC_NAMES
+from orinexception import *
+
+_MAGIC     = b"BCAPCAP1"
+_ST_HEADER = struct.Struct("<8sq")
+_ST_RECORD = struct.Struct("<BqI")
+
+class CaptureWriter:
+  SENT     = 0
+  RECEIVED = 1
+
+  def __init__(self, path):
+    self._lock = Lock()
+    self._file = open(path, "wb")
+    self._t0   = time.monotonic_ns()
+    self.started = time.time_ns()
+    self.frames  = 0
+    self._file.write(_ST_HEADER.pack(_MAGIC, self.started))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def write(self, direction, frame):
+    t = time.monotonic_ns() - self._t0
+    with self._lock:
+      if self._file is None:
+        return
+      self._file.write(_ST_RECORD.pack(direction, t, len(frame)))
+      self._file.write(frame)
+      self.frames += 1
+
+  def flush(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.flush()
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+def read_capture(path):
+  # (記録開始時刻 [ns], [(方向, 経過 [ns], フレーム), ...])
+  with open(path, "rb") as f:
+    data = f.read()
+  (magic, started) = _ST_HEADER.unpack_from(data, 0)
+  if magic != _MAGIC:
+    raise ValueError("not a b-CAP capture: %s" % path)
+
+  records = []
+  offset = _ST_HEADER.size
+  while offset + _ST_RECORD.size <= len(data):
+    (direction, t, len_frame) = _ST_RECORD.unpack_from(data, offset)
+    offset += _ST_RECORD.size
+    if offset + len_frame > len(data):
+      break  # 書きかけのレコード (記録中に異常終了した場合)
+    records.append((direction, t, data[offset:offset + len_frame]))
+    offset += len_frame
+  return (started, records)
+
+def load_session(path):
+  # 要求と最終応答を serial で対にする.
+  # [{"funcid", "args", "t_sent", "t_reply", "hresult", "retvals", "keepalives"}, ...]
+  (started, records) = read_capture(path)
+  c = BCAPClient.codec()
+  calls   = []
+  pending = {}
+  for (direction, t, frame) in records:
+    (serial, version, code, values) = c._deserialize(frame)
+    if direction == CaptureWriter.SENT:
+      call = {"serial": serial, "funcid": code, "args": values, "t_sent": t,
+              "t_reply": None, "hresult": None, "retvals": None, "keepalives": 0}
+      pending[serial] = call
+      calls.append(call)
+    elif serial in pending:
+      call = pending[serial]
+      if code == HResult.S_EXECUTING:
+        call["keepalives"] += 1
+      else:
+        call["t_reply"] = t
+        call["hresult"] = code
+        call["retvals"] = values
+        del pending[serial]
+  return [call for call in calls if call["t_reply"] is not None]
+
+def summarize(calls):
+  # funcid ごとの {回数, 記録時の平均応答時間 [s]}
+  result = {}
+  for call in calls:
+    (count, total) = result.get(call["funcid"], (0, 0))
+    result[call["funcid"]] = (count + 1, total + call["t_reply"] - call["t_sent"])
+  return {FUNC_NAMES.get(funcid, str(funcid)): {"count": count, "mean": total / count / 1e9}
+          for (funcid, (count, total)) in result.items()}
+
+class ReplayHandlers:
+  # 記録した応答を funcid ごとに記録順に返すハンドラを server (bcapserver.BCAPServer) に登録する.
+  # 応答までの時間は記録時の応答時間 / speed.
+  def __init__(self, server, calls, speed = 1.0):
+    self.mismatches = 0
+    self._replies = {}
+    self._lock    = Lock()
+    for call in calls:
+      self._replies.setdefault(call["funcid"], []).append(call)
+    for funcid in self._replies:
+      server.set_handler(funcid, self._replier(funcid, speed))
+
+  def _replier(self, funcid, speed):
+    replies = self._replies[funcid]
+    def reply(args):
+      with self._lock:
+        if not replies:
+          self.mismatches += 1
+          raise ORiNException(HResult.E_FAIL)
+        call = replies.pop(0)
+      time.sleep((call["t_reply"] - call["t_sent"]) / 1e9 / speed)
+      if HResult.failed(call["hresult"]):
+        raise ORiNException(call["hresult"])
+      return call["retvals"][0] if call["retvals"] else None
+    return reply
+
+def replay(path, speed = 1.0, timeout = 2, keepalive = None, client = BCAPClient):
+  # 記録どおりの間隔 (/ speed) で要求を出し直し, 呼び出しごとの応答時間を比べる.
+  # 前の呼び出しが終わっていなければ次の要求はその完了を待つ.
+  calls = load_session(path)
+  if not calls:
+    return {"calls": 0}
+
+  # スタンドインサーバは再生のときだけ使う
+  from bcapserver import BCAPServer
+
+  results = []
+  server = BCAPServer(keepalive=keepalive)
+  handlers = ReplayHandlers(server, calls, speed)
+  with server:
+    c = client(server.host, server.port, timeout)
+    try:
+      t_origin = calls[0]["t_sent"]
+      t_start  = time.perf_counter()
+      late_max = 0.0
+      for call in calls:
+        deadline = t_start + (call["t_sent"] - t_origin) / 1e9 / speed
+        now = time.perf_counter()
+        if now < deadline:
+          time.sleep(deadline - now)
+        else:
+          late_max = max(late_max, now - deadline)
+
+        t0 = time.perf_counter()
+        try:
+          c._send_and_recv(call["funcid"], call["args"])
+        except ORiNException:
+          pass
+        results.append((call["funcid"], (call["t_reply"] - call["t_sent"]) / 1e9,
+                        time.perf_counter() - t0))
+      elapsed = time.perf_counter() - t_start
+    finally:
+      c.close()
+    mismatches = handlers.mismatches
+
+  recorded = (calls[-1]["t_reply"] - t_origin) / 1e9
+  per_func = {}
+  for (funcid, t_rec, t_rep) in results:
+    entry = per_func.setdefault(FUNC_NAMES.get(funcid, str(funcid)),
+                                {"count": 0, "recorded": 0.0, "replayed": 0.0})
+    entry["count"]    += 1
+    entry["recorded"] += t_rec
+    entry["replayed"] += t_rep
+  for entry in per_func.values():
+    entry["recorded"] /= entry["count"]
+    entry["replayed"] /= entry["count"]
+
+  return {
+    "calls"     : len(results),
+    "speed"     : speed,
+    "recorded"  : recorded,
+    "replayed"  : elapsed,
+    "late_max"  : late_max,
+    "mismatches": mismatches,
+    "functions" : per_func,
+  }
+
+def _print_functions(functions, columns):
+  print("%-28s %7s" % ("function", "count") + "".join(" %12s" % c for c in columns))
+  for (name, entry) in sorted(functions.items(), key=lambda kv: -kv[1]["count"]):
+    print("%-28s %7d" % (name, entry["count"])
+          + "".join(" %12.1f" % (entry[c] * 1e6) for c in columns))
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3 or sys.argv[1] not in ("info", "replay"):
+    print("usage: python bcaprecord.py info <file>")
+    print("       python bcaprecord.py replay <file> [speed]")
+    sys.exit(1)
+
+  if sys.argv[1] == "info":
+    (started, records) = read_capture(sys.argv[2])
+    calls = load_session(sys.argv[2])
+    print("started : %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started / 1e9)))
+    print("frames  : %d" % len(records))
+    print("calls   : %d" % len(calls))
+    if calls:
+      print("duration: %.3f s" % ((calls[-1]["t_reply"] - calls[0]["t_sent"]) / 1e9))
+      functions = {name: {"count": s["count"], "mean": s["mean"]}
+                   for (name, s) in summarize(calls).items()}
+      _print_functions(functions, ["mean"])
+  else:
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    result = replay(sys.argv[2], speed)
+    print("calls     : %d (mismatches %d)" % (result["calls"], result.get("mismatches", 0)))
+    if result["calls"]:
+      print("recorded  : %.3f s" % result["recorded"])
+      print("replayed  : %.3f s (x%g, start late max %.1f us)"
+            % (result["replayed"], speed, result["late_max"] * 1e6))
+      _print_functions(result["functions"], ["recorded", "replayed"])
@@ -0,0 +1,266 @@
+# -*- coding:utf-8 -*-
+# 接続が切れたら自動で再接続する BCAPClient
+#   service_start / controller_connect / *_get* の呼び出しを順に記録しておき,
+#   再接続後に同じ順で取り直す. 利用側には論理ハンドル (BCAPClientPool と同じく 1 からの連番) を
+#   返し, 呼び出しのたびに現在の実ハンドルに置き換える.
+#   TakeArm / ExtSpeed 等の状態を変えるコマンドも最後の呼び出しを記録して再実行する.
+#   Motor は restore_motor=True のときだけ再実行する (切断中に非常停止・手動操作があっても
+#   再接続しただけでモータ電源が入らないように. 既定では再接続後にモータをオンし直すのは利用側).
+#   読み出し系の呼び出しは再接続後にやり直し, それ以外は E_NOT_CONNECTED を送出する
+#   (動作指令が届いたか分からないため. 再接続は済んでいるのですぐに指令し直せる).
+#   give_up で再接続を諦めた後も, 次の呼び出しでまた再接続を試みる.
+#   再接続の待ちの間も _lock は持たないので, 他のスレッドの記録や close() は止まらない.
+import inspect
+import time
+from threading import Event, Lock, RLock, Thread
+from bcapclient import BCAPClient
+from bcappool import BCAPClientPool
+from orinexception import *
+
+class ResilientBCAPClient:
+  _LOST = {HResult.E_NOT_CONNECTED, HResult.E_TIMEOUT}
+
+  _RESTORE = ("TakeArm", "GiveArm", "ExtSpeed")
+
+  _SAFE_COMMANDS = {"CurPos", "CurJnt", "CurTrn", "CurFig", "MPS", "DevH", "Dev",
+                    "slvGetMode", "GetSrvState"}
+
+  _SETTINGS = ("settimeout", "setndarray", "settrace", "setcapture", "setcache")
+
+  def __init__(self, host, port, timeout, backoff = 0.05, backoff_max = 2.0,
+               give_up = 60.0, heartbeat = None, restore_motor = False, **options):
+    # backoff   : 再接続の待ち時間の初期値 [s] (失敗ごとに倍, backoff_max まで)
+    # give_up   : この時間 [s] 再接続できなければ諦めて例外を送出する
+    # heartbeat : この間隔 [s] で controller_getname を呼び, 指令がなくても切断を検知する
+    # restore_motor : 再接続後に最後の Motor も再実行する
+    # options   : BCAPClient にそのまま渡す (transport 等)
+    self._host        = host
+    self._port        = port
+    self._timeout     = timeout
+    self._options     = options
+    self._backoff     = backoff
+    self._backoff_max = backoff_max
+    self._give_up     = give_up
+    self._commands    = self._RESTORE + (("Motor", ) if restore_motor else ())
+
+    self._lock       = RLock()
+    self._reconnecting = Lock()  # 再接続は 1 スレッドずつ
+    self._generation = 0
+    self._service    = None
+    self._chain      = {}  # 論理ハンドル -> (関数名, 引数 (親は論理ハンドル))
+    self._handles    = {}  # 論理ハンドル -> 実ハンドル
+    self._restore    = {}  # (論理ハンドル, コマンド) -> (順番, 引数)
+    self._settings   = {}
+    self._seq        = 0
+    self._next_handle = 1
+    self.recoveries  = []
+
+    self._client = BCAPClient(host, port, timeout, **options)
+
+    self._stop_event = Event()
+    self._heartbeat  = None
+    if heartbeat is not None:
+      self._heartbeat = Thread(target=self._heartbeat_task, args=(heartbeat, ), daemon=True)
+      self._heartbeat.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __getattr__(self, name):
+    if name in self._SETTINGS:
+      return lambda *args, **kwargs: self._setting(name, self._positional(name, args, kwargs))
+    if name.startswith("_") or (name.split("_")[0] not in BCAPClientPool._PREFIXES) \
+        or not hasattr(BCAPClient, name):
+      raise AttributeError(name)
+    return lambda *args, **kwargs: self._call(name, self._positional(name, args, kwargs))
+
+  def close(self):
+    self._stop_event.set()
+    if self._heartbeat is not None:
+      self._heartbeat.join()
+      self._heartbeat = None
+    with self._lock:
+      if self._client is not None:
+        self._client.close()
+      self._client = None
+
+  def gettimeout(self):
+    return self._timeout
+
+  def stats(self):
+    downtimes = [r["downtime"] for r in self.recoveries]
+    return {
+      "reconnects"   : len(self.recoveries),
+      "downtime_mean": sum(downtimes) / len(downtimes) if downtimes else 0.0,
+      "downtime_max" : max(downtimes) if downtimes else 0.0,
+      "recoveries"   : list(self.recoveries),
+    }
+
+  def _positional(self, name, args, kwargs):
+    # キーワード引数も位置引数に直す (記録・再実行は位置引数で行う)
+    if not kwargs:
+      return args
+    return tuple(inspect.signature(getattr(BCAPClient, name)).bind(None, *args, **kwargs).args[1:])
+
+  def _setting(self, name, args):
+    with self._lock:
+      if name == "settimeout":
+        self._timeout = args[0]
+      self._settings[name] = args
+      if self._client is not None:
+        return getattr(self._client, name)(*args)
+
+  def _connection(self):
+    # (世代, 現在の接続). 再接続を諦めた後なら接続は None
+    with self._lock:
+      return (self._generation, self._client)
+
+  def _call(self, name, args):
+    (generation, client) = self._connection()
+    try:
+      if client is None:
+        # 前回の再接続を諦めた (または再接続中): この呼び出しで再接続する
+        raise ORiNException(HResult.E_NOT_CONNECTED)
+      result = getattr(client, name)(*self._translate(name, args))
+    except (OSError, ORiNException) as e:
+      if isinstance(e, ORiNException) and (e.hresult not in self._LOST):
+        raise e
+      self._reconnect(generation, e)
+      if not self._safe(name, args):
+        raise ORiNException(HResult.E_NOT_CONNECTED)
+      (generation, client) = self._connection()
+      if client is None:
+        raise ORiNException(HResult.E_NOT_CONNECTED)
+      result = getattr(client, name)(*self._translate(name, args))
+    return self._record(name, args, result)
+
+  def _safe(self, name, args):
+    if name == "robot_execute":
+      return args[1] in self._SAFE_COMMANDS
+    return ("_get" in name) or (name == "service_start")
+
+  def _translate(self, name, args):
+    with self._lock:
+      return self._translate_locked(name, args)
+
+  def _translate_locked(self, name, args):
+    if (len(args) == 0) or name.startswith("service") or (name == "controller_connect"):
+      return args
+    if args[0] not in self._handles:
+      raise ORiNException(HResult.E_HANDLE)
+    return (self._handles[args[0]], ) + tuple(args[1:])
+
+  def _record(self, name, args, result):
+    with self._lock:
+      self._seq += 1
+      if name == "service_start":
+        self._service = args
+      elif name == "service_stop":
+        self._service = None
+      elif name in BCAPClientPool._ACQUIRE:
+        handle = self._next_handle
+        self._next_handle += 1
+        self._chain[handle]   = (name, args)
+        self._handles[handle] = result
+        return handle
+      elif name in BCAPClientPool._RELEASE:
+        self._forget(args[0])
+      elif (name == "robot_execute") and (args[1] in self._commands):
+        command = "TakeArm" if args[1] == "GiveArm" else args[1]
+        self._restore[(args[0], command)] = (self._seq, args)
+      return result
+
+  def _forget(self, handle):
+    self._chain.pop(handle, None)
+    self._handles.pop(handle, None)
+    for key in [key for key in self._restore if key[0] == handle]:
+      del self._restore[key]
+    for child in [h for (h, (name, args)) in self._chain.items()
+                  if (name != "controller_connect") and (args[0] == handle)]:
+      self._forget(child)
+
+  def _reconnect(self, generation, error):
+    with self._reconnecting:
+      if generation != self._generation:
+        return  # 他のスレッドが再接続済み
+      t_lost   = time.perf_counter()
+      delay    = self._backoff
+      attempts = 0
+      # 切れた接続のソケットは閉じる (相手側に半開きのまま残さない)
+      with self._lock:
+        (old, self._client) = (self._client, None)
+      if old is not None:
+        old.close()
+      while True:
+        attempts += 1
+        if self._stop_event.is_set():
+          raise ORiNException(HResult.E_NOT_CONNECTED)  # close() された
+        try:
+          (client, handles) = self._replay()
+          break
+        except (OSError, ORiNException) as e:
+          if time.perf_counter() - t_lost + delay > self._give_up:
+            raise ORiNException(HResult.E_NOT_CONNECTED) from e
+          # close() で待ちを打ち切れるように Event で待つ
+          self._stop_event.wait(delay)
+          delay = min(delay * 2, self._backoff_max)
+
+      with self._lock:
+        if self._stop_event.is_set():
+          client.close()
+          raise ORiNException(HResult.E_NOT_CONNECTED)
+        self._client  = client
+        self._handles = handles
+        self._generation += 1
+      if self._settings.get("setcache", (None, ))[0] is not None:
+        # 実ハンドルが変わったので前の接続での結果は使えない
+        self._settings["setcache"][0].invalidate()
+      self.recoveries.append({
+        "time"    : time.time(),
+        "error"   : repr(error),
+        "attempts": attempts,
+        "downtime": time.perf_counter() - t_lost,
+      })
+
+  def _replay(self):
+    with self._lock:
+      settings = list(self._settings.items())
+      service  = self._service
+      chain    = list(self._chain.items())
+      restore  = sorted(self._restore.values(), key=lambda entry: entry[0])
+      timeout  = self._timeout
+    client = BCAPClient(self._host, self._port, timeout, **self._options)
+    try:
+      for (name, args) in settings:
+        getattr(client, name)(*args)
+      if service is not None:
+        client.service_start(*service)
+
+      handles = {}
+      for (handle, (name, args)) in chain:
+        if name != "controller_connect":
+          args = (handles[args[0]], ) + tuple(args[1:])
+        handles[handle] = getattr(client, name)(*args)
+
+      for (seq, args) in restore:
+        client.robot_execute(handles[args[0]], *args[1:])
+    except (OSError, ORiNException) as e:
+      # 途中で失敗した接続は閉じてから次の試行に移る
+      client.close()
+      raise e
+    return (client, handles)
+
+  def _heartbeat_task(self, interval):
+    while not self._stop_event.wait(interval):
+      with self._lock:
+        hctrl = next((h for (h, (name, args)) in self._chain.items()
+                      if name == "controller_connect"), None)
+      if hctrl is None:
+        continue
+      try:
+        self._call("controller_getname", (hctrl, ))
+      except (OSError, ORiNException):
+        pass
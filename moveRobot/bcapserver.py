@@ -0,0 +1,406 @@
+# -*- coding:utf-8 -*-
+# ローカル用 b-CAP スタンドインサーバ (実機 10.1.1.190 なしでの動作確認・ベンチマーク用)
+#   BCAPServer     : パケット形式・シリアル番号のエコー・S_EXECUTING の送信 (TCP / UDP)
+#   SimulatedRobot : コントローラ/ロボットの模擬 (コマンドごとの遅延を設定可能)
+import math
+import re
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from queue import SimpleQueue
+from threading import Event, Lock, Thread
+from bcapclient import BCAPClient, FUNC_IDS
+from orinexception import *
+
+class BCAPServer:
+  def __init__(self, host = "127.0.0.1", port = 0, keepalive = None, udp = False,
+               pipeline = False):
+    # keepalive: 処理中にこの間隔 [s] で S_EXECUTING を返す (None なら送らない)
+    # pipeline : True なら同じ TCP 接続の要求を前の応答を待たずに並行して処理する
+    #   (応答は処理の終わった順. シリアル番号で応答を振り分けるクライアントの確認用)
+    # udp      : True なら同じポート番号で UDP も受け付ける
+    #   UDP では (送信元, シリアル番号) で再送を見分け, 処理中なら無視,
+    #   処理済みなら前回の応答を送り直す (ハンドラは 1 回しか呼ばない)
+    self._keepalive = keepalive
+    self._pipeline  = pipeline
+    self._executor  = ThreadPoolExecutor() if keepalive is not None else None
+    self.requests   = 0
+    self.keepalives = 0
+    self.duplicates = 0
+    self.drop       = None  # drop(packet) が True の UDP パケットは捨てる (パケットロスの模擬)
+    self._handlers = {}
+    self._commands = {}
+    self._clients  = []
+    self._running  = False
+    self._thread   = None
+
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind((host, port))
+    self._sock.listen()
+    (self.host, self.port) = self._sock.getsockname()
+
+    self._udp_sock   = None
+    self._udp_thread = None
+    self._udp_peers  = {}
+    self._udp_lock   = Lock()
+    if udp:
+      self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self._udp_sock.bind((self.host, self.port))
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def set_handler(self, funcid, handler):
+    # handler(args) -> 戻り値 (None なら戻り値なし)
+    self._handlers[funcid] = handler
+
+  def set_command(self, name, handler):
+    # controller_execute / robot_execute のコマンド名ごとのハンドラ
+    self._commands[name] = handler
+
+  def start(self):
+    self._running = True
+    self._thread = Thread(target=self._accept_task, daemon=True)
+    self._thread.start()
+    if self._udp_sock is not None:
+      self._udp_thread = Thread(target=self._udp_task, daemon=True)
+      self._udp_thread.start()
+
+  def stop(self):
+    self._running = False
+    try:
+      self._sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    try:
+      self._sock.close()
+    finally:
+      for conn in self._clients:
+        try:
+          conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+        conn.close()
+      self._clients = []
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    if self._udp_sock is not None:
+      # close だけでは recvfrom が戻らないので空のデータグラムで起こす
+      if self._udp_thread is not None:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as wake:
+          wake.sendto(b"", (self.host, self.port))
+        self._udp_thread.join()
+        self._udp_thread = None
+      self._udp_sock.close()
+    if self._executor is not None:
+      self._executor.shutdown(wait=False)
+
+  def _accept_task(self):
+    while self._running:
+      try:
+        (conn, addr) = self._sock.accept()
+      except OSError:
+        break
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self._clients.append(conn)
+      Thread(target=self._client_task, args=(conn,), daemon=True).start()
+
+  def _client_task(self, conn):
+    c = BCAPClient.codec()
+    lock = Lock()
+    def send(buf):
+      with lock:
+        conn.sendall(buf)
+    try:
+      while self._running:
+        head = self._recv_exact(conn, 5)
+        if head is None:
+          break
+        (len_frame, ) = struct.unpack_from("<I", head, 1)
+        body = self._recv_exact(conn, len_frame - 5)
+        if body is None:
+          break
+
+        (serial, version, funcid, args) = c._deserialize(head + body)
+        self.requests += 1
+        if self._pipeline:
+          Thread(target=self._pipeline_task, args=(send, serial, version, funcid, args),
+                 daemon=True).start()
+        else:
+          send(self._respond(c, send, serial, version, funcid, args))
+    except OSError:
+      pass
+    finally:
+      conn.close()
+
+  def _pipeline_task(self, send, serial, version, funcid, args):
+    try:
+      send(self._respond(BCAPClient.codec(), send, serial, version, funcid, args))
+    except OSError:
+      pass
+
+  def _respond(self, c, send, serial, version, funcid, args):
+    # 処理結果の応答パケット (bytes) を返す. 処理中は keepalive ごとに S_EXECUTING を送る
+    if self._executor is None:
+      (hresult, retvals) = self._dispatch(funcid, args)
+    else:
+      future = self._executor.submit(self._dispatch, funcid, args)
+      while True:
+        try:
+          (hresult, retvals) = future.result(self._keepalive)
+          break
+        except FutureTimeout:
+          send(c._serialize(serial, version, HResult.S_EXECUTING, []))
+          self.keepalives += 1
+    return bytes(c._serialize(serial, version, hresult, retvals))
+
+  def _udp_task(self):
+    # 受信とシリアル番号による重複判定だけ行い, 処理は送信元ごとのスレッドに渡す
+    # (TCP の接続ごとのスレッドと同じく, 送信元ごとに要求を順に処理する)
+    c = BCAPClient.codec()
+    while self._running:
+      try:
+        (data, addr) = self._udp_sock.recvfrom(65536)
+      except OSError:
+        break
+      if (self.drop is not None) and self.drop(data):
+        continue
+      try:
+        (serial, version, funcid, args) = c._deserialize(data)
+      except (ORiNException, struct.error):
+        continue
+
+      with self._udp_lock:
+        peer = self._udp_peers.get(addr)
+        if peer is None:
+          peer = [None, None, SimpleQueue()]
+          self._udp_peers[addr] = peer
+          Thread(target=self._udp_peer_task, args=(addr, peer), daemon=True).start()
+        if peer[0] == serial:
+          # 再送: 処理済みなら前回の応答を送り直す
+          self.duplicates += 1
+          if peer[1] is not None:
+            self._udp_send(peer[1], addr)
+          continue
+        peer[0] = serial
+        peer[1] = None
+      self.requests += 1
+      peer[2].put((serial, version, funcid, args))
+    for peer in list(self._udp_peers.values()):
+      peer[2].put(None)
+
+  def _udp_peer_task(self, addr, peer):
+    c = BCAPClient.codec()
+    send = lambda buf: self._udp_send(buf, addr)
+    while True:
+      request = peer[2].get()
+      if request is None:
+        break
+      reply = self._respond(c, send, *request)
+      with self._udp_lock:
+        if peer[0] == request[0]:
+          peer[1] = reply
+      send(reply)
+
+  def _udp_send(self, buf, addr):
+    if (self.drop is not None) and self.drop(buf):
+      return
+    try:
+      self._udp_sock.sendto(buf, addr)
+    except OSError:
+      pass
+
+  _EXECUTE = (17, 64)
+
+  def _dispatch(self, funcid, args):
+    handler = None
+    if (funcid in self._EXECUTE) and (len(args) > 1):
+      handler = self._commands.get(args[1])
+    if handler is None:
+      handler = self._handlers.get(funcid)
+    if handler is None:
+      return (HResult.S_OK, [])
+    try:
+      retval = handler(args)
+    except ORiNException as e:
+      return (e.hresult, [])
+    except Exception:
+      return (HResult.E_FAIL, [])
+    if retval is None:
+      return (HResult.S_OK, [])
+    return (HResult.S_OK, [retval])
+
+  def _recv_exact(self, conn, len_recv):
+    buf = bytearray()
+    while len(buf) < len_recv:
+      data = conn.recv(len_recv - len(buf))
+      if not data:
+        return None
+      buf += data
+    return bytes(buf)
+
+class SlaveModeSimulator:
+  # b-CAP スレーブモード (slvChangeMode / slvMove) の模擬.
+  # モード 0 (同期) では slvMove は次の制御周期の境界まで待ってから返る.
+  def __init__(self, server, cycle = 0.008, pose = None):
+    self._cycle   = cycle
+    self._mode    = 0
+    self._pose    = list(pose) if pose is not None else [0.0] * 7
+    self._last    = None
+    self._lock    = Lock()
+    self.moves    = 0
+    self.missed   = 0
+    self.trace    = []
+
+    server.set_command("slvChangeMode", self._change_mode)
+    server.set_command("slvGetMode", lambda args: self._mode)
+    server.set_command("slvMove", self._move)
+    server.set_command("CurPos", lambda args: list(self._pose))
+
+  def _change_mode(self, args):
+    with self._lock:
+      self._mode = int(args[2]) if args[2] is not None else 0
+      self._last = None
+
+  def _move(self, args):
+    with self._lock:
+      if self._mode == 0:
+        raise ORiNException(HResult.E_ACCESSDENIED)
+
+      now = time.perf_counter()
+      tick = math.ceil(now / self._cycle) * self._cycle
+      time.sleep(max(0.0, tick - now))
+      # 前回の指令から 1 周期以上空いたら周期落ちとして数える
+      if (self._last is not None) and (tick - self._last > self._cycle * 1.5):
+        self.missed += int(round((tick - self._last) / self._cycle)) - 1
+      self._last = tick
+
+      self._pose = list(args[2])
+      self.moves += 1
+      self.trace.append((tick, self._pose))
+      return list(self._pose)
+
+class SimulatedRobot:
+  # コントローラ 1 台 + ロボット 1 台の模擬.
+  #   delays: {メソッド名 または robot_execute のコマンド名: 遅延 [s]}
+  #     例: {"robot_move": 0.5, "CurPos": 0.002}
+  #   variables: コントローラ変数 {名前: 値}
+  def __init__(self, server, pose = None, joints = None, delays = None,
+               variables = None):
+    self.pose      = list(pose) if pose is not None \
+                       else [300.0, 0.0, 400.0, 180.0, 0.0, 180.0, -1.0]
+    self.joints    = list(joints) if joints is not None else [0.0] * 8
+    self.delays    = dict(delays) if delays is not None else {}
+    self.variables = dict(variables) if variables is not None else {}
+    self.motor     = False
+    self.arm       = False
+    self.moves     = 0
+    self.handles   = {}
+
+    self._lock   = Lock()
+    self._halt   = Event()
+    self._next   = 1
+
+    for (name, handler) in [
+        ("service_start"              , lambda args: None),
+        ("service_stop"               , lambda args: None),
+        ("controller_connect"         , lambda args: self._open("controller", args[0])),
+        ("controller_disconnect"      , self._close),
+        ("controller_getrobot"        , lambda args: self._open("robot", args[1])),
+        ("controller_getvariable"     , lambda args: self._open("variable", args[1])),
+        ("controller_getrobotnames"   , lambda args: ["Arm"]),
+        ("controller_getvariablenames", lambda args: list(self.variables)),
+        ("controller_getname"         , lambda args: "RC8"),
+        ("controller_execute"         , self._execute),
+        ("robot_getvariable"          , lambda args: self._open("variable", args[1])),
+        ("robot_getvariablenames"     , lambda args: list(self.variables)),
+        ("robot_execute"              , self._execute),
+        ("robot_halt"                 , self._halt_move),
+        ("robot_getname"              , lambda args: "Arm"),
+        ("robot_release"              , self._close),
+        ("variable_getvalue"          , self._getvalue),
+        ("variable_putvalue"          , self._putvalue),
+        ("variable_release"           , self._close)]:
+      server.set_handler(FUNC_IDS[name], self._delayed(name, handler))
+    # robot_move の遅延は robot_halt で中断できるように _move の中で待つ
+    server.set_handler(FUNC_IDS["robot_move"], self._move)
+
+    for (name, handler) in [
+        ("TakeArm" , lambda args: self._set("arm", True)),
+        ("GiveArm" , lambda args: self._set("arm", False)),
+        ("Motor"   , lambda args: self._set("motor", bool(args[2][0]))),
+        ("CurPos"  , lambda args: list(self.pose)),
+        ("CurJnt"  , lambda args: list(self.joints)),
+        ("MPS"     , lambda args: float(args[2][0]) * 10.0),
+        ("DevH"    , lambda args: self._offset("devh", args[2])),
+        ("Dev"     , lambda args: self._offset("dev", args[2]))]:
+      server.set_command(name, self._delayed(name, handler))
+
+  def _delayed(self, name, handler):
+    def delayed(args):
+      delay = self.delays.get(name, 0.0)
+      if delay > 0:
+        time.sleep(delay)
+      return handler(args)
+    return delayed
+
+  def _open(self, kind, name):
+    with self._lock:
+      handle = self._next
+      self._next += 1
+      self.handles[handle] = (kind, name)
+    return handle
+
+  def _close(self, args):
+    with self._lock:
+      if self.handles.pop(args[0], None) is None:
+        raise ORiNException(HResult.E_HANDLE)
+
+  def _handle(self, handle, kind):
+    entry = self.handles.get(handle)
+    if (entry is None) or (entry[0] != kind):
+      raise ORiNException(HResult.E_HANDLE)
+    return entry[1]
+
+  def _set(self, name, value):
+    setattr(self, name, value)
+
+  def _getvalue(self, args):
+    return self.variables.get(self._handle(args[0], "variable"))
+
+  def _putvalue(self, args):
+    self.variables[self._handle(args[0], "variable")] = args[1]
+
+  def _execute(self, args):
+    raise ORiNException(HResult.E_INVALID_CMD_NAME)
+
+  def _offset(self, func, param):
+    import poselib
+    (p1, p2) = param
+    if isinstance(p2, str):
+      p2 = [float(v) for v in re.findall(r"[-+0-9.eE]+", p2)]
+    return getattr(poselib, func)(p1, p2).tolist()
+
+  def _move(self, args):
+    self._handle(args[0], "robot")
+    if not (self.arm and self.motor):
+      raise ORiNException(HResult.E_ACCESSDENIED)
+    self._halt.clear()
+    if self._halt.wait(self.delays.get("robot_move", 0.0)):
+      raise ORiNException(HResult.E_ABORT)
+    pose = args[2]
+    if isinstance(pose, (list, tuple)) and isinstance(pose[0], (list, tuple)):
+      pose = pose[0]
+    if isinstance(pose, (list, tuple)):
+      self.pose = list(pose) + self.pose[len(pose):]
+    self.moves += 1
+
+  def _halt_move(self, args):
+    self._halt.set()
@@ -0,0 +1,205 @@
+# -*- coding:utf-8 -*-
+# コントローラ変数・ロボット変数の一括取得 (BCAPClientPool の全セッションで並列に読む)
+#   snapshot = Snapshotter(pool, hctrl, hrobot).snapshot()
+#   snapshot.diff(前回の snapshot) で変化した変数が分かる.
+#   incremental=True では最近変化した変数と, 残りのうち一部 (順番に入れ替える) だけを読み直し,
+#   それ以外は前回の値を引き継ぐ (age 列が読んでからの回数).
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from bcaphandles import HandleCache
+from orinexception import *
+
+def _type_name(value):
+  if isinstance(value, (list, tuple)):
+    types = {type(v).__name__ for v in value}
+    return "%s[%d]" % (types.pop() if len(types) == 1 else "variant", len(value))
+  return type(value).__name__
+
+class Snapshot:
+  # 列ごとのリスト (scope, name, type, value, age) を持つ
+  def __init__(self, seq, started, elapsed, scope, name, types, values, age, errors):
+    self.seq     = seq
+    self.started = started
+    self.elapsed = elapsed
+    self.scope   = scope
+    self.name    = name
+    self.type    = types
+    self.value   = values
+    self.age     = age
+    self.errors  = errors
+    self._index  = {key: i for (i, key) in enumerate(zip(scope, name))}
+
+  def __len__(self):
+    return len(self.name)
+
+  def __getitem__(self, key):
+    # snapshot["I1"] (コントローラ変数) / snapshot["robot", "I1"]
+    if isinstance(key, str):
+      key = ("controller", key)
+    return self.value[self._index[key]]
+
+  def keys(self):
+    return list(self._index)
+
+  def diff(self, other):
+    # other (前回) からの変化. {"changed": {(scope, name): (前回, 今回)}, "added": ..., "removed": ...}
+    changed = {}
+    added   = {}
+    for (key, i) in self._index.items():
+      j = other._index.get(key)
+      if j is None:
+        added[key] = self.value[i]
+      elif (other.value[j] != self.value[i]) or (other.type[j] != self.type[i]):
+        changed[key] = (other.value[j], self.value[i])
+    removed = {key: other.value[j] for (key, j) in other._index.items()
+               if key not in self._index}
+    return {"changed": changed, "added": added, "removed": removed}
+
+  def columns(self):
+    return {"scope": self.scope, "name": self.name, "type": self.type,
+            "value": self.value, "age": self.age}
+
+  def numeric(self):
+    # 数値のスカラー変数だけを {(scope, name): float} で返す (bool は除く)
+    return {key: float(self.value[i]) for (key, i) in self._index.items()
+            if isinstance(self.value[i], (int, float)) and not isinstance(self.value[i], bool)}
+
+  def save(self, path):
+    data = {"seq": self.seq, "started": self.started, "elapsed": self.elapsed,
+            "columns": self.columns(),
+            "errors": {"%s:%s" % key: hresult for (key, hresult) in self.errors.items()}}
+    with open(path, "w") as f:
+      json.dump(data, f, indent=1, default=str)
+
+class Snapshotter:
+  def __init__(self, pool, hctrl, hrobot = None, hot_window = 3, cold_cycle = 8,
+               capacity = 4096):
+    # hot_window : 直近この回数のうちに変化した変数は incremental でも毎回読む
+    # cold_cycle : それ以外の変数はこの回数で一巡するように少しずつ読む
+    self._pool       = pool
+    self._hctrl      = hctrl
+    self._hrobot     = hrobot
+    self._hot_window = hot_window
+    self._cold_cycle = cold_cycle
+    self._capacity   = capacity
+    self._caches     = {}
+    self._lock       = Lock()
+    self._executor   = ThreadPoolExecutor(max_workers=len(pool))
+    self._keys       = []
+    self._last       = None
+    self._changed_at = {}
+    self._cold_pos   = 0
+    self._seq        = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    self._executor.shutdown()
+    # セッションを順に占有して, それぞれのキャッシュのハンドルを解放する
+    pending = dict(self._caches)
+    while pending:
+      with self._pool.connection() as conn:
+        cache = pending.pop(conn.index, None)
+        if cache is not None:
+          cache.close()
+    self._caches = {}
+
+  def snapshot(self, incremental = False):
+    self._seq += 1
+    started = time.time()
+    t0 = time.perf_counter()
+
+    if (not incremental) or (self._last is None):
+      self._keys = self._names()
+      targets = list(self._keys)
+    else:
+      targets = self._select()
+
+    (values, errors) = self._read(targets)
+
+    last = self._last
+    scope  = []
+    name   = []
+    types  = []
+    result = []
+    age    = []
+    for key in self._keys:
+      if key in values:
+        value = values[key]
+        scope.append(key[0])
+        name.append(key[1])
+        types.append(_type_name(value))
+        result.append(value)
+        age.append(0)
+        if (last is not None) and (key in last._index) and (last[key] != value):
+          self._changed_at[key] = self._seq
+      else:
+        i = last._index[key]
+        scope.append(key[0])
+        name.append(key[1])
+        types.append(last.type[i])
+        result.append(last.value[i])
+        age.append(last.age[i] + 1)
+
+    snapshot = Snapshot(self._seq, started, time.perf_counter() - t0,
+                        scope, name, types, result, age, errors)
+    self._last = snapshot
+    return snapshot
+
+  def _names(self):
+    keys = [("controller", name)
+            for name in self._pool.controller_getvariablenames(self._hctrl)]
+    if self._hrobot is not None:
+      keys += [("robot", name)
+               for name in self._pool.robot_getvariablenames(self._hrobot)]
+    return keys
+
+  def _select(self):
+    hot  = [key for key in self._keys
+            if self._seq - self._changed_at.get(key, -self._hot_window) <= self._hot_window]
+    hot_set = set(hot)
+    cold = [key for key in self._keys if key not in hot_set]
+    if not cold:
+      return hot
+    count = math.ceil(len(cold) / self._cold_cycle)
+    begin = self._cold_pos % len(cold)
+    self._cold_pos = begin + count
+    return hot + (cold + cold)[begin:begin + count]
+
+  def _read(self, keys):
+    n = len(self._pool)
+    chunks = [keys[i::n] for i in range(n)]
+    values = {}
+    errors = {}
+    for (chunk_values, chunk_errors) in self._executor.map(self._read_chunk, chunks):
+      values.update(chunk_values)
+      errors.update(chunk_errors)
+    return (values, errors)
+
+  def _read_chunk(self, keys):
+    values = {}
+    errors = {}
+    if not keys:
+      return (values, errors)
+    with self._pool.connection() as conn:
+      with self._lock:
+        cache = self._caches.get(conn.index)
+        if cache is None:
+          cache = HandleCache(conn, self._capacity)
+          self._caches[conn.index] = cache
+      # キャッシュ内のハンドルはこのセッション専用 (同じ index を占有している間だけ使う)
+      for key in keys:
+        parent = self._hctrl if key[0] == "controller" else self._hrobot
+        try:
+          values[key] = cache.getvalue(parent, key[1], kind=key[0])
+        except ORiNException as e:
+          values[key] = None
+          errors[key] = e.hresult
+    return (values, errors)
@@ -0,0 +1,108 @@
+# -*- coding:utf-8 -*-
+# b-CAP 呼び出しの計測 (BCAPClient.settrace で有効にする)
+#   funcid ごとに serialize / send / wait / receive / decode の各区間 [ns] と
+#   送受信サイズ [byte] を対数線形バケットのヒストグラム (HDR 方式) に溜める.
+#   wait    : 送信完了から応答の先頭が届くまで (S_EXECUTING の受信もここに含む)
+#   receive : 応答の先頭から 1 フレーム揃うまで
+import json
+import time
+from threading import Lock
+from bcapclient import FUNC_NAMES
+from histogram import Histogram
+
+class CallStats:
+  PHASES = ("serialize", "send", "wait", "receive", "decode", "total")
+  SIZES  = ("sent", "received")
+
+  def __init__(self):
+    self._lock  = Lock()
+    self._calls = {}
+    self._t_start = time.time()
+
+  def reset(self):
+    with self._lock:
+      self._calls = {}
+      self._t_start = time.time()
+
+  def _entry(self, funcid):
+    entry = self._calls.get(funcid)
+    if entry is None:
+      entry = {
+        "phases"    : {name: Histogram() for name in self.PHASES},
+        "sizes"     : {name: Histogram() for name in self.SIZES},
+        "keepalives": 0,
+        "errors"    : {},
+      }
+      self._calls[funcid] = entry
+    return entry
+
+  def record(self, funcid, phases, len_send, len_recv, keepalives, hresult):
+    # phases: PHASES の順の各区間 [ns]. 途中で失敗した区間は None
+    with self._lock:
+      entry = self._entry(funcid)
+      for (name, value) in zip(self.PHASES, phases):
+        if value is not None:
+          entry["phases"][name].record(value)
+      if len_send is not None:
+        entry["sizes"]["sent"].record(len_send)
+      if len_recv is not None:
+        entry["sizes"]["received"].record(len_recv)
+      entry["keepalives"] += keepalives
+      if hresult is not None:
+        entry["errors"][hresult] = entry["errors"].get(hresult, 0) + 1
+
+  def funcids(self):
+    with self._lock:
+      return sorted(self._calls)
+
+  def histogram(self, funcid, name):
+    # 呼び出し時点の複製を返す
+    hist = Histogram()
+    with self._lock:
+      entry = self._calls.get(funcid)
+      if entry is not None:
+        hist.merge(entry["phases"].get(name) or entry["sizes"][name])
+    return hist
+
+  def summary(self):
+    result = {}
+    with self._lock:
+      for (funcid, entry) in sorted(self._calls.items()):
+        result[funcid] = {
+          "name"      : FUNC_NAMES.get(funcid, str(funcid)),
+          "count"     : entry["phases"]["total"].count,
+          "keepalives": entry["keepalives"],
+          "errors"    : {"0x%08X" % (hresult & 0xFFFFFFFF): n
+                         for (hresult, n) in entry["errors"].items()},
+          "phases_ns" : {name: hist.summary()
+                         for (name, hist) in entry["phases"].items()},
+          "sizes"     : {name: hist.summary()
+                         for (name, hist) in entry["sizes"].items()},
+        }
+    return result
+
+  def dump(self, path, buckets = False):
+    # JSON で書き出す. buckets=True ならヒストグラムの中身も含める
+    summary = self.summary()
+    if buckets:
+      with self._lock:
+        for (funcid, entry) in self._calls.items():
+          summary[funcid]["buckets"] = {
+            name: hist.buckets()
+            for (name, hist) in list(entry["phases"].items()) + list(entry["sizes"].items())}
+    with open(path, "w") as f:
+      json.dump({"started": self._t_start, "calls": summary}, f, indent=2)
+
+  def report(self):
+    # 合計時間の多い順に 1 行ずつ
+    lines = ["%-28s %7s %10s %10s %10s %10s %6s"
+             % ("function", "count", "mean[us]", "p99[us]", "wait[us]", "total[ms]", "k/a")]
+    rows = sorted(self.summary().values(),
+                  key=lambda s: s["phases_ns"]["total"]["mean"] * s["count"], reverse=True)
+    for s in rows:
+      total = s["phases_ns"]["total"]
+      lines.append("%-28s %7d %10.1f %10.1f %10.1f %10.1f %6d"
+                   % (s["name"], s["count"], total["mean"] / 1e3, total["p99"] / 1e3,
+                      s["phases_ns"]["wait"]["mean"] / 1e3,
+                      total["mean"] * s["count"] / 1e6, s["keepalives"]))
+    return "\n".join(lines)
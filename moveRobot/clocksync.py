@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+# Arduino の時計 (micros) を PC の時計 (time.monotonic_ns) に合わせる
+#   受信時刻には USB / シリアルのバッファ待ちが乗るので, 行ごとに数 ms ずれる.
+#   バッチごとに (最後の行の micros, 受信時刻) を 1 組の観測とし, 直近 window 組に
+#   host - device = offset + skew * device の直線を当てはめる.
+#   遅れは必ず正の側に出るので, 当てはめ直線より下の半分だけで当てはめ直す (2 回) ことで,
+#   待ちの少なかった観測の下側包絡線に合わせる. 各行の時刻はこの直線で micros から求める.
+#   新しい観測が直前の直線からどれだけ遅れていたか (当てはめ前の残差) をジッタとして記録する.
+import numpy as np
+from histogram import Histogram
+
+def _line(x, y):
+  # 最小二乗の直線 y = a + b x
+  mx = x.mean()
+  my = y.mean()
+  dx = x - mx
+  sxx = np.dot(dx, dx)
+  b = np.dot(dx, y - my) / sxx if sxx > 0 else 0.0
+  return (my - b * mx, b)
+
+class ClockSync:
+  def __init__(self, window = 512, min_points = 8, unit_ns = 1000, wrap_bits = 32):
+    # window     : 当てはめに使う観測の数 (バッチ数)
+    # min_points : これより観測が少ない間は skew = 0 (オフセットのみ) とする
+    # unit_ns    : デバイス時刻の 1 単位 [ns] (micros なら 1000)
+    # wrap_bits  : デバイス時刻のビット数 (micros は 32 ビットで約 71 分で一周する)
+    self._window     = window
+    self._min_points = min_points
+    self._unit_ns    = unit_ns
+    self._wrap       = 1 << wrap_bits
+    self.jitter = Histogram()
+    self.resets = 0
+    self.reset()
+
+  def reset(self):
+    # デバイスが再起動したとき等 (時刻が戻ったら自動で呼ぶ)
+    self._last_raw = None
+    self._device   = 0      # 最後の行のデバイス時刻 [ns] (一周分を足した通算)
+    self._x = np.empty(self._window, dtype=np.int64)
+    self._y = np.empty(self._window, dtype=np.int64)
+    self._n = 0
+    self.observations = 0
+    self.offset_ns = None   # host = device + offset_ns + skew * (device - 最後の観測)
+    self.skew      = 0.0
+    self._ref      = 0
+
+  def update(self, device, host_ns):
+    # device : 1 バッチ分のデバイス時刻 (micros 等, 一周する生の値)
+    # host_ns: そのバッチの受信時刻 (time.monotonic_ns())
+    # 戻り値 : 各行の取得時刻を PC の時計に直したもの [ns] (int64)
+    raw = np.asarray(device, dtype=np.int64)
+    (device, j) = self._unwrap(raw)
+    if j < len(raw):
+      # 時刻が戻った (デバイスの再起動): 戻る前の行は前の時計の当てはめで直してから,
+      # それまでの当てはめを捨てて戻った行から数え直す
+      if self.offset_ns is not None:
+        before = self.correct(device)
+      else:
+        before = np.full(len(device), int(host_ns), dtype=np.int64)
+      self.resets += 1
+      self.reset()
+      return np.concatenate([before, self.update(raw[j:], host_ns)])
+    if len(device) == 0:
+      return np.empty(0, dtype=np.int64)
+    (x, y) = (int(device[-1]), int(host_ns))
+    if self.offset_ns is not None:
+      self.jitter.record(y - self.correct(np.array([x]))[0])
+    self._observe(x, y)
+    self._fit()
+    return self.correct(device)
+
+  def correct(self, device_ns):
+    # 通算のデバイス時刻 [ns] -> PC の時計 [ns]
+    d = device_ns - self._ref
+    return device_ns + self.offset_ns + np.round(self.skew * d).astype(np.int64)
+
+  def stats(self):
+    return {
+      "observations": self.observations,
+      "resets"      : self.resets,
+      "skew_ppm"    : self.skew * 1e6,
+      "offset_ns"   : self.offset_ns,
+      "jitter_ns"   : {"mean": self.jitter.mean(),
+                       "p50" : self.jitter.percentile(50),
+                       "p99" : self.jitter.percentile(99),
+                       "max" : self.jitter.max or 0},
+    }
+
+  def _unwrap(self, raw):
+    # 戻り値: (通算のデバイス時刻 [ns], 時刻が戻った行 (戻っていなければ len(raw)))
+    #   戻った行以降は扱わない
+    if len(raw) == 0:
+      return (raw, 0)
+    last = raw[0] if self._last_raw is None else self._last_raw
+    step = np.diff(np.concatenate([[last], raw])) % self._wrap
+    back = np.flatnonzero(step >= self._wrap // 2)
+    j = int(back[0]) if len(back) else len(raw)
+    if j == 0:
+      return (raw[:0], 0)
+    device = self._device + np.cumsum(step[:j]) * self._unit_ns
+    self._last_raw = int(raw[j - 1])
+    self._device   = int(device[-1])
+    return (device, j)
+
+  def _observe(self, x, y):
+    if self._n == self._window:
+      self._x[:-1] = self._x[1:]
+      self._y[:-1] = self._y[1:]
+      self._n -= 1
+    self._x[self._n] = x
+    self._y[self._n] = y
+    self._n += 1
+    self.observations += 1
+
+  def _fit(self):
+    # 最後の観測を原点にして (host - device) を直線で当てはめる
+    self._ref = int(self._x[self._n - 1])
+    x = (self._x[:self._n] - self._ref).astype(np.float64)
+    y = (self._y[:self._n] - self._x[:self._n]).astype(np.float64)
+    if self._n < self._min_points:
+      (offset, skew) = (y.min(), 0.0)
+    else:
+      keep = np.ones(self._n, dtype=bool)
+      for i in range(3):
+        (offset, skew) = _line(x[keep], y[keep])
+        if i < 2:
+          r = y - (offset + skew * x)
+          keep = r <= np.median(r)
+    self.offset_ns = int(round(offset))
+    self.skew      = float(skew)
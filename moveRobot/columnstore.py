@@ -0,0 +1,213 @@
+# -*- coding:utf-8 -*-
+# センサログの列ごとのバイナリ保存 (CSV の代わり)
+#   ディレクトリに 列名.bin (型そのままの列を追記) と manifest.json (列の型・書式, 確定した行数,
+#   チャンクごとの行数, 時刻の基準) を置く. 書き込みはまとめて行い, 列ファイルに追記してから manifest を
+#   置き換えるので, 途中で落ちても manifest の行数までは必ず読める (続きから追記もできる).
+#   読み込みは np.memmap なので, 長いログでもすぐに開ける.
+#   CSV が必要なときは export_csv / python columnstore.py export <ディレクトリ> [出力.csv]
+#
+#   列の指定: [(列名, dtype, 書式)]. 書式は CSV に書き出すときの % 書式で,
+#   "monotonic_ns" なら time.monotonic_ns() の値を "%Y-%m-%d %H:%M:%S.%f" (ローカル時刻) で書き出す.
+#   時刻は記録中は整数のまま扱い, 文字列にするのは書き出し・表示のときだけ.
+#   壁時計との対応 (anchor) は ColumnWriter を開くたびに 1 つ manifest に記録する.
+import datetime
+import json
+import os
+import sys
+import time
+import numpy as np
+
+MANIFEST = "manifest.json"
+VERSION  = 1
+
+def _column_path(path, name):
+  return os.path.join(path, name + ".bin")
+
+def anchor():
+  # 壁時計と monotonic の対応 (wall_ns, mono_ns). monotonic は前後に読んだ中点
+  before = time.monotonic_ns()
+  wall   = time.time_ns()
+  after  = time.monotonic_ns()
+  return (wall, (before + after) // 2)
+
+def wall_clock(mono_ns, anchor):
+  # monotonic_ns (整数 / 配列) -> UNIX 時刻 [ns]
+  (wall, mono) = anchor
+  return wall + (mono_ns - mono)
+
+def format_wall_ns(wall_ns):
+  # UNIX 時刻 [ns] の配列 -> "YYYY-mm-dd HH:MM:SS.ffffff" (ローカル時刻. 時差は先頭の時刻で決める)
+  if len(wall_ns) == 0:
+    return np.array([], dtype=str)
+  offset = datetime.datetime.fromtimestamp(int(wall_ns[0]) / 1e9).astimezone().utcoffset()
+  us = (np.asarray(wall_ns, dtype=np.int64) + int(offset.total_seconds()) * 1000000000) // 1000
+  text = np.datetime_as_string(us.astype("datetime64[us]"), unit="us")
+  return np.char.replace(text, "T", " ")
+
+class ColumnWriter:
+  def __init__(self, path, columns, flush_rows = 65536, flush_interval = 1.0):
+    # flush_rows / flush_interval [s]: どちらかに達したら 1 チャンクとして書き出す
+    #   (落ちたときに失うのは最大で flush_interval 分)
+    self.path = path
+    self._columns = [(name, np.dtype(dtype).newbyteorder("<"), fmt)
+                     for (name, dtype, fmt) in columns]
+    self._flush_rows     = flush_rows
+    self._flush_interval = flush_interval
+    self._pending = {name: [] for (name, dtype, fmt) in self._columns}
+    self._pending_rows = 0
+    self._last_flush = time.monotonic()
+
+    os.makedirs(path, exist_ok=True)
+    self._manifest = self._load()
+    self.rows = self._manifest["rows"]
+    # この行以降の monotonic_ns はこの anchor で壁時計に直す
+    self.anchor = anchor()
+    self._manifest["anchors"].append([self.rows] + list(self.anchor))
+    self._files = {}
+    for (name, dtype, fmt) in self._columns:
+      f = open(_column_path(path, name), "ab")
+      # manifest に載っていない書きかけ (前回落ちた分) は捨てる
+      f.truncate(self.rows * dtype.itemsize)
+      self._files[name] = f
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _load(self):
+    spec = [{"name": name, "dtype": dtype.str, "format": fmt}
+            for (name, dtype, fmt) in self._columns]
+    try:
+      with open(os.path.join(self.path, MANIFEST)) as f:
+        manifest = json.load(f)
+    except FileNotFoundError:
+      return {"version": VERSION, "rows": 0, "columns": spec, "chunks": [], "anchors": []}
+    if manifest["columns"] != spec:
+      raise ValueError("columns differ from %s" % os.path.join(self.path, MANIFEST))
+    return manifest
+
+  def append(self, data):
+    # data: {列名: 配列 or スカラー (行数分繰り返す)}. 全列を指定すること
+    n = max(np.size(value) for value in data.values())
+    if n == 0:
+      return
+    for (name, dtype, fmt) in self._columns:
+      value = np.asarray(data[name], dtype=dtype)
+      if value.ndim == 0:
+        value = np.full(n, value, dtype=dtype)
+      elif len(value) != n:
+        raise ValueError("column %s has %d rows, expected %d" % (name, len(value), n))
+      self._pending[name].append(value)
+    self._pending_rows += n
+    if (self._pending_rows >= self._flush_rows) or \
+        (time.monotonic() - self._last_flush >= self._flush_interval):
+      self.flush()
+
+  def flush(self):
+    self._last_flush = time.monotonic()
+    if self._pending_rows == 0:
+      return
+    for (name, dtype, fmt) in self._columns:
+      f = self._files[name]
+      f.write(np.concatenate(self._pending[name]).tobytes())
+      f.flush()
+      self._pending[name] = []
+    self._manifest["chunks"].append([self.rows, self._pending_rows])
+    self.rows += self._pending_rows
+    self._manifest["rows"] = self.rows
+    self._pending_rows = 0
+
+    tmp = os.path.join(self.path, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+      json.dump(self._manifest, f)
+    os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+  def close(self):
+    if self._files is None:
+      return
+    try:
+      self.flush()
+    finally:
+      for f in self._files.values():
+        f.close()
+      self._files = None
+
+class ColumnLog:
+  # 保存したログを開く. log["AcX"] は memmap (読み取り専用) の 1 次元配列
+  def __init__(self, path):
+    if os.path.basename(path) == MANIFEST:
+      path = os.path.dirname(path)
+    self.path = path
+    with open(os.path.join(path, MANIFEST)) as f:
+      self.manifest = json.load(f)
+    self.rows    = self.manifest["rows"]
+    self.chunks  = self.manifest["chunks"]
+    self.columns = [c["name"] for c in self.manifest["columns"]]
+    self.formats = {c["name"]: c["format"] for c in self.manifest["columns"]}
+    self.anchors = self.manifest["anchors"]
+    self._data = {}
+    for c in self.manifest["columns"]:
+      dtype = np.dtype(c["dtype"])
+      if self.rows == 0:
+        self._data[c["name"]] = np.empty(0, dtype=dtype)
+      else:
+        self._data[c["name"]] = np.memmap(_column_path(path, c["name"]), dtype=dtype,
+                                          mode="r", shape=(self.rows, ))
+
+  def __len__(self):
+    return self.rows
+
+  def __getitem__(self, name):
+    return self._data[name]
+
+  def __contains__(self, name):
+    return name in self._data
+
+  def wall_ns(self, name, begin = 0, end = None):
+    # monotonic_ns の列 name の [begin, end) 行を UNIX 時刻 [ns] (int64) にする
+    end = self.rows if end is None else end
+    mono = np.asarray(self._data[name][begin:end], dtype=np.int64)
+    starts = np.array([a[0] for a in self.anchors], dtype=np.int64)
+    offsets = np.array([a[1] - a[2] for a in self.anchors], dtype=np.int64)
+    # 行ごとに, その行より前で最後に記録した anchor を使う
+    which = np.searchsorted(starts, np.arange(begin, end), side="right") - 1
+    return mono + offsets[np.maximum(which, 0)]
+
+  def export_csv(self, out, chunk_rows = 100000):
+    # CSV (先頭行は列名) に書き出す. chunk_rows 行ずつ書くのでメモリは増えない
+    row = ",".join("%s" if self.formats[name] in ("monotonic_ns", None) else self.formats[name]
+                   for name in self.columns)
+    with open(out, "w", newline="") as f:
+      f.write(",".join(self.columns) + "\r\n")
+      for begin in range(0, self.rows, chunk_rows):
+        end = min(begin + chunk_rows, self.rows)
+        columns = []
+        for name in self.columns:
+          value = self._data[name][begin:end]
+          if self.formats[name] == "monotonic_ns":
+            value = format_wall_ns(self.wall_ns(name, begin, end))
+          columns.append(value.tolist())
+        f.write("".join([row % values + "\r\n" for values in zip(*columns)]))
+
+def export_csv(path, out = None):
+  log = ColumnLog(path)
+  if out is None:
+    out = log.path.rstrip("/\\") + ".csv"
+  log.export_csv(out)
+  return out
+
+if __name__ == '__main__':
+  if (len(sys.argv) < 3) or (sys.argv[1] not in ("info", "export")):
+    print("usage: python columnstore.py info|export <ログのディレクトリ> [出力.csv]")
+    sys.exit(1)
+  if sys.argv[1] == "info":
+    t0 = time.perf_counter()
+    log = ColumnLog(sys.argv[2])
+    print("%d rows, %d chunks (opened in %.1f ms)"
+          % (len(log), len(log.chunks), (time.perf_counter() - t0) * 1e3))
+    for name in log.columns:
+      print("  %-8s %-4s %s" % (name, log[name].dtype.str, log.formats[name]))
+  else:
+    print(export_csv(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None))
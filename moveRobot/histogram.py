@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+# 対数線形バケットのヒストグラム (HDR 方式). 整数の値 (時間 [ns], サイズ [byte] 等) を
+# 一定の相対誤差で溜め, メモリは値の数によらず一定
+class Histogram:
+  # 2^SUB_BITS 個の線形バケットを 2 のべき乗ごとに持つ (相対誤差 < 1 / 2^SUB_BITS)
+  SUB_BITS  = 5
+  MAX_VALUE = (1 << 40) - 1
+
+  def __init__(self):
+    self._counts = [0] * (self._index(self.MAX_VALUE) + 1)
+    self.reset()
+
+  def reset(self):
+    for i in range(len(self._counts)):
+      self._counts[i] = 0
+    self.count = 0
+    self.total = 0
+    self.min   = None
+    self.max   = None
+
+  def _index(self, value):
+    e = value.bit_length() - self.SUB_BITS - 1
+    if e <= 0:
+      return value
+    return (e << self.SUB_BITS) + (value >> e)
+
+  def _bounds(self, index):
+    # バケットに入る値の範囲 [low, high]
+    if index < (2 << self.SUB_BITS):
+      return (index, index)
+    e = (index >> self.SUB_BITS) - 1
+    m = index - (e << self.SUB_BITS)
+    return (m << e, ((m + 1) << e) - 1)
+
+  def record(self, value):
+    value = min(max(int(value), 0), self.MAX_VALUE)
+    self._counts[self._index(value)] += 1
+    self.count += 1
+    self.total += value
+    if (self.min is None) or (value < self.min):
+      self.min = value
+    if (self.max is None) or (value > self.max):
+      self.max = value
+
+  def merge(self, other):
+    for (i, n) in enumerate(other._counts):
+      if n:
+        self._counts[i] += n
+    self.count += other.count
+    self.total += other.total
+    if other.count:
+      self.min = other.min if self.min is None else min(self.min, other.min)
+      self.max = other.max if self.max is None else max(self.max, other.max)
+
+  def mean(self):
+    return self.total / self.count if self.count else 0.0
+
+  def percentile(self, q):
+    # q [%] 点を含むバケットの上端 (min / max を超えないように丸める)
+    if self.count == 0:
+      return 0
+    rank = max(1, int(self.count * q / 100.0 + 0.5))
+    seen = 0
+    for (i, n) in enumerate(self._counts):
+      seen += n
+      if seen >= rank:
+        return min(max(self._bounds(i)[1], self.min), self.max)
+    return self.max
+
+  def buckets(self):
+    # [(low, high, count), ...] (空でないバケットのみ)
+    return [self._bounds(i) + (n, ) for (i, n) in enumerate(self._counts) if n]
+
+  def summary(self, percentiles = (50, 90, 99, 99.9)):
+    result = {
+      "count": self.count,
+      "min"  : self.min if self.min is not None else 0,
+      "mean" : self.mean(),
+      "max"  : self.max if self.max is not None else 0,
+    }
+    for q in percentiles:
+      result["p%g" % q] = self.percentile(q)
+    return result
@@ -0,0 +1,108 @@
+# -*- coding:utf-8 -*-
+# P 型 [x, y, z, rx, ry, rz(, fig)] の座標計算をローカルで行う (DevH / Dev 相当)
+#   姿勢は [deg], R = Rx(rx) @ Ry(ry) @ Rz(rz) (X→Y→Z の順に動いた軸回りに回転).
+#   すべての関数は先頭の次元でブロードキャストするので, ラスタ全点を 1 回で計算できる.
+#   fig は第 1 引数のものを引き継ぐ.
+import numpy as np
+
+_EPS = 1e-9
+
+def _split(poses):
+  poses = np.asarray(poses, dtype=np.float64)
+  return (poses[..., :3], poses[..., 3:6], poses[..., 6:])
+
+def rot_to_matrix(rpy):
+  (a, b, c) = np.moveaxis(np.radians(rpy), -1, 0)
+  (ca, sa) = (np.cos(a), np.sin(a))
+  (cb, sb) = (np.cos(b), np.sin(b))
+  (cc, sc) = (np.cos(c), np.sin(c))
+  r = np.empty(np.shape(a) + (3, 3))
+  r[..., 0, 0] =  cb * cc
+  r[..., 0, 1] = -cb * sc
+  r[..., 0, 2] =  sb
+  r[..., 1, 0] =  ca * sc + sa * sb * cc
+  r[..., 1, 1] =  ca * cc - sa * sb * sc
+  r[..., 1, 2] = -sa * cb
+  r[..., 2, 0] =  sa * sc - ca * sb * cc
+  r[..., 2, 1] =  sa * cc + ca * sb * sc
+  r[..., 2, 2] =  ca * cb
+  return r
+
+def matrix_to_rot(r):
+  sb = np.clip(r[..., 0, 2], -1.0, 1.0)
+  b  = np.arcsin(sb)
+  gimbal = np.abs(np.cos(b)) < _EPS
+  a = np.where(gimbal, np.arctan2(r[..., 2, 1], r[..., 1, 1]),
+                       np.arctan2(-r[..., 1, 2], r[..., 2, 2]))
+  c = np.where(gimbal, 0.0, np.arctan2(-r[..., 0, 1], r[..., 0, 0]))
+  return np.degrees(np.stack([a, b, c], axis=-1))
+
+def pose_to_matrix(poses):
+  (p, rpy, fig) = _split(poses)
+  t = np.zeros(p.shape[:-1] + (4, 4))
+  t[..., :3, :3] = rot_to_matrix(rpy)
+  t[..., :3, 3]  = p
+  t[..., 3, 3]   = 1.0
+  return t
+
+def matrix_to_pose(t, fig = None):
+  poses = np.concatenate([t[..., :3, 3], matrix_to_rot(t[..., :3, :3])], axis=-1)
+  if fig is not None and np.shape(fig)[-1] > 0:
+    fig = np.broadcast_to(fig, poses.shape[:-1] + (np.shape(fig)[-1], ))
+    poses = np.concatenate([poses, fig], axis=-1)
+  return poses
+
+def devh(p1, p2):
+  # ツール座標系での偏差: T(p1) @ T(p2)
+  (_, _, fig) = _split(p1)
+  return matrix_to_pose(pose_to_matrix(p1) @ pose_to_matrix(p2), fig)
+
+def dev(p1, p2):
+  # ベース座標系での偏差: 位置は加算, 姿勢は p2 の回転をベース軸回りに適用
+  (pos1, rpy1, fig) = _split(p1)
+  (pos2, rpy2, _)   = _split(p2)
+  r = rot_to_matrix(rpy2) @ rot_to_matrix(rpy1)
+  poses = np.concatenate([pos1 + pos2, matrix_to_rot(r)], axis=-1)
+  if fig.shape[-1] > 0:
+    poses = np.concatenate([poses, np.broadcast_to(fig,
+      poses.shape[:-1] + (fig.shape[-1], ))], axis=-1)
+  return poses
+
+def devh_chain(base, step, n):
+  # base, DevH(base, step), DevH(DevH(base, step), step), ... の n+1 点
+  (_, _, fig) = _split(base)
+  t    = pose_to_matrix(base)
+  step = pose_to_matrix(step)
+  ts = [t]
+  for i in range(n):
+    t = t @ step
+    ts.append(t)
+  return matrix_to_pose(np.stack(ts), fig)
+
+def pose_to_str(pose):
+  # コントローラに渡す "P(x, y, z, rx, ry, rz)" 形式
+  return "P(%s)" % ", ".join("%.6f" % v for v in np.asarray(pose)[:6])
+
+def pose_error(p1, p2):
+  # (位置誤差 [mm], 姿勢誤差 [deg]) を返す. 姿勢は回転行列の差の角度で比較する
+  (pos1, rpy1, _) = _split(p1)
+  (pos2, rpy2, _) = _split(p2)
+  dpos = np.linalg.norm(pos1 - pos2, axis=-1)
+  r = np.swapaxes(rot_to_matrix(rpy1), -1, -2) @ rot_to_matrix(rpy2)
+  cos = np.clip((np.trace(r, axis1=-2, axis2=-1) - 1.0) / 2.0, -1.0, 1.0)
+  return (dpos, np.degrees(np.arccos(cos)))
+
+def verify_devh(client, hrobot, p1s, p2s, tol_pos = 1e-3, tol_rot = 1e-3):
+  # ローカル計算とコントローラの DevH を比較する.
+  # 戻り値: (一致したか, 最大位置誤差 [mm], 最大姿勢誤差 [deg])
+  p1s = np.atleast_2d(np.asarray(p1s, dtype=np.float64))
+  p2s = np.broadcast_to(np.asarray(p2s, dtype=np.float64),
+                        p1s.shape[:-1] + (np.shape(p2s)[-1], ))
+  local  = devh(p1s, p2s)
+  remote = np.array([client.robot_execute(hrobot, "DevH",
+                       [p1.tolist(), pose_to_str(p2)])
+                     for (p1, p2) in zip(p1s, p2s)], dtype=np.float64)
+  (dpos, drot) = pose_error(local, remote)
+  max_pos = float(np.max(dpos))
+  max_rot = float(np.max(drot))
+  return ((max_pos <= tol_pos) and (max_rot <= tol_rot), max_pos, max_rot)
@@ -0,0 +1,244 @@
+# -*- coding:utf-8 -*-
+# ロボット状態 (CurPos / CurJnt / 任意の変数) を一定周期で記録する
+#   専用の b-CAP セッションでポーリングし, NumPy のリングバッファに溜めて
+#   チャンク単位で columnstore の形式 (センサログと同じ) で書き出す. 読むときは columnstore.ColumnLog.
+#   時刻列 "t" はシリアルログの Time / SampleTime 列と同じ time.monotonic_ns() なので, そのまま突き合わせられる.
+#   壁時計との対応は columnstore と同じく manifest.json の anchors (ColumnLog.wall_ns("t") で UNIX 時刻 [ns]).
+#   接続が切れても ResilientBCAPClient が再接続してハンドルを取り直すので記録は続く.
+#   記録の統計は sampler_stats.json に書く.
+import json
+import os
+import time
+from threading import Event, Thread
+import numpy as np
+from bcapresilient import ResilientBCAPClient
+from columnstore import ColumnWriter
+
+STATS = "sampler_stats.json"
+
+class RobotStateSampler:
+  _POS_COLUMNS = ["x", "y", "z", "rx", "ry", "rz", "fig"]
+
+  def __init__(self, host, port, timeout, provider, machine = "localhost",
+               robot = "Arm", rate = 50.0, variables = (),
+               chunk = 500, capacity = 4096):
+    # variables: 追加で記録するロボット変数名 (例: 電流・トルク監視用の変数)
+    self._host      = host
+    self._port      = port
+    self._timeout   = timeout
+    self._provider  = provider
+    self._machine   = machine
+    self._robot     = robot
+    self._period    = 1.0 / rate
+    self._variables = list(variables)
+    self._chunk     = chunk
+    self._capacity  = max(capacity, 2 * chunk)
+
+    self._client   = None
+    self._hctrl    = None
+    self._hrobot   = None
+    self._hvars    = []
+    self._columns  = None
+    self._ring     = None
+    self._ring_t   = None
+    self._dir      = None
+
+    self._written  = 0
+    self._flushed  = 0
+    self._missed   = 0
+    self._dropped  = 0
+    self._late_sum = 0.0
+    self._late_max = 0.0
+    self._reconnects = 0
+    self._errors   = 0
+    self.error     = None     # 最後に読み取りに失敗したときの例外
+    self._t_start  = None
+    self._t_stop   = None
+
+    self._stop_event  = Event()
+    self._chunk_event = Event()
+    self._thread = None
+    self._writer = None
+    self._log    = None
+
+  def start(self, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    self._dir = out_dir
+
+    self._client = ResilientBCAPClient(self._host, self._port, self._timeout)
+    try:
+      self._client.service_start("")
+      self._hctrl  = self._client.controller_connect("", self._provider, self._machine, "")
+      self._hrobot = self._client.controller_getrobot(self._hctrl, self._robot, "")
+      self._hvars  = [self._client.robot_getvariable(self._hrobot, name, "")
+                      for name in self._variables]
+
+      # 1 回読んで列数を決める
+      (t, latency, values) = self._read()
+      self._columns = ["latency"] + self._names(values)
+      self._ring   = np.empty((len(self._columns), self._capacity), dtype=np.float64)
+      self._ring_t = np.empty(self._capacity, dtype=np.int64)
+      # 書き出しは _spill でまとめて行うので, ColumnWriter 側では溜めない
+      self._log = ColumnWriter(out_dir, [("t", "<i8", "monotonic_ns")] +
+                               [(name, "<f8", "%r") for name in self._columns],
+                               flush_rows=1)
+    except BaseException as e:
+      # 開始できなかったらセッションを閉じて送出する (stop() は呼ばなくてよい)
+      self._client.close()
+      self._client = None
+      self._dir    = None
+      raise e
+
+    self._stop_event.clear()
+    self._t_start = time.perf_counter()
+    self._thread = Thread(target=self._sample_task, daemon=True)
+    self._writer = Thread(target=self._writer_task, daemon=True)
+    self._writer.start()
+    self._thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._t_stop = time.perf_counter()
+      self._chunk_event.set()
+      self._writer.join()
+      self._thread = None
+      self._writer = None
+      if self._written > self._flushed:
+        self._spill(self._written - self._flushed)
+    if self._log is not None:
+      self._log.close()
+      self._log = None
+    if self._dir is not None:
+      self._write_stats()
+
+    if self._client is not None:
+      try:
+        for hvar in self._hvars:
+          self._client.variable_release(hvar)
+        self._client.robot_release(self._hrobot)
+        self._client.controller_disconnect(self._hctrl)
+        self._client.service_stop()
+      finally:
+        self._reconnects = self._client.stats()["reconnects"]
+        self._client.close()
+        self._client = None
+
+  def stats(self):
+    end = self._t_stop if self._t_stop is not None else time.perf_counter()
+    elapsed = end - self._t_start if self._t_start is not None else 0.0
+    return {
+      "samples"      : self._written,
+      "target_rate"  : 1.0 / self._period,
+      "achieved_rate": self._written / elapsed if elapsed > 0 else 0.0,
+      "missed"       : self._missed,
+      "dropped"      : self._dropped,
+      "late_mean"    : self._late_sum / self._written if self._written else 0.0,
+      "late_max"     : self._late_max,
+      "reconnects"   : self._client.stats()["reconnects"] if self._client is not None
+                       else self._reconnects,
+      "errors"       : self._errors,
+      "error"        : None if self.error is None else repr(self.error),
+    }
+
+  def _read(self):
+    t0 = time.perf_counter()
+    t  = time.monotonic_ns()
+    values = [self._client.robot_execute(self._hrobot, "CurPos"),
+              self._client.robot_execute(self._hrobot, "CurJnt")]
+    for hvar in self._hvars:
+      values.append(self._client.variable_getvalue(hvar))
+    return (t, time.perf_counter() - t0, values)
+
+  def _names(self, values):
+    names = self._POS_COLUMNS[:len(values[0])]
+    names += ["j%d" % (i + 1) for i in range(len(values[1]))]
+    for (name, value) in zip(self._variables, values[2:]):
+      if isinstance(value, (list, tuple)):
+        names += ["%s[%d]" % (name, i) for i in range(len(value))]
+      else:
+        names.append(name)
+    return names
+
+  def _flatten(self, values):
+    row = []
+    for value in values:
+      if isinstance(value, (list, tuple)):
+        row += value
+      else:
+        row.append(value)
+    return row
+
+  def _sample_task(self):
+    deadline = self._t_start
+    while not self._stop_event.is_set():
+      now = time.perf_counter()
+      if now < deadline:
+        self._stop_event.wait(deadline - now)
+        continue
+
+      late = now - deadline
+      self._late_sum += late
+      if late > self._late_max:
+        self._late_max = late
+
+      try:
+        (t, latency, values) = self._read()
+      except Exception as e:
+        # 再接続でも戻らなかった: 記録して次の周期にまた試す (スレッドは止めない)
+        self._errors += 1
+        self.error = e
+      else:
+        self._push(t, [latency] + self._flatten(values))
+
+      # 1 周期以上遅れたら取りこぼした周期を数えて次の周期に合わせる
+      deadline += self._period
+      now = time.perf_counter()
+      if now > deadline + self._period:
+        skipped = int((now - deadline) / self._period)
+        self._missed += skipped
+        deadline += skipped * self._period
+
+  def _push(self, t, row):
+    if self._written - self._flushed >= self._capacity:
+      self._dropped += 1
+      return
+    self._ring[:, self._written % self._capacity] = row
+    self._ring_t[self._written % self._capacity] = t
+    self._written += 1
+    if self._written - self._flushed >= self._chunk:
+      self._chunk_event.set()
+
+  def _writer_task(self):
+    while True:
+      self._chunk_event.wait()
+      self._chunk_event.clear()
+      while self._written - self._flushed >= self._chunk:
+        self._spill(self._chunk)
+      if self._stop_event.is_set():
+        break
+
+  def _spill(self, rows):
+    begin = self._flushed % self._capacity
+    end   = begin + rows
+    if end <= self._capacity:
+      block = self._ring[:, begin:end]
+      t     = self._ring_t[begin:end]
+    else:
+      block = np.concatenate([self._ring[:, begin:], self._ring[:, :end - self._capacity]], axis=1)
+      t     = np.concatenate([self._ring_t[begin:], self._ring_t[:end - self._capacity]])
+    data = dict(zip(self._columns, block))
+    data["t"] = t
+    self._log.append(data)
+    self._flushed += rows
+
+  def _write_stats(self):
+    with open(os.path.join(self._dir, STATS), "w") as f:
+      json.dump(self.stats(), f, indent=2)
+
+def interpolate_samples(log, t):
+  # log: 記録したディレクトリを開いた columnstore.ColumnLog
+  # シリアルログ等の時刻 t (time.monotonic_ns()) におけるロボット状態を線形補間で求める
+  return {name: np.interp(t, log["t"], log[name])
+          for name in log.columns if name != "t"}
@@ -1,6 +1,5 @@
 import serial
 import time
-import csv
 import datetime
 import threading
 import os
@@ -9,6 +8,10 @@ import numpy as np
 import cv2
 from ctypes import *
 import glob
+from serialingest import FIRMWARE_COLUMNS, SerialIngest
+from telemetry import TelemetryIngest
+from columnstore import ColumnWriter, ColumnLog, MANIFEST
+from clocksync import ClockSync
 import tkinter as tk
 from tkinter import filedialog
 
@@ -49,6 +52,10 @@ except ImportError:
 HAS_ROBOT_LIB = False
 try:
     import bcapclient
+    from robotsampler import RobotStateSampler
+    from bcapstats import CallStats
+    from bcaprecord import CaptureWriter
+    import poselib
     HAS_ROBOT_LIB = True
 except ImportError:
     print("【警告】bcapclient が見つかりません。ロボット通信はスキップされます。")
@@ -59,6 +66,7 @@ except ImportError:
 # ==============================================================================
 COM_PORT = 'COM18'
 BAUD_RATE = 460800
+SERIAL_BINARY = False   # Arduino にバイナリフレームで送らせる ('b' で開始. False なら CSV 文字列の 's')
 
 # ロボット接続設定
 HOST = "10.1.1.190"
@@ -67,16 +75,38 @@ TIMEOUT = 2000
 PROVIDER = "CaoProv.DENSO.VRC9"
 MACHINE = "localhost"
 
+SCAN_STEPS = 5
+SCAN_STEP = [0, 5, 0, 0, 0, 0]    # 1 ステップの移動量 (ツール座標系)
+SCAN_LIFT = [0, 0, 40, 0, 0, 0]   # 持ち上げ量 (ツール座標系)
+POSE_VERIFY = True                # 事前にローカル計算をコントローラの DevH と照合する
+
+ROBOT_SAMPLE_RATE = 50  # ロボット状態の記録周期 [Hz] (専用セッションで取得)
+ROBOT_SAMPLE_TIMEOUT = 1.0  # 状態記録セッションの応答待ち [s] (これで切断を検知して再接続する)
+BCAP_TRACE = False      # b-CAP 呼び出しごとの所要時間を計測して robot_<日時>/bcap_stats.json に保存
+BCAP_CAPTURE = False    # 送受信フレームを robot_<日時>/bcap_session.bcap に記録 (bcaprecord.py で再生)
+
 CAMERA_FPS = 10
 SAVE_DIR_BASE = "captured_images"
 LOG_DIR_BASE = "sensor_logs"
 
+# センサログの列 (列名, 型, CSV に書き出すときの書式). sensor_logs/log_<日時>/ に列ごとに保存する
+#   Time       : 受信時刻 time.monotonic_ns() (壁時計との対応は manifest.json の anchors)
+#   Micros     : Arduino での取得時刻 micros()
+#   SampleTime : Micros を PC の時計に合わせた取得時刻 (clocksync.ClockSync. 画像との対応はこちらで取る)
+# CSV が必要なら python columnstore.py export sensor_logs/log_<日時>
+FIRMWARE = 'ArduinoMega_20260107'
+SENSOR_COLUMNS = [c for c in FIRMWARE_COLUMNS[FIRMWARE] if c[0] != 'Micros']
+LOG_COLUMNS = (
+    [('Time', '<i8', 'monotonic_ns')] + SENSOR_COLUMNS +
+    [('Micros', '<u4', '%d'), ('SampleTime', '<i8', 'monotonic_ns')]
+)
+
 stop_event = threading.Event()
 
 # ==========================================
 #  タスク: シリアル通信
 # ==========================================
-def serial_logger_task(csv_filepath):
+def serial_logger_task(log_path):
     try:
         ser = serial.Serial(COM_PORT, BAUD_RATE, timeout=1)
         print(f"[Serial] {COM_PORT} に接続しました。")
@@ -86,44 +116,48 @@ def serial_logger_task(csv_filepath):
 
     time.sleep(2)
     
-    with open(csv_filepath, 'w', newline='') as f:
-        writer = csv.writer(f)
-        headers = [
-            'Time', 
-            'Current', 
-            'AcX', 'AcY', 'AcZ', 
-            'GyX', 'GyY', 'GyZ', 
-            'Fx', 'Fy', 'Fz', 'Mx', 'My', 'Mz',
-            'Freq'
-        ]
-        writer.writerow(headers)
-        
-        print(f"[Serial] 計測開始... 保存先: {csv_filepath}")
-        ser.write(b's')
-
+    names = [name for (name, dtype, fmt) in SENSOR_COLUMNS]
+    clock = ClockSync()
+    with ColumnWriter(log_path, LOG_COLUMNS) as writer:
+        print(f"[Serial] 計測開始... 保存先: {log_path}")
+        if SERIAL_BINARY:
+            # バイナリフレームを CRC で確かめ, CSV と同じ14列に直して記録する
+            ser.write(b'b')
+            ingest = TelemetryIngest(ser)
+        else:
+            # 届いた分をまとめて読み, 既存8 + 新規6 + micros = 15列ちょうどの行だけを記録する
+            ser.write(b's')
+            ingest = SerialIngest(ser, fields=len(FIRMWARE_COLUMNS[FIRMWARE]))
         try:
             while not stop_event.is_set():
-                if ser.in_waiting > 0:
-                    try:
-                        line = ser.readline().decode('utf-8').strip()
-                        if not line: continue
-                        parts = line.split(',')
-                        
-                        # 既存8 + 新規6 = 14列以上あるか確認
-                        if len(parts) >= 14:
-                            try:
-                                float(parts[0]) # 数値変換チェック
-                                now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
-                                writer.writerow([now] + parts)
-                            except ValueError:
-                                pass
-                    except UnicodeDecodeError:
-                        pass
+                batch = ingest.read()
+                if not len(batch.lines):
+                    continue
+                columns = {name: batch.values[:, i] for (i, name) in enumerate(names)}
+                columns['Time'] = batch.t
+                if SERIAL_BINARY:
+                    columns['Micros'] = batch.lines['micros']
+                else:
+                    columns['Micros'] = batch.values[:, 14].astype(np.uint32)
+                columns['SampleTime'] = clock.update(columns['Micros'], batch.t)
+                writer.append(columns)
         finally:
             print("[Serial] 停止コマンド送信...")
             ser.write(b'e')
             time.sleep(0.5)
             ser.close()
+            st = ingest.stats()
+            writer.flush()
+            print(f"[Serial] 保存 {writer.rows} 行")
+            if SERIAL_BINARY:
+                print(f"[Serial] 受信 {st['frames']} フレーム (CRC 不一致 {st['crc_errors']}, "
+                      f"欠落 {st['lost']} ({st['gaps']} 箇所), 破棄 {st['skipped']} バイト)")
+            else:
+                print(f"[Serial] 受信 {st['parsed']} 行 (不正 {st['malformed']}, 破棄 {st['dropped']}, "
+                      f"1 回の最大 {st['max_batch']} 行)")
+            cs = clock.stats()
+            print(f"[Serial] 時計合わせ: ずれ {cs['skew_ppm']:.1f} ppm, 受信の遅れ "
+                  f"p50 {cs['jitter_ns']['p50'] / 1e3:.0f} us / p99 {cs['jitter_ns']['p99'] / 1e3:.0f} us")
 
 # ==========================================
 #  タスク: カメラ撮影
@@ -159,42 +193,56 @@ def camera_logger_task(cam, buf, buf_size, frame_info, save_dir):
 # ==========================================
 #  可視化機能 (チェックボックス対応版)
 # ==========================================
-def visualize_results(csv_path, img_dir):
-    print(f"\n[Visualizer] 起動中...\n CSV: {csv_path}\n IMG: {img_dir}")
+def load_sensor_log(path):
+    # ログ (列ごとの保存ディレクトリ / その manifest.json / 以前の CSV) を読む
+    # 戻り値: (開始時刻 datetime, 経過時間 [s] の配列, {列名: 配列})
+    numeric_cols = ['Current', 'AcX', 'AcY', 'AcZ', 'GyX', 'GyY', 'GyZ', 
+                    'Freq', 'Fx', 'Fy', 'Fz', 'Mx', 'My', 'Mz']
+
+    if os.path.isdir(path) or os.path.basename(path) == MANIFEST:
+        # memmap で開くので, 長いログでも読み込み待ちはない
+        log = ColumnLog(path)
+        if len(log) == 0:
+            return (None, None, {})
+        # 取得時刻 (SampleTime) があればそちらを使う (受信時刻はバッファ待ちの分ずれている)
+        wall_ns = log.wall_ns('SampleTime' if 'SampleTime' in log else 'Time')
+        start_time = datetime.datetime.fromtimestamp(int(wall_ns[0]) / 1e9)
+        elapsed = (wall_ns - wall_ns[0]) / 1e9
+        return (start_time, elapsed, {col: log[col] for col in numeric_cols if col in log})
+
+    df = pd.read_csv(path)
+    df['dt'] = pd.to_datetime(df['Time'], format='%Y-%m-%d %H:%M:%S.%f', errors='coerce')
+    df = df.dropna(subset=['dt'])
+    if df.empty:
+        return (None, None, {})
+    start_time = df['dt'].iloc[0]
+    elapsed = (df['dt'] - start_time).dt.total_seconds().to_numpy()
+    # 実際にCSVに存在する列のみを対象にする
+    data = {col: pd.to_numeric(df[col], errors='coerce').to_numpy()
+            for col in numeric_cols if col in df.columns}
+    return (start_time.to_pydatetime(), elapsed, data)
+
+def visualize_results(log_path, img_dir):
+    print(f"\n[Visualizer] 起動中...\n LOG: {log_path}\n IMG: {img_dir}")
     
-    if not os.path.exists(csv_path):
-        print("[Visualizer] CSVファイルが見つかりません。")
+    if not os.path.exists(log_path):
+        print("[Visualizer] ログが見つかりません。")
         return
 
     try:
-        df = pd.read_csv(csv_path)
-        df['dt'] = pd.to_datetime(df['Time'], format='%Y-%m-%d %H:%M:%S.%f', errors='coerce')
-        df = df.dropna(subset=['dt'])
+        (start_time, elapsed, data) = load_sensor_log(log_path)
         
-        if df.empty:
+        if start_time is None:
             print("[Visualizer] 有効なデータがありませんでした。")
             return
 
-        start_time = df['dt'].iloc[0]
-        df['Elapsed'] = (df['dt'] - start_time).dt.total_seconds()
-        
-        # 数値変換 (プロット可能な列を特定するため)
-        numeric_cols = ['Current', 'AcX', 'AcY', 'AcZ', 'GyX', 'GyY', 'GyZ', 
-                        'Freq', 'Fx', 'Fy', 'Fz', 'Mx', 'My', 'Mz']
-        
-        # 実際にCSVに存在する列のみを対象にする
-        plot_targets = []
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-                plot_targets.append(col)
-        
+        plot_targets = list(data)
         if not plot_targets:
             print("[Visualizer] プロット可能な数値データ列が見つかりません。")
             return
 
     except Exception as e:
-        print(f"[Visualizer] CSV読み込みエラー: {e}")
+        print(f"[Visualizer] ログ読み込みエラー: {e}")
         return
 
     # 画像リスト作成
@@ -228,7 +276,7 @@ def visualize_results(csv_path, img_dir):
     colors = plt.cm.tab20(np.linspace(0, 1, len(plot_targets)))
 
     for i, col in enumerate(plot_targets):
-        ln, = ax_graph.plot(df['Elapsed'], df[col], label=col, color=colors[i], lw=1.5)
+        ln, = ax_graph.plot(elapsed, data[col], label=col, color=colors[i], lw=1.5)
         lines.append(ln)
         lines_map[col] = ln
     
@@ -298,7 +346,7 @@ def visualize_results(csv_path, img_dir):
 
     # --- スライダー ---
     ax_slider = plt.axes([0.2, 0.1, 0.4, 0.03])
-    slider = Slider(ax_slider, 'Time', 0, df['Elapsed'].max(), valinit=0)
+    slider = Slider(ax_slider, 'Time', 0, float(elapsed[-1]), valinit=0)
 
     def update(val):
         current_time_sec = slider.val
@@ -329,7 +377,8 @@ def run_measurement_mode():
     save_dir_img = os.path.join(SAVE_DIR_BASE, now_str)
     os.makedirs(save_dir_img, exist_ok=True)
     
-    csv_filepath = os.path.join(LOG_DIR_BASE, f"log_{now_str}.csv")
+    log_path = os.path.join(LOG_DIR_BASE, f"log_{now_str}")
+    robot_log_dir = os.path.join(LOG_DIR_BASE, f"robot_{now_str}")
 
     # --- カメラ準備 ---
     print("[Main] カメラを探しています...")
@@ -370,7 +419,7 @@ def run_measurement_mode():
     # --- スレッド開始 ---
     stop_event.clear()
     
-    serial_thread = threading.Thread(target=serial_logger_task, args=(csv_filepath,))
+    serial_thread = threading.Thread(target=serial_logger_task, args=(log_path,))
     serial_thread.start()
 
     camera_thread = None
@@ -383,13 +432,34 @@ def run_measurement_mode():
     # --- ロボット動作 ---
     if HAS_ROBOT_LIB:
         hCtrl = None
+        sampler = None
+        call_stats = None
+        capture = None
         try:
             print("[Robot] Connecting...")
             m_bcapclient = bcapclient.BCAPClient(HOST, PORT, TIMEOUT)
+            if BCAP_TRACE:
+                call_stats = CallStats()
+                m_bcapclient.settrace(call_stats)
+            if BCAP_CAPTURE:
+                os.makedirs(robot_log_dir, exist_ok=True)
+                capture = CaptureWriter(os.path.join(robot_log_dir, "bcap_session.bcap"))
+                m_bcapclient.setcapture(capture)
             m_bcapclient.service_start("")
             hCtrl = m_bcapclient.controller_connect("", PROVIDER, MACHINE, "")
             HRobot = m_bcapclient.controller_getrobot(hCtrl, "Arm", "")
 
+            # ロボット状態の記録 (CurPos/CurJnt) を別セッションで開始.
+            # 記録は補助なので, 開始できなくても動作は続ける
+            try:
+                smp = RobotStateSampler(HOST, PORT, ROBOT_SAMPLE_TIMEOUT, PROVIDER, MACHINE,
+                                        rate=ROBOT_SAMPLE_RATE)
+                smp.start(robot_log_dir)
+                sampler = smp
+                print(f"[Robot] 状態記録開始... 保存先: {robot_log_dir}")
+            except Exception as e:
+                print(f"[Robot] 状態記録を開始できません。記録なしで続行します: {e}")
+
             m_bcapclient.robot_execute(HRobot, "TakeArm", [0, 0])
             m_bcapclient.robot_execute(HRobot, "Motor", [1, 0])
             
@@ -398,14 +468,21 @@ def run_measurement_mode():
             option_z = "SPEED=" + str(vSp) + ", ACCEL=100, DECEL=100, NEXT"
             option_y = "SPEED=10"
 
-            for i in range(5):
-                print(f"[Robot] 動作 {i+1}/5")
-                relative_z_up = m_bcapclient.robot_execute(HRobot, "DevH", [base_pos, "P(0, 0, 40, 0, 0, 0)"])
-                m_bcapclient.robot_move(HRobot, 2, [relative_z_up, "P", "@P"], option_z)
-                m_bcapclient.robot_move(HRobot, 2, [base_pos, "P", "@P"], option_y)
-                
-                base_pos = m_bcapclient.robot_execute(HRobot, "DevH", [base_pos, "P(0, 5, 0, 0, 0, 0)"])
-                m_bcapclient.robot_move(HRobot, 2, [base_pos, "P", "@P"], option_y)
+            # 経路点をローカルで一括計算 (DevH の往復通信を省く)
+            base_list = poselib.devh_chain(base_pos, SCAN_STEP, SCAN_STEPS)
+            z_up_list = poselib.devh(base_list[:-1], SCAN_LIFT)
+            if POSE_VERIFY:
+                ok, err_pos, err_rot = poselib.verify_devh(
+                    m_bcapclient, HRobot, base_list[:2], [SCAN_LIFT, SCAN_STEP])
+                print(f"[Robot] DevH 照合: 位置誤差 {err_pos:.2e} mm, 姿勢誤差 {err_rot:.2e} deg")
+                if not ok:
+                    raise RuntimeError("ローカルの座標計算がコントローラの DevH と一致しません")
+
+            for i in range(SCAN_STEPS):
+                print(f"[Robot] 動作 {i+1}/{SCAN_STEPS}")
+                m_bcapclient.robot_move(HRobot, 2, [z_up_list[i].tolist(), "P", "@P"], option_z)
+                m_bcapclient.robot_move(HRobot, 2, [base_list[i].tolist(), "P", "@P"], option_y)
+                m_bcapclient.robot_move(HRobot, 2, [base_list[i + 1].tolist(), "P", "@P"], option_y)
 
             print("[Robot] 動作完了。5秒待機...")
             time.sleep(5)
@@ -417,6 +494,24 @@ def run_measurement_mode():
 
         except Exception as e:
             print(f"[Robot] Error: {e}")
+        finally:
+            if capture is not None:
+                m_bcapclient.setcapture(None)
+                capture.close()
+                print(f"[Robot] b-CAP 通信記録: {capture.frames} フレーム")
+            if sampler is not None:
+                sampler.stop()
+                st = sampler.stats()
+                print(f"[Robot] 状態記録: {st['samples']} サンプル, "
+                      f"{st['achieved_rate']:.1f}/{st['target_rate']:.0f} Hz, 周期落ち {st['missed']}, "
+                      f"読み取り失敗 {st['errors']}")
+                if st['error'] is not None:
+                    print(f"[Robot] 状態記録の最後のエラー: {st['error']}")
+            if call_stats is not None:
+                os.makedirs(robot_log_dir, exist_ok=True)
+                call_stats.dump(os.path.join(robot_log_dir, "bcap_stats.json"), buckets=True)
+                print("[Robot] b-CAP 呼び出し時間:")
+                print(call_stats.report())
     else:
         print("[Robot] ライブラリがないため動作シミュレーション (Wait 10s)")
         time.sleep(10)
@@ -436,8 +531,8 @@ def run_measurement_mode():
             pass
     
     print("計測終了。ビューワーを起動します。")
-    if camera_ready or os.path.exists(csv_filepath):
-        visualize_results(csv_filepath, save_dir_img)
+    if camera_ready or os.path.exists(log_path):
+        visualize_results(log_path, save_dir_img)
 
 # ==========================================
 #  モード B: 過去データを表示する
@@ -446,12 +541,12 @@ def run_viewer_mode():
     root = tk.Tk()
     root.withdraw() 
 
-    csv_path = filedialog.askopenfilename(
-        title="1. ログファイル(csv) を選択",
-        filetypes=[("CSV files", "*.csv"), ("All files", "*.*")],
+    log_path = filedialog.askopenfilename(
+        title="1. ログファイル (manifest.json / csv) を選択",
+        filetypes=[("Sensor logs", "manifest.json *.csv"), ("All files", "*.*")],
         initialdir=os.getcwd()
     )
-    if not csv_path: return
+    if not log_path: return
 
     img_dir = filedialog.askdirectory(
         title="2. 画像フォルダを選択",
@@ -459,7 +554,7 @@ def run_viewer_mode():
     )
     if not img_dir: return
 
-    visualize_results(csv_path, img_dir)
+    visualize_results(log_path, img_dir)
 
 # ==========================================
 #  メインメニュー
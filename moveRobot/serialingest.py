@@ -0,0 +1,119 @@
+# -*- coding:utf-8 -*-
+# Arduino からの CSV 行をまとめて受信・解析する (sendCommand2 / sendCommandToArduino 共用)
+#   届いている分を 1 回の read でまとめて読み (何も届いていなければ timeout まで待つ),
+#   バッファから行に分け, 1 バッチ分をまとめて NumPy の列に変換する.
+#   列数が合わない行 (ファームウェアの取り違え・行の混ざり) や数値にならない行は malformed,
+#   改行が来ないまま max_line を超えたゴミは dropped として数えて捨てる.
+import time
+from collections import namedtuple
+import numpy as np
+
+# ファームウェアごとの CSV 1 行の列 (列名, 型, 保存するときの書式). 's' で送ってくるもの
+_CURRENT = [("Current", "<f4", "%.2f")]
+_IMU     = [(name, "<i2", "%d") for name in ("AcX", "AcY", "AcZ", "GyX", "GyY", "GyZ")]
+_FORCE   = [(name, "<f4", "%.3f") for name in ("Fx", "Fy", "Fz", "Mx", "My", "Mz")]
+_FREQ    = [("Freq", "<f4", "%.2f")]
+
+FIRMWARE_COLUMNS = {
+  "ArduinoMega_20251216": _CURRENT + _IMU + _FREQ,
+  "ArduinoMega_20260107": _CURRENT + _IMU + _FORCE + _FREQ + [("Micros", "<u4", "%d")],
+}
+
+# t: 受信時刻 (time.monotonic_ns()), lines: 有効な行 (bytes), values: (行数, fields) の float64
+Batch = namedtuple("Batch", ["t", "lines", "values"])
+
+def _parse(text, count):
+  # "v,v,...,v" を count 個の float64 に. 数が合わない・数値でなければ None
+  try:
+    values = np.fromstring(text.decode("ascii"), sep=",")
+  except (ValueError, UnicodeDecodeError):
+    return None
+  return values if values.size == count else None
+
+def parse_lines(lines, fields):
+  # ちょうど fields 列の行を float64 にする. 戻り値: (有効な行, values)
+  #   列が多い行も捨てる (先頭だけ採ると別の形式の行を違う列名で記録してしまう)
+  good = [line for line in lines if line.count(b",") == fields - 1]
+  if not good:
+    return ([], np.empty((0, fields)))
+
+  values = _parse(b",".join(good), len(good) * fields)
+  if values is None:
+    # 数値にならない行があるので 1 行ずつ確かめる
+    rows = [(line, _parse(line, fields)) for line in good]
+    rows = [(line, row) for (line, row) in rows if row is not None]
+    if not rows:
+      return ([], np.empty((0, fields)))
+    good   = [line for (line, row) in rows]
+    values = np.concatenate([row for (line, row) in rows])
+  return (good, values.reshape(len(good), fields))
+
+class SerialIngest:
+  def __init__(self, ser, fields, timeout = 0.1, max_line = 1024):
+    # ser    : serial.Serial (timeout を上書きする)
+    # fields : 1 行の列数 (FIRMWARE_COLUMNS 参照. 列数が違う行は malformed)
+    self._ser      = ser
+    self._fields   = fields
+    self._max_line = max_line
+    self._buf      = bytearray()
+    self._ser.timeout = timeout
+
+    self.bytes     = 0
+    self.reads     = 0
+    self.lines     = 0
+    self.parsed    = 0
+    self.malformed = 0
+    self.dropped   = 0
+    self.max_batch = 0
+
+  def read(self):
+    # 1 バッチ読む. 何も届かなければ空のバッチ
+    waiting = self._ser.in_waiting
+    data = self._ser.read(waiting if waiting > 0 else 1)
+    if data and (waiting == 0):
+      # 先頭 1 バイトを待っている間に届いた分もまとめて読む
+      waiting = self._ser.in_waiting
+      if waiting > 0:
+        data += self._ser.read(waiting)
+    t = time.monotonic_ns()
+    if not data:
+      return Batch(t, [], np.empty((0, self._fields)))
+    self.bytes += len(data)
+    self.reads += 1
+    return self._feed(t, data)
+
+  def stats(self):
+    return {
+      "bytes"    : self.bytes,
+      "reads"    : self.reads,
+      "lines"    : self.lines,
+      "parsed"   : self.parsed,
+      "malformed": self.malformed,
+      "dropped"  : self.dropped,
+      "max_batch": self.max_batch,
+    }
+
+  def _feed(self, t, data):
+    buf = self._buf
+    buf += data
+    end = buf.rfind(b"\n")
+    if end < 0:
+      if len(buf) > self._max_line:
+        self.dropped += 1
+        del buf[:]
+      return Batch(t, [], np.empty((0, self._fields)))
+
+    lines = [line.strip() for line in bytes(buf[:end]).split(b"\n")]
+    del buf[:end + 1]
+    if len(buf) > self._max_line:
+      self.dropped += 1
+      del buf[:]
+    lines = [line for line in lines if line]
+    (good, values) = parse_lines(lines, self._fields)
+
+    self.lines     += len(lines)
+    self.parsed    += len(good)
+    self.malformed += len(lines) - len(good)
+    if len(good) > self.max_batch:
+      self.max_batch = len(good)
+    return Batch(t, good, values)
@@ -0,0 +1,159 @@
+# -*- coding:utf-8 -*-
+# b-CAP スレーブモードで事前計算した経路点を一定周期で流し込む
+#   TakeArm / Motor ON 済みのロボットハンドルに対して使う.
+#   周期に遅れたら経路点を先に飛ばさず (指令が大きく跳ぶので), 直前に送った姿勢をもう一度
+#   送って保持し, 以降の予定をその分後ろにずらす. 周期落ちが max_miss 回連続したら
+#   送信を打ち切り, スレーブモードを抜けて停止させる.
+import time
+from threading import Event, Thread
+import numpy as np
+from histogram import Histogram
+
+class SlaveModeStreamer:
+  MODE_P = 0x001
+  MODE_J = 0x002
+  MODE_T = 0x003
+
+  MODE_SYNC   = 0x000
+  MODE_ASYNC1 = 0x100
+  MODE_ASYNC2 = 0x200
+
+  def __init__(self, client, hrobot, cycle = 0.008, mode = MODE_P,
+               max_miss = 3, spin = 0.002):
+    # spin: 期限直前はスリープせずに待つ時間 [s] (Windows の sleep 粒度対策)
+    self._client   = client
+    self._hrobot   = hrobot
+    self._cycle    = cycle
+    self._mode     = mode
+    self._max_miss = max_miss
+    self._spin     = spin
+
+    self._poses  = None
+    self._thread = None
+    self._stop_event = Event()
+    self._reset()
+
+  def _reset(self):
+    self.current  = None
+    self.error    = None
+    self.aborted  = False
+    self._sent    = 0
+    self._missed  = 0
+    self._held    = 0
+    self._run_max = 0
+    self._jitter  = Histogram()   # [ns]
+    self._latency = Histogram()   # [ns]
+    self._t_start = None
+    self._t_stop  = None
+
+  def start(self, poses):
+    self._poses = np.asarray(poses, dtype=np.float64)
+    self._reset()
+    self._stop_event.clear()
+    self._thread = Thread(target=self._stream_task, daemon=True)
+    self._thread.start()
+
+  def wait(self, timeout = None):
+    if self._thread is not None:
+      self._thread.join(timeout)
+      if not self._thread.is_alive():
+        self._thread = None
+    return self._thread is None
+
+  def stop(self):
+    self._stop_event.set()
+    self.wait()
+
+  def run(self, poses):
+    self.start(poses)
+    self.wait()
+    if self.error is not None:
+      raise self.error
+    return self.stats()
+
+  def stats(self):
+    # 時間は [s]. ジッタ・レイテンシはヒストグラムの値 (相対誤差 3% 程度)
+    jitter  = self._jitter
+    latency = self._latency
+    end = self._t_stop if self._t_stop is not None else time.perf_counter()
+    return {
+      "sent"        : self._sent,
+      "total"       : 0 if self._poses is None else len(self._poses),
+      "missed"      : self._missed,
+      "held"        : self._held,
+      "max_run"     : self._run_max,
+      "aborted"     : self.aborted,
+      "elapsed"     : 0.0 if self._t_start is None else end - self._t_start,
+      "jitter_mean" : jitter.mean() / 1e9,
+      "jitter_p99"  : jitter.percentile(99) / 1e9,
+      "jitter_max"  : (jitter.max or 0) / 1e9,
+      "latency_mean": latency.mean() / 1e9,
+      "latency_p99" : latency.percentile(99) / 1e9,
+      "latency_max" : (latency.max or 0) / 1e9,
+    }
+
+  def _sleep_until(self, deadline):
+    while True:
+      remain = deadline - time.perf_counter()
+      if remain <= 0:
+        return
+      if remain > self._spin:
+        time.sleep(remain - self._spin)
+
+  def _stream_task(self):
+    client = self._client
+    hrobot = self._hrobot
+    n = len(self._poses)
+    run  = 0
+    last = None
+
+    try:
+      client.robot_execute(hrobot, "slvChangeMode", self._mode)
+      self._t_start = time.perf_counter()
+      deadline = self._t_start
+      i = 0
+      while (i < n) and not self._stop_event.is_set():
+        self._sleep_until(deadline)
+
+        now  = time.perf_counter()
+        late = now - deadline
+        self._jitter.record(late * 1e9)
+
+        if late >= self._cycle:
+          # 周期落ち: 先の点には飛ばさず, 直前の姿勢を送り直して保持する.
+          # 以降の予定は今から数え直す
+          self._missed += int(late / self._cycle)
+          run += 1
+          if run > self._run_max:
+            self._run_max = run
+          if run > self._max_miss:
+            self.aborted = True
+            break
+          deadline = now
+          pose = last
+        else:
+          run  = 0
+          pose = None
+
+        if pose is None:
+          pose = self._poses[i].tolist()
+          i += 1
+        else:
+          self._held += 1
+
+        t0 = time.perf_counter()
+        self.current = client.robot_execute(hrobot, "slvMove", pose)
+        self._latency.record((time.perf_counter() - t0) * 1e9)
+        self._sent += 1
+        last = pose
+        deadline += self._cycle
+    except Exception as e:
+      self.error = e
+      self.aborted = True
+    finally:
+      self._t_stop = time.perf_counter()
+      try:
+        client.robot_execute(hrobot, "slvChangeMode", 0)
+      except Exception as e:
+        if self.error is None:
+          self.error = e
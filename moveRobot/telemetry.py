@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+# ArduinoMega_20260107 のバイナリフレーム ('b' で開始) の受信・解析
+#   1 フレーム 38 バイト: sync(0x5A,0xA5), seq, micros, 電流 x100, IMU 6 軸, 力覚 6 軸 (ADC 生値), crc16.
+#   同期語の候補をまとめて探し, 候補全部の CRC を NumPy で一度に計算して正しいものだけを採る.
+#   seq の飛びから抜けたフレーム数 (lost) を数える.
+#   TelemetryIngest は SerialIngest と同じ使い方で, Batch.lines の代わりにフレームの構造化配列を返す.
+import numpy as np
+from serialingest import Batch, SerialIngest
+
+SYNC = b"\x5a\xa5"
+
+FRAME = np.dtype([
+  ("sync",    "<u2"),
+  ("seq",     "<u2"),
+  ("micros",  "<u4"),
+  ("current", "<i4"),
+  ("imu",     "<i2", (6, )),
+  ("force",   "<u2", (6, )),
+  ("crc",     "<u2"),
+])
+
+# CSV と同じ列 (電流, IMU 6 軸, 力覚 6 軸 [V], 周波数)
+COLUMNS = ["Current", "AcX", "AcY", "AcZ", "GyX", "GyY", "GyZ",
+           "Fx", "Fy", "Fz", "Mx", "My", "Mz", "Freq"]
+
+def _crc_table():
+  table = np.zeros(256, dtype=np.uint16)
+  for i in range(256):
+    crc = i << 8
+    for j in range(8):
+      crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+    table[i] = crc & 0xffff
+  return table
+
+# ファームウェアの crc16() (CRC-16/XMODEM) と同じもの
+_CRC_TABLE = _crc_table()
+
+def crc16(rows):
+  # rows: (n, 長さ) の uint8. 各行の crc16 を返す
+  rows = np.asarray(rows, dtype=np.uint8)
+  crc = np.zeros(rows.shape[0], dtype=np.uint16)
+  for column in rows.T:
+    crc = (crc << 8) ^ _CRC_TABLE[(crc >> 8) ^ column]
+  return crc
+
+def find_gaps(seq, last = None):
+  # seq の飛び. 戻り値: (飛んだ位置, その前に抜けたフレーム数). last は前回最後の seq
+  seq = seq.astype(np.int64)
+  if last is not None:
+    seq = np.concatenate([[last], seq])
+  step = np.diff(seq) % 65536
+  index = np.flatnonzero(step != 1)
+  lost = (step[index] - 1) % 65536
+  return (index, lost)
+
+def decode(data):
+  # data (bytes / bytearray) からフレームを取り出す.
+  # 戻り値: (フレームの配列, 読み終えた位置, CRC が合わなかった候補の数)
+  #   読み終えた位置より後ろは途中までのフレームなので次回に持ち越す
+  buf = np.frombuffer(data, dtype=np.uint8)
+  size = FRAME.itemsize
+  starts = np.flatnonzero((buf[:-1] == SYNC[0]) & (buf[1:] == SYNC[1]))
+  starts = starts[starts + size <= len(buf)]
+  rows = buf[starts[:, None] + np.arange(size)]
+  frames = rows.view(FRAME).reshape(-1)
+  ok = crc16(rows[:, :size - 2]) == frames["crc"]
+  (frames, errors) = (frames[ok], int(np.count_nonzero(~ok)))
+  starts = starts[ok]
+
+  # 偶然 CRC が合った重なり (フレームの途中の同期語) は捨てる
+  if len(starts) > 1:
+    keep = np.concatenate([[True], np.diff(starts) >= size])
+    (frames, starts) = (frames[keep], starts[keep])
+
+  end = int(starts[-1]) + size if len(starts) else 0
+  end = max(end, len(buf) - size + 1, 0)
+  return (frames, end, errors)
+
+def to_values(frames, last_micros = None):
+  # フレームを CSV と同じ 14 列の float64 にする (周波数は micros の差から)
+  values = np.empty((len(frames), len(COLUMNS)))
+  values[:, 0]    = frames["current"] / 100.0
+  values[:, 1:7]  = frames["imu"]
+  values[:, 7:13] = frames["force"] * (5.0 / 1023.0)
+  micros = frames["micros"].astype(np.int64)
+  if last_micros is not None:
+    micros = np.concatenate([[last_micros], micros])
+  else:
+    micros = np.concatenate([micros[:1], micros])
+  dt = np.diff(micros) % (1 << 32)
+  with np.errstate(divide="ignore"):
+    values[:, 13] = np.where(dt > 0, 1e6 / dt, 0.0)
+  return values
+
+class TelemetryIngest(SerialIngest):
+  def __init__(self, ser, timeout = 0.1, max_line = 4096):
+    # max_line: フレームが見つからないまま溜まったバイト列をこれ以上持たない
+    SerialIngest.__init__(self, ser, len(COLUMNS), timeout, max_line)
+    self.skipped     = 0
+    self.crc_errors  = 0
+    self.lost        = 0
+    self.gaps        = 0
+    self._last_seq    = None
+    self._last_micros = None
+
+  def stats(self):
+    stats = SerialIngest.stats(self)
+    del stats["lines"]
+    stats["frames"]     = stats.pop("parsed")
+    stats["skipped"]    = self.skipped
+    stats["crc_errors"] = self.crc_errors
+    stats["lost"]       = self.lost
+    stats["gaps"]       = self.gaps
+    return stats
+
+  def _feed(self, t, data):
+    buf = self._buf
+    buf += data
+    (frames, end, errors) = decode(buf)
+    # end までのうちフレームにならなかった分 (起動時の文字列, 壊れたフレーム) は破棄した扱い
+    skipped = end - len(frames) * FRAME.itemsize
+    del buf[:end]
+    if len(buf) > self._max_line:
+      skipped += len(buf)
+      del buf[:]
+    if skipped > 0:
+      self.dropped += 1
+      self.skipped += skipped
+    self.crc_errors += errors
+
+    if len(frames) == 0:
+      return Batch(t, frames, np.empty((0, self._fields)))
+    (index, lost) = find_gaps(frames["seq"], self._last_seq)
+    self.gaps += len(index)
+    self.lost += int(lost.sum())
+    values = to_values(frames, self._last_micros)
+    self._last_seq    = int(frames["seq"][-1])
+    self._last_micros = int(frames["micros"][-1])
+
+    self.parsed += len(frames)
+    if len(frames) > self.max_batch:
+      self.max_batch = len(frames)
+    return Batch(t, frames, values)
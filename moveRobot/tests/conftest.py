@@ -0,0 +1,6 @@
+# -*- coding:utf-8 -*-
+# moveRobot のモジュールは同じディレクトリから import する前提なので, パスに追加する
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
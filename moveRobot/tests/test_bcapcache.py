@@ -0,0 +1,169 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+import pytest
+from bcapcache import MetadataCache
+from bcapclient import BCAPClient, FUNC_IDS
+from bcapserver import BCAPServer, SimulatedRobot
+
+class Clock:
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+class Controller:
+  # send_and_recv の代わり. 呼ばれた回数を数え, 呼ぶたびに違う値を返す
+  def __init__(self):
+    self.calls = []
+
+  def __call__(self, funcid, args):
+    self.calls.append((funcid, args))
+    return [len(self.calls)]
+
+def _call(cache, send, name, *args):
+  return cache.call(send, FUNC_IDS[name], list(args))
+
+@pytest.fixture
+def cache():
+  clock = Clock()
+  return (MetadataCache(clock=clock), clock, Controller())
+
+def test_forever_until_invalidated(cache):
+  (cache, clock, send) = cache
+  assert _call(cache, send, "controller_getname", 1) == [1]
+  clock.now = 1e6
+  assert _call(cache, send, "controller_getname", 1) == [1]
+  # 引数が違えば別のエントリ
+  assert _call(cache, send, "controller_getname", 2) == [2]
+  assert len(send.calls) == 2
+  assert cache.stats()["hits"] == 1
+
+def test_ttl_expiry(cache):
+  (cache, clock, send) = cache
+  # *_get*names は 10 s
+  assert _call(cache, send, "controller_getvariablenames", 1, "") == [1]
+  clock.now = 9.9
+  assert _call(cache, send, "controller_getvariablenames", 1, "") == [1]
+  clock.now = 10.0
+  assert _call(cache, send, "controller_getvariablenames", 1, "") == [2]
+  assert cache.expired == 1
+  clock.now = 19.9
+  assert _call(cache, send, "controller_getvariablenames", 1, "") == [2]
+  assert len(send.calls) == 2
+
+def test_policies(cache):
+  (cache, clock, send) = cache
+  cache = MetadataCache({"controller_getname": 1.0, "controller_getid": 0}, clock=clock)
+  _call(cache, send, "controller_getname", 1)
+  clock.now = 1.0
+  _call(cache, send, "controller_getname", 1)
+  # TTL 0 はキャッシュしない
+  _call(cache, send, "controller_getid", 1)
+  _call(cache, send, "controller_getid", 1)
+  assert len(send.calls) == 4
+  with pytest.raises(ValueError):
+    MetadataCache({"variable_getvalue": 1.0})
+
+def test_unsafe_calls_are_not_cached(cache):
+  (cache, clock, send) = cache
+  assert _call(cache, send, "variable_getvalue", 1) == [1]
+  assert _call(cache, send, "variable_getvalue", 1) == [2]
+  assert cache.stats()["size"] == 0
+
+def test_execute_commands(cache):
+  (cache, clock, send) = cache
+  _call(cache, send, "robot_execute", 1, "MPS", [1])
+  _call(cache, send, "robot_execute", 1, "MPS", [1])
+  _call(cache, send, "robot_execute", 1, "CurPos", None)
+  _call(cache, send, "robot_execute", 1, "CurPos", None)
+  assert len(send.calls) == 3
+
+def test_results_are_copied(cache):
+  (cache, clock, send) = cache
+  cache.call(lambda funcid, args: ["Arm", "Arm2"], FUNC_IDS["controller_getrobotnames"], [1, ""])
+  names = _call(cache, send, "controller_getrobotnames", 1, "")
+  names.append("changed")
+  assert _call(cache, send, "controller_getrobotnames", 1, "") == ["Arm", "Arm2"]
+
+def test_invalidate_by_handle_and_function(cache):
+  (cache, clock, send) = cache
+  _call(cache, send, "controller_getname", 1)
+  _call(cache, send, "controller_getname", 2)
+  _call(cache, send, "controller_gettag", 1)
+  cache.invalidate(handle=1)
+  assert cache.stats()["size"] == 1
+  cache.invalidate("controller_getname")
+  assert cache.stats()["size"] == 0
+  assert cache.invalidations == 3
+
+def test_put_and_release_invalidate_the_handle(cache):
+  (cache, clock, send) = cache
+  _call(cache, send, "variable_getname", 5)
+  _call(cache, send, "variable_getname", 6)
+  _call(cache, send, "variable_putvalue", 5, 1)
+  assert _call(cache, send, "variable_getname", 5) == [4]
+  assert _call(cache, send, "variable_getname", 6) == [2]
+  _call(cache, send, "variable_release", 6)
+  assert _call(cache, send, "variable_getname", 6) == [6]
+
+def test_disconnect_clears_everything(cache):
+  (cache, clock, send) = cache
+  _call(cache, send, "controller_getname", 1)
+  _call(cache, send, "robot_getname", 2)
+  _call(cache, send, "controller_disconnect", 1)
+  assert cache.stats()["size"] == 0
+  _call(cache, send, "robot_getname", 2)
+  _call(cache, send, "service_stop")
+  assert cache.stats()["size"] == 0
+
+def test_observe_only_invalidates(cache):
+  (cache, clock, send) = cache
+  _call(cache, send, "variable_getname", 5)
+  cache.observe(FUNC_IDS["variable_getname"], [5])
+  assert cache.stats()["size"] == 1
+  cache.observe(FUNC_IDS["variable_putvalue"], [5, 1])
+  assert cache.stats()["size"] == 0
+  _call(cache, send, "variable_getname", 5)
+  cache.observe(FUNC_IDS["service_stop"], [])
+  assert cache.stats()["size"] == 0
+  assert len(send.calls) == 2
+
+def test_with_client():
+  server = BCAPServer()
+  robot = SimulatedRobot(server)
+  count = [0]
+  def getname(args):
+    count[0] += 1
+    return "RC8"
+  server.set_handler(FUNC_IDS["controller_getname"], getname)
+  server.start()
+  clock = Clock()
+  client = BCAPClient(server.host, server.port, 2)
+  client.setcache(MetadataCache({"controller_getname": 5.0}, clock=clock))
+  hctrl = client.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+  assert [client.controller_getname(hctrl) for i in range(3)] == ["RC8"] * 3
+  assert count[0] == 1
+  clock.now = 5.0
+  client.controller_getname(hctrl)
+  assert count[0] == 2
+  client.controller_disconnect(hctrl)
+  assert client.getcache().stats()["size"] == 0
+  client.close()
+  server.stop()
+
+def test_ndarray_arguments(cache):
+  (cache, clock, send) = cache
+  # setndarray(True) のときは引数に ndarray が来る
+  _call(cache, send, "robot_execute", 1, "MPS", np.array([4.0]))
+  _call(cache, send, "robot_execute", 1, "MPS", np.array([4.0]))
+  _call(cache, send, "robot_execute", 1, "MPS", np.array([4], dtype=np.int32))
+  _call(cache, send, "robot_execute", 1, "MPS", np.array([5.0]))
+  assert len(send.calls) == 3
+
+def test_unhashable_arguments_are_not_cached(cache):
+  (cache, clock, send) = cache
+  _call(cache, send, "robot_execute", 1, "MPS", {"speed": 4})
+  _call(cache, send, "robot_execute", 1, "MPS", {"speed": 4})
+  assert len(send.calls) == 2
+  assert cache.stats()["size"] == 0
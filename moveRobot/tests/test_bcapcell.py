@@ -0,0 +1,127 @@
+# -*- coding:utf-8 -*-
+import time
+from threading import BrokenBarrierError, Lock
+import pytest
+from bcapcell import Arm, Cell
+from bcapserver import BCAPServer, SimulatedRobot
+
+POSE = [300.0, 0.0, 400.0, 180.0, 0.0, 180.0, -1.0]
+
+@pytest.fixture
+def cell():
+  servers = [BCAPServer(keepalive=0.05) for i in range(2)]
+  robots  = [SimulatedRobot(server, delays={"robot_move": 0.05 * (i + 1)})
+             for (i, server) in enumerate(servers)]
+  for server in servers:
+    server.start()
+  arms = [Arm("arm%d" % (i + 1), server.host, server.port, 2, "CaoProv.DENSO.VRC9")
+          for (i, server) in enumerate(servers)]
+  with Cell(arms, barrier_timeout=5) as cell:
+    yield (cell, dict(zip(cell.arms, robots)))
+  for server in servers:
+    server.stop()
+
+def _pose(z):
+  return [POSE[:2] + [z] + POSE[3:], "P", "@P"]
+
+def test_run_waits_at_barrier(cell):
+  (cell, robots) = cell
+  events = []
+  lock = Lock()
+
+  def script(arm, cell):
+    arm.execute("TakeArm", [0, 0])
+    arm.execute("Motor", [1, 0])
+    # arm2 の方が遅いので, barrier がなければ arm1 が先に進む
+    arm.move(2, _pose(350.0), "")
+    with lock:
+      events.append(("moved", arm.name))
+    cell.barrier()
+    with lock:
+      events.append(("passed", arm.name))
+    return arm.execute("CurPos")
+
+  results = cell.run({name: script for name in cell.arms})
+  assert results == {name: POSE[:2] + [350.0] + POSE[3:] for name in cell.arms}
+  assert [kind for (kind, name) in events] == ["moved", "moved", "passed", "passed"]
+  assert all(robot.moves == 1 for robot in robots.values())
+
+def test_run_requires_every_arm(cell):
+  (cell, robots) = cell
+  with pytest.raises(ValueError):
+    cell.run({"arm1": lambda arm, cell: None})
+
+def test_run_releases_barrier_on_error(cell):
+  (cell, robots) = cell
+
+  def fails(arm, cell):
+    raise RuntimeError("script failed")
+
+  def waits(arm, cell):
+    cell.barrier()
+
+  t0 = time.perf_counter()
+  with pytest.raises(RuntimeError):
+    cell.run({"arm1": fails, "arm2": waits})
+  # barrier_timeout (5 s) を待たずに戻る
+  assert time.perf_counter() - t0 < 1.0
+
+  # 次の run では barrier が使える
+  assert cell.run({name: lambda arm, cell: cell.barrier() is not None
+                   for name in cell.arms}) == {"arm1": True, "arm2": True}
+
+def test_run_barrier_broken_is_reported(cell):
+  (cell, robots) = cell
+  with pytest.raises(BrokenBarrierError):
+    cell.run({"arm1": lambda arm, cell: cell._barrier.abort(),
+              "arm2": lambda arm, cell: cell.barrier()})
+
+def test_move_together(cell):
+  (cell, robots) = cell
+  for arm in cell.arms.values():
+    arm.execute("TakeArm", [0, 0])
+    arm.execute("Motor", [1, 0])
+  skew = cell.move_together({name: (2, _pose(320.0 + i), "")
+                             for (i, name) in enumerate(cell.arms)})
+  assert 0.0 <= skew < 0.05
+  assert [robot.pose[2] for robot in robots.values()] == [320.0, 321.0]
+  assert cell.stats()["skew"]["count"] == 1
+
+def test_move_together_nowait(cell):
+  (cell, robots) = cell
+  for arm in cell.arms.values():
+    arm.execute("TakeArm", [0, 0])
+    arm.execute("Motor", [1, 0])
+  (skew, futures) = cell.move_together({name: (2, _pose(330.0), "") for name in cell.arms},
+                                       wait=False)
+  assert set(futures) == set(cell.arms)
+  for future in futures.values():
+    future.result(timeout=2)
+  assert all(robot.moves == 1 for robot in robots.values())
+
+def test_connect_failure_cleans_up():
+  server = BCAPServer()
+  robot = SimulatedRobot(server)
+  server.start()
+  # 2 台目は接続できない (空いているポートを取ってすぐ閉じる)
+  closed = BCAPServer()
+  port = closed.port
+  closed.stop()
+  arms = [Arm("arm1", server.host, server.port, 2, "CaoProv.DENSO.VRC9"),
+          Arm("arm2", server.host, port, 2, "CaoProv.DENSO.VRC9")]
+  cell = Cell(arms)
+  with pytest.raises(OSError):
+    cell.__enter__()
+  assert all(arm.client is None for arm in arms)
+  assert robot.handles == {}
+  with pytest.raises(RuntimeError):
+    cell._executor.submit(lambda: None)
+  server.stop()
+
+def test_arm_close_closes_socket(cell):
+  (cell, robots) = cell
+  arm = cell["arm1"]
+  client = arm.client
+  arm.close()
+  assert client._sock is None
+  assert arm.client is None
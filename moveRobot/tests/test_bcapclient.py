@@ -0,0 +1,33 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+import pytest
+from bcapclient import BCAPClient
+from bcapserver import BCAPServer, SimulatedRobot
+
+@pytest.fixture
+def variables():
+  server = BCAPServer()
+  robot = SimulatedRobot(server, variables={"B": b"\x00\x01\xff", "F": [1.5, 2.5]})
+  server.start()
+  client = BCAPClient(server.host, server.port, 2)
+  hctrl = client.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+  yield (client, {name: client.controller_getvariable(hctrl, name) for name in ("B", "F")})
+  client.close()
+  server.stop()
+
+@pytest.mark.parametrize("ndarray", [False, True])
+def test_byte_arrays_stay_bytes(variables, ndarray):
+  (client, handles) = variables
+  client.setndarray(ndarray)
+  # VT_UI1 の配列は ndarray モードでも bytes
+  value = client.variable_getvalue(handles["B"])
+  assert isinstance(value, bytes)
+  assert value == b"\x00\x01\xff"
+
+def test_numeric_arrays_follow_ndarray_mode(variables):
+  (client, handles) = variables
+  assert client.variable_getvalue(handles["F"]) == [1.5, 2.5]
+  client.setndarray(True)
+  value = client.variable_getvalue(handles["F"])
+  assert isinstance(value, np.ndarray)
+  assert value.tolist() == [1.5, 2.5]
@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+import pytest
+from bcapclient import BCAPClient, FUNC_IDS
+from bcaphandles import HandleCache
+from bcappool import BCAPClientPool
+from bcapserver import BCAPServer, SimulatedRobot
+from orinexception import *
+
+VARIABLES = {"I1": 1, "I2": 2, "I3": 3}
+
+@pytest.fixture
+def controller():
+  server = BCAPServer()
+  robot = SimulatedRobot(server, variables=VARIABLES)
+  server.start()
+  client = BCAPClient(server.host, server.port, 2)
+  hctrl = client.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+  yield (server, robot, client, hctrl)
+  client.close()
+  server.stop()
+
+def _variables(robot):
+  return sorted(name for (kind, name) in robot.handles.values() if kind == "variable")
+
+def test_reuses_handle(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  assert cache.getvalue(hctrl, "I1") == 1
+  assert cache.getvalue(hctrl, "I1") == 1
+  cache.putvalue(hctrl, "I1", 10)
+  assert cache.getvalue(hctrl, "I1") == 10
+  assert (cache.misses, cache.hits) == (1, 3)
+  assert _variables(robot) == ["I1"]
+
+def test_retries_once_on_e_handle(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  hvar = cache.controller_getvariable(hctrl, "I2")
+  # コントローラ側でハンドルが無効になった (再起動等)
+  del robot.handles[hvar]
+  assert cache.getvalue(hctrl, "I2") == 2
+  assert cache.retries == 1
+  assert cache.controller_getvariable(hctrl, "I2") != hvar
+  assert _variables(robot) == ["I2"]
+
+def test_retry_error_is_raised(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  count = [0]
+  def getvalue(args):
+    count[0] += 1
+    raise ORiNException(HResult.E_HANDLE)
+  server.set_handler(FUNC_IDS["variable_getvalue"], getvalue)
+  # 取り直しても無効なら 1 回だけやり直してそのまま送出する
+  with pytest.raises(ORiNException) as e:
+    cache.getvalue(hctrl, "I1")
+  assert e.value.hresult == HResult.E_HANDLE
+  assert cache.retries == 1
+  assert count[0] == 2
+
+def test_other_errors_are_not_retried(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  def fails(hvar):
+    raise ORiNException(HResult.E_TIMEOUT)
+  with pytest.raises(ORiNException) as e:
+    cache._with_variable(hctrl, "I1", "", "controller", fails)
+  assert e.value.hresult == HResult.E_TIMEOUT
+  assert cache.retries == 0
+  assert len(cache) == 1
+
+def test_evicts_least_recently_used(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client, capacity=2)
+  cache.getvalue(hctrl, "I1")
+  cache.getvalue(hctrl, "I2")
+  cache.getvalue(hctrl, "I1")
+  cache.getvalue(hctrl, "I3")
+  # I2 が最も長く使われていないので解放される
+  assert cache.evictions == 1
+  assert len(cache) == 2
+  assert _variables(robot) == ["I1", "I3"]
+
+def test_evicts_children_first(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client, capacity=2)
+  hrobot = cache.controller_getrobot(hctrl, "Arm")
+  cache.robot_getvariable(hrobot, "I1")
+  cache.getvalue(hctrl, "I2")
+  # robot を解放するときはその変数も解放する
+  assert cache.evictions == 2
+  assert len(cache) == 1
+  assert sorted(robot.handles.values()) == [("controller", ""), ("variable", "I2")]
+
+def test_release_and_close(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  cache.getvalue(hctrl, "I1")
+  cache.getvalue(hctrl, "I2")
+  cache.release("controller_getvariable", hctrl, "I1")
+  assert _variables(robot) == ["I2"]
+  cache.close()
+  assert len(cache) == 0
+  assert _variables(robot) == []
+
+def test_reset_forgets_without_release(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  cache.getvalue(hctrl, "I1")
+  cache.reset()
+  assert len(cache) == 0
+  assert _variables(robot) == ["I1"]
+
+def test_with_pool():
+  server = BCAPServer()
+  robot = SimulatedRobot(server, variables=VARIABLES)
+  server.start()
+  with BCAPClientPool(server.host, server.port, 2, size=2) as pool:
+    hctrl = pool.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+    cache = HandleCache(pool)
+    assert cache.getvalue(hctrl, "I3") == 3
+    hvar = cache.controller_getvariable(hctrl, "I3")
+    # 一方のセッションのハンドルだけが無効になっても取り直して読める
+    real = pool._handles[0][hvar]
+    del robot.handles[real]
+    assert [cache.getvalue(hctrl, "I3") for i in range(4)] == [3] * 4
+    # 古いハンドルはもう一方のセッションでも解放済み
+    assert hvar not in pool._handles[1]
+    assert _variables(robot) == ["I3", "I3"]
+    cache.close()
+  assert robot.handles == {}
+  server.stop()
+
+def test_only_getters_are_exposed(controller):
+  (server, robot, client, hctrl) = controller
+  cache = HandleCache(client)
+  assert cache.controller_getrobot(hctrl, "Arm") == cache.controller_getrobot(hctrl, "Arm")
+  for name in ("controller_connect", "controller_getmessage", "variable_getvalue", "_entries_x"):
+    with pytest.raises(AttributeError):
+      getattr(cache, name)
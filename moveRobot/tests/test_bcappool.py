@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+import time
+import pytest
+from bcappool import BCAPClientPool
+from bcapserver import BCAPServer, SimulatedRobot
+
+POSE = [300.0, 0.0, 400.0, 180.0, 0.0, 180.0, -1.0]
+
+@pytest.fixture
+def pool():
+  server = BCAPServer()
+  robot  = SimulatedRobot(server, delays={"robot_move": 0.3})
+  server.start()
+  with BCAPClientPool(server.host, server.port, 2, size=2) as pool:
+    hctrl  = pool.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+    hrobot = pool.controller_getrobot(hctrl, "Arm", "")
+    pool.robot_execute(hrobot, "TakeArm", [0, 0])
+    pool.robot_execute(hrobot, "Motor", [1, 0])
+    yield (pool, robot, hrobot)
+  server.stop()
+
+def test_nowait_holds_session_until_done(pool):
+  (pool, robot, hrobot) = pool
+  future = pool.robot_move_nowait(hrobot, 2, [POSE, "P", "@P"], "")
+  # 動作中のセッションは他から借りられない
+  assert len(pool._free) == 1
+  with pool.connection() as c:
+    assert not future.done()
+  future.result(timeout=2)
+  time.sleep(0.05)
+  assert sorted(pool._free) == [0, 1]
+  assert robot.moves == 1
+
+def test_nowait_waits_for_free_session(pool):
+  (pool, robot, hrobot) = pool
+  futures = [pool.robot_move_nowait(hrobot, 2, [POSE, "P", "@P"], "") for i in range(2)]
+  # 2 セッションとも動作中なので, 次の呼び出しは先の動作が終わるまで待つ
+  t0 = time.perf_counter()
+  pool.robot_execute(hrobot, "CurPos")
+  assert time.perf_counter() - t0 >= 0.2
+  for future in futures:
+    future.result(timeout=2)
+  assert robot.moves == 2
+
+def test_nowait_in_connection_uses_pinned_session(pool):
+  (pool, robot, hrobot) = pool
+  with pool.connection() as c:
+    future = pool.robot_move_nowait(hrobot, 2, [POSE, "P", "@P"], "")
+    assert len(pool._free) == 1
+    future.result(timeout=2)
+    time.sleep(0.05)
+    # 返却は connection() を抜けたとき
+    assert len(pool._free) == 1
+  assert sorted(pool._free) == [0, 1]
+
+def test_nowait_error_returns_session(pool):
+  (pool, robot, hrobot) = pool
+  with pytest.raises(TypeError):
+    pool.robot_move_nowait(hrobot, 2, [POSE, "P", "@P"], "", "extra")
+  assert sorted(pool._free) == [0, 1]
@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+import socket
+import time
+from threading import Thread
+import pytest
+from bcapresilient import ResilientBCAPClient
+from bcapserver import BCAPServer, SimulatedRobot
+from orinexception import *
+
+def _start(port = 0):
+  server = BCAPServer(port=port)
+  robot = SimulatedRobot(server)
+  server.start()
+  return (server, robot)
+
+def _open(client):
+  hctrl = client.controller_connect("", "CaoProv.DENSO.VRC9", "localhost", "")
+  hrobot = client.controller_getrobot(hctrl, "Arm", "")
+  return (hctrl, hrobot)
+
+def test_reconnects_after_server_restart():
+  (server, robot) = _start()
+  port = server.port
+  client = ResilientBCAPClient(server.host, port, 1, backoff=0.02, give_up=0.2)
+  (hctrl, hrobot) = _open(client)
+  client.robot_execute(hrobot, "TakeArm", [0, 0])
+  server.stop()
+
+  # 諦めた後の呼び出しも E_NOT_CONNECTED (接続がないまま壊れた状態にならない)
+  for i in range(2):
+    with pytest.raises(ORiNException) as e:
+      client.robot_execute(hrobot, "CurPos")
+    assert e.value.hresult == HResult.E_NOT_CONNECTED
+
+  (server, robot) = _start(port)
+  try:
+    assert client.robot_execute(hrobot, "CurPos") == robot.pose
+    assert client.stats()["reconnects"] == 1
+    assert robot.arm
+    assert sorted(robot.handles.values()) == [("controller", ""), ("robot", "Arm")]
+  finally:
+    client.close()
+    server.stop()
+
+def test_keyword_arguments():
+  (server, robot) = _start()
+  client = ResilientBCAPClient(server.host, server.port, 1)
+  try:
+    hctrl = client.controller_connect(name="", provider="CaoProv.DENSO.VRC9",
+                                      machine="localhost", option="")
+    hrobot = client.controller_getrobot(hctrl, name="Arm")
+    client.robot_execute(hrobot, command="TakeArm", param=[0, 0])
+    client.settimeout(timeout=2)
+    assert client.gettimeout() == 2
+    # キーワードで渡したものも記録して再接続後に取り直す
+    client._client._sock.shutdown(socket.SHUT_RDWR)
+    robot.arm = False
+    assert client.robot_execute(hrobot, command="CurPos") == robot.pose
+    assert robot.arm
+  finally:
+    client.close()
+    server.stop()
+
+@pytest.mark.parametrize("restore_motor", [False, True])
+def test_motor_restore_is_opt_in(restore_motor):
+  (server, robot) = _start()
+  client = ResilientBCAPClient(server.host, server.port, 1, restore_motor=restore_motor)
+  try:
+    (hctrl, hrobot) = _open(client)
+    client.robot_execute(hrobot, "Motor", [1, 0])
+    old = client._client
+    old._sock.shutdown(socket.SHUT_RDWR)
+    robot.motor = False
+    client.robot_execute(hrobot, "CurPos")
+    assert old._sock is None
+    assert robot.motor == restore_motor
+  finally:
+    client.close()
+    server.stop()
+
+def test_close_interrupts_backoff():
+  (server, robot) = _start()
+  client = ResilientBCAPClient(server.host, server.port, 1, backoff=5.0, give_up=60)
+  (hctrl, hrobot) = _open(client)
+  server.stop()
+
+  errors = []
+  def call():
+    try:
+      client.robot_execute(hrobot, "CurPos")
+    except ORiNException as e:
+      errors.append(e.hresult)
+  thread = Thread(target=call)
+  thread.start()
+  time.sleep(0.2)
+  # 再接続の待ち (5 s) の間も close() はすぐ戻り, 待っていた呼び出しも終わる
+  t0 = time.perf_counter()
+  client.close()
+  thread.join(2)
+  assert time.perf_counter() - t0 < 1.0
+  assert not thread.is_alive()
+  assert errors == [HResult.E_NOT_CONNECTED]
@@ -0,0 +1,73 @@
+# -*- coding:utf-8 -*-
+import time
+import pytest
+from bcapclient import BCAPClient
+from bcapserver import BCAPServer, SlaveModeSimulator
+from slavemode import SlaveModeStreamer
+
+CYCLE = 0.02
+
+@pytest.fixture
+def robot():
+  server = BCAPServer()
+  sim = SlaveModeSimulator(server, cycle=CYCLE)
+  server.start()
+  client = BCAPClient(server.host, server.port, 2)
+  yield (server, sim, client)
+  server.stop()
+
+def _poses(n):
+  return [[300.0 + i, 0.0, 400.0, 180.0, 0.0, 180.0, -1.0] for i in range(n)]
+
+def _stall(server, sim, calls, delay):
+  # calls 回目 (1 始まり) の slvMove の前に delay [s] 止まる
+  count = [0]
+  def move(args):
+    count[0] += 1
+    if count[0] in calls:
+      time.sleep(delay)
+    return sim._move(args)
+  server.set_command("slvMove", move)
+
+def _sent(sim):
+  # 送られた姿勢を, 続けて同じものはまとめて並べる
+  poses = []
+  for (tick, pose) in sim.trace:
+    if not poses or poses[-1] != pose:
+      poses.append(pose)
+  return poses
+
+def test_streams_every_pose(robot):
+  (server, sim, client) = robot
+  poses = _poses(10)
+  stats = SlaveModeStreamer(client, 1, cycle=CYCLE).run(poses)
+  assert stats["sent"] == 10
+  assert not stats["aborted"]
+  assert _sent(sim) == poses
+  assert sim._mode == 0
+
+def test_holds_last_pose_after_miss(robot):
+  (server, sim, client) = robot
+  poses = _poses(12)
+  _stall(server, sim, {5}, 3 * CYCLE)
+  streamer = SlaveModeStreamer(client, 1, cycle=CYCLE, max_miss=3)
+  stats = streamer.run(poses)
+  assert not stats["aborted"]
+  assert stats["missed"] >= 2
+  assert stats["held"] >= 1
+  # 周期落ちしても先の点に飛ばず, すべての点を順に送る
+  assert _sent(sim) == poses
+  assert stats["sent"] == len(poses) + stats["held"]
+
+def test_aborts_after_max_miss(robot):
+  (server, sim, client) = robot
+  poses = _poses(20)
+  _stall(server, sim, set(range(3, 21)), 2 * CYCLE)
+  streamer = SlaveModeStreamer(client, 1, cycle=CYCLE, max_miss=2)
+  stats = streamer.run(poses)
+  assert stats["aborted"]
+  assert stats["max_run"] == 3
+  assert stats["sent"] < len(poses)
+  assert _sent(sim) == poses[:len(_sent(sim))]
+  # 打ち切った後はスレーブモードを抜けている
+  assert sim._mode == 0
@@ -1,12 +1,33 @@
 import serial
 import time
-import csv
 import datetime
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'moveRobot'))
+from serialingest import FIRMWARE_COLUMNS, SerialIngest
+from columnstore import ColumnWriter, wall_clock
 
 # --- 設定 ---
 COM_PORT = 'COM18'   # Arduinoのポート
 BAUD_RATE = 460800   # ArduinoのSerial.beginの値と合わせてください
-OUTPUT_FILE = 'vesc_imu_log.csv'
+OUTPUT_DIR = 'vesc_imu_log'  # 列ごとのバイナリで追記する (CSV は python moveRobot/columnstore.py export vesc_imu_log)
+# 書き込んであるファームウェア. 1 行の列数と列名はこれで決まる
+#   ArduinoMega_20251216: 電流1 + IMU6 + 周波数1 = 8列
+#   ArduinoMega_20260107: 電流1 + IMU6 + 力覚6 + 周波数1 + micros = 15列
+FIRMWARE = 'ArduinoMega_20260107'
+
+# Time は time.monotonic_ns() (壁時計との対応は実行ごとに manifest.json の anchors に記録される)
+SENSOR_COLUMNS = FIRMWARE_COLUMNS[FIRMWARE]
+COLUMNS = [('Time', '<i8', 'monotonic_ns')] + SENSOR_COLUMNS
+
+def open_log(path, columns):
+    # 既存のログと列が違う (ファームウェアを替えた等) ときは追記できないので, path_<日時> に新しく記録する
+    try:
+        return ColumnWriter(path, columns)
+    except ValueError:
+        rollover = f"{path}_{datetime.datetime.now():%Y%m%d_%H%M%S}"
+        print(f"{path} は列の構成が違うため {rollover} に記録します。")
+        return ColumnWriter(rollover, columns)
 
 def main():
     try:
@@ -18,56 +39,32 @@ def main():
 
     time.sleep(2) # Arduinoのリセット待ち
 
-    with open(OUTPUT_FILE, 'a', newline='') as f:
-        writer = csv.writer(f)
-        
-        # ヘッダーを書き込む
-        headers = ['Time', 'Current', 'AcX', 'AcY', 'AcZ', 'GyX', 'GyY', 'GyZ', 'Freq']
-        writer.writerow(headers)
-        
-        print(f"計測を開始します... データ保存先: {OUTPUT_FILE}")
+    names = [name for (name, dtype, fmt) in SENSOR_COLUMNS]
+    freq = names.index('Freq')
+    with open_log(OUTPUT_DIR, COLUMNS) as writer:
+        print(f"計測を開始します... データ保存先: {writer.path}")
         print("停止は Ctrl+C")
         
         # 1. 開始コマンド送信
         ser.write(b's')
 
+        # 届いた分をまとめて読み, ファームウェアの列数ちょうどの行だけを記録する
+        ingest = SerialIngest(ser, fields=len(names))
+
         try:
             while True:
-                if ser.in_waiting > 0:
-                    try:
-                        # Arduinoからの行を読み取る
-                        line = ser.readline().decode('utf-8').strip()
-                        
-                        # 空行は無視
-                        if not line:
-                            continue
+                batch = ingest.read()
+                if not batch.lines:
+                    continue
 
-                        # カンマで分割してリストにする
-                        parts = line.split(',')
-                        
-                        # データの個数チェック (電流1 + IMU6 + 周波数1 = 8個以上あるか)
-                        if len(parts) >= 8:
-                            try:
-                                # 数値として正しいか軽くチェック（最初の電流値がfloat変換できるか）
-                                float(parts[0])
+                # 記録: [受信時刻 (monotonic_ns)] + センサの列. 文字列にするのは表示だけ
+                columns = {name: batch.values[:, i] for (i, name) in enumerate(names)}
+                columns['Time'] = batch.t
+                writer.append(columns)
 
-                                now = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-                                
-                                # ログ用データ作成: [時刻] + [受信したデータのリスト]
-                                log_data = [now] + parts
-                                
-                                # コンソール表示 (整形して表示)
-                                print(f"{now} -> Cur:{parts[0]}A, Freq:{parts[-1]}Hz")
-                                
-                                # CSVに記録
-                                writer.writerow(log_data)
-                                
-                            except ValueError:
-                                # 数値変換エラー（通信ノイズなど）は無視
-                                pass
-                        
-                    except UnicodeDecodeError:
-                        pass
+                # コンソール表示 (バッチの最後の行のみ)
+                now = datetime.datetime.fromtimestamp(wall_clock(batch.t, writer.anchor) / 1e9)
+                print(f"{now:%H:%M:%S.%f}"[:-3] + f" -> Cur:{batch.values[-1, 0]:g}A, Freq:{batch.values[-1, freq]:g}Hz")
 
         except KeyboardInterrupt:
             print("\n停止操作を受信しました。")
@@ -78,6 +75,9 @@ def main():
             ser.write(b'e')
             time.sleep(0.5)
             ser.close()
+            writer.flush()
+            st = ingest.stats()
+            print(f"受信 {st['parsed']} 行 (不正 {st['malformed']}, 破棄 {st['dropped']}), 保存 {writer.rows} 行")
             print("終了しました。")
 
 if __name__ == '__main__':